@@ -3,29 +3,185 @@
 This module exposes a small demo API used by the frontend demo and tests.
 """
 
-import sqlite3
-from typing import Optional
+from contextlib import asynccontextmanager
+import os
+from typing import List, Optional
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, JSONResponse
+from starlette.middleware.base import BaseHTTPMiddleware
 from pydantic import BaseModel
 
 from src.approval_system import (
     init_db,
     create_user,
+    import_users,
     send_letter,
     list_pending_for_role,
+    get_pending_counts,
     list_all_letters,
+    get_admin_overview,
+    find_users_by_name,
     act_on_letter,
+    ConflictError,
     get_letter,
+    get_letter_events,
     resend_letter,
 )
-
-DB_PATH = "approval.db"
+from src.approval_system import idempotency
+from src.approval_system.admission import Admission
+from src.approval_system.db import get_conn, track_queries
+from src.approval_system.jobs import JobQueue, get_job, result_media_type, submit_job
+from src.approval_system.records import dumps
+from src.approval_system.replica import ReplicaManager
+from src.approval_system.roles import role_id
+from src.approval_system.timestamps import isoformat_fields
+from src.approval_system.writer import WriteQueue
+
+DB_PATH = os.environ.get("APPROVAL_DB", "approval.db")
 
 init_db(DB_PATH)
 
-app = FastAPI(title="Approval System API")
+# Optional single-writer mode (APPROVAL_WRITE_QUEUE=1): writes go through one
+# group-committing thread instead of opening a connection per request.
+# X-Query-Count / X-Query-Time-Ms headers, for debugging only: they put
+# tracing wrappers on every connection
+QUERY_HEADERS = (
+    os.environ.get("APPROVAL_SQL_TRACE", "") not in ("", "0")
+    or os.environ.get("APPROVAL_DEBUG", "") not in ("", "0")
+)
+
+WRITER = (
+    WriteQueue(DB_PATH, traced=QUERY_HEADERS) if os.environ.get("APPROVAL_WRITE_QUEUE") == "1" else None
+)
+
+# Optional reporting replica (APPROVAL_REPLICA_INTERVAL=<seconds>): a snapshot
+# refreshed in the background that ?replica=true listings read instead.
+REPLICA = ReplicaManager.from_env(DB_PATH)
+if REPLICA is not None:
+    REPLICA.start()
+
+# Background exports and reports; workers (APPROVAL_JOB_WORKERS, default 2)
+# start with the first submitted job.
+JOBS = JobQueue.from_env(DB_PATH)
+
+
+# Times a conflicting approval is re-read and retried before answering 409
+ACT_RETRIES = 2
+
+
+def _write(func, *args):
+    """Run a service write, through the writer queue when it is enabled."""
+    if WRITER is None:
+        return func(DB_PATH, *args)
+    return WRITER.submit(func, *args).result()
+
+
+def _direct(func, *args):
+    return func(DB_PATH, *args)
+
+
+def _read_path(replica: bool) -> str:
+    """DB to read from: the replica when asked for and fresh, else the primary."""
+    return REPLICA.reader_path() if replica and REPLICA is not None else DB_PATH
+
+
+def _idempotent(request: Request, payload: BaseModel, handler):
+    """Run ``handler`` at most once per ``Idempotency-Key`` request header.
+
+    ``handler(write)`` performs the endpoint's writes through ``write`` and
+    returns the response content or raises ``HTTPException``. Without the
+    header it runs as a plain request. With it, the first response (errors
+    included) is stored and replayed to retries, marked with an
+    ``Idempotent-Replayed: true`` header.
+    """
+    key = request.headers.get("Idempotency-Key")
+    if key is None:
+        return handler(_write)
+    request_hash = idempotency.fingerprint(request.url.path, payload.model_dump())
+
+    def attempt():
+        try:
+            return 200, dumps(isoformat_fields(handler(_direct)))
+        except HTTPException as e:
+            if e.status_code == 409:
+                # a lost race is not the request's outcome; let retries run it again
+                raise
+            return e.status_code, dumps({"detail": e.detail})
+
+    try:
+        stored = idempotency.lookup(DB_PATH, key, request_hash)
+        if stored is not None:
+            status, body, replayed = (*stored, True)
+        else:
+            # the whole attempt runs where writes run, so it shares their transaction
+            status, body, replayed = _write(idempotency.run, key, request_hash, attempt)
+    except idempotency.IdempotencyKeyReused as e:
+        raise HTTPException(status_code=422, detail=str(e)) from e
+    headers = {"Idempotent-Replayed": "true"} if replayed else None
+    return Response(body, status_code=status, media_type="application/json", headers=headers)
+
+# Responses smaller than this (bytes) are sent uncompressed
+GZIP_MIN_SIZE = 1024
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response encoded by ``records.dumps`` (orjson when installed).
+
+    List endpoints return this directly so rows skip FastAPI's
+    ``jsonable_encoder`` pass. Timestamps, stored as epoch ms, go out as
+    ISO-8601 text.
+    """
+
+    def render(self, content) -> bytes:
+        return dumps(isoformat_fields(content))
+
+
+def _fields(fields: Optional[str]):
+    """Parse a comma-separated ``fields=`` query parameter."""
+    if not fields:
+        return None
+    return [f.strip() for f in fields.split(",") if f.strip()]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the concurrency slots belong to the loop that serves requests
+    ADMISSION.bind()
+    yield
+
+
+app = FastAPI(title="Approval System API", default_response_class=FastJSONResponse, lifespan=lifespan)
+
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MIN_SIZE)
+
+# Per-client rate limits and a global cap on concurrent requests; limits come
+# from APPROVAL_* environment variables (see admission.py).
+ADMISSION = Admission.from_env()
+
+
+async def admission_control(request: Request, call_next):
+    """Reject requests over their client's budget or beyond the queue limit."""
+    if not ADMISSION.enabled or request.method == "OPTIONS" or request.url.path == "/api/admission":
+        return await call_next(request)
+    client = ADMISSION.client_key(
+        request.client.host if request.client else None, request.headers.get("X-User-Id")
+    )
+    rejected = await ADMISSION.enter(client, write=request.method not in ("GET", "HEAD"))
+    if rejected:
+        status, retry_after = rejected
+        detail = "Too many requests" if status == 429 else "Server busy"
+        return JSONResponse({"detail": detail}, status_code=status, headers={"Retry-After": str(retry_after)})
+    try:
+        return await call_next(request)
+    finally:
+        ADMISSION.leave()
+
+
+# added before CORS so rejections still carry CORS headers
+app.add_middleware(BaseHTTPMiddleware, dispatch=admission_control)
 
 app.add_middleware(
     CORSMiddleware,
@@ -33,9 +189,23 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Query-Count", "X-Query-Time-Ms", "Idempotent-Replayed"],
 )
 
 
+async def count_queries(request: Request, call_next):
+    """Report how many SQL statements each request ran, including queued writes."""
+    with track_queries() as stats:
+        response = await call_next(request)
+    response.headers["X-Query-Count"] = str(stats.count)
+    response.headers["X-Query-Time-Ms"] = f"{stats.total_ms:.1f}"
+    return response
+
+
+if QUERY_HEADERS:
+    app.middleware("http")(count_queries)
+
+
 class CreateUserIn(BaseModel):
     """Payload for creating a user."""
     name: str
@@ -62,50 +232,109 @@ class ActIn(BaseModel):
 @app.get("/api/users")
 def get_users():
     """Return all users from the database."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_conn(DB_PATH)
     conn.row_factory = None
     cur = conn.cursor()
-    cur.execute("SELECT id, name, role FROM users ORDER BY role, name")
+    cur.execute(
+        "SELECT u.id, u.name, r.name FROM users u JOIN roles r ON r.id = u.role_id ORDER BY r.name, u.name"
+    )
     rows = cur.fetchall()
     conn.close()
     users = [{"id": r[0], "name": r[1], "role": r[2]} for r in rows]
     return users
 
 
+@app.get("/api/users/lookup")
+def lookup_users(name: str):
+    """Return users whose name matches ``name`` (case-insensitive)."""
+    return find_users_by_name(DB_PATH, name)
+
+
 @app.post("/api/users")
 def post_user(payload: CreateUserIn):
     """Create a user from payload and return its id."""
     try:
-        uid = create_user(DB_PATH, payload.name, payload.role)
+        uid = _write(create_user, payload.name, payload.role)
         return {"id": uid, "name": payload.name, "role": payload.role}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e)) from e
 
 
+class BulkUsersIn(BaseModel):
+    users: List[CreateUserIn]
+
+
+@app.post("/api/users/bulk")
+def post_users_bulk(payload: BulkUsersIn, request: Request):
+    """Create many users at once; returns the count imported and the rows rejected."""
+    def handle(write):
+        return write(import_users, [u.model_dump() for u in payload.users])
+
+    return _idempotent(request, payload, handle)
+
+
 @app.post("/api/send")
-def post_send(payload: SendLetterIn):
+def post_send(payload: SendLetterIn, request: Request):
     """Send a new letter and return its id."""
-    try:
-        lid = send_letter(DB_PATH, payload.sender_id, payload.title, payload.body)
-        return {"id": lid}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e)) from e
+    def handle(write):
+        try:
+            lid = write(send_letter, payload.sender_id, payload.title, payload.body)
+            return {"id": lid}
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e)) from e
+
+    return _idempotent(request, payload, handle)
+
+
+@app.get("/api/pending/counts")
+def get_pending_counts_endpoint():
+    """Return the number of pending letters for every role."""
+    return get_pending_counts(DB_PATH)
 
 
 @app.get("/api/pending")
-def get_pending(role: str):
-    """List pending approvals for a role."""
+def get_pending(
+    role: str,
+    fields: Optional[str] = None,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+):
+    """List pending approvals for a role, optionally only the given ``fields``.
+
+    ``from``/``to`` (ISO date or datetime) limit letters to those created in
+    ``[from, to)``.
+    """
     try:
-        rows = list_pending_for_role(DB_PATH, role)
-        return rows
+        rows = list_pending_for_role(DB_PATH, role, _fields(fields), date_from, date_to)
+        return FastJSONResponse(rows)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e)) from e
 
 
 @app.get("/api/letters")
-def get_letters():
-    """Return all letters."""
-    return list_all_letters(DB_PATH)
+def get_letters(
+    fields: Optional[str] = None,
+    replica: bool = False,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+):
+    """Return all letters, optionally only the given ``fields`` (e.g. ``id,title,status``).
+
+    ``from``/``to`` (ISO date or datetime) limit them to letters created in
+    ``[from, to)``. ``replica=true`` reads the reporting replica, which may
+    lag by up to its refresh interval.
+    """
+    try:
+        rows = list_all_letters(_read_path(replica), None, _fields(fields), date_from, date_to)
+        return FastJSONResponse(rows)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+
+
+@app.get("/api/admin/overview")
+def get_overview(recent: int = 10, replica: bool = False):
+    """Return letter counts by status, pending counts per role and recent letters."""
+    return get_admin_overview(_read_path(replica), recent)
 
 
 @app.get("/api/letter/{letter_id}")
@@ -117,11 +346,20 @@ def get_letter_endpoint(letter_id: int):
         raise HTTPException(status_code=404, detail=str(e)) from e
 
 
+@app.get("/api/letter/{letter_id}/events")
+def get_letter_events_endpoint(letter_id: int):
+    """Return a letter's event log (every send, decision, comment and resend), oldest first."""
+    events = get_letter_events(DB_PATH, letter_id)
+    if not events:
+        raise HTTPException(status_code=404, detail="Letter not found")
+    return events
+
+
 @app.delete("/api/users/{user_id}")
 def delete_user(user_id: int):
     """Delete a user by ID."""
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_conn(DB_PATH)
         cur = conn.cursor()
         cur.execute("DELETE FROM users WHERE id = ?", (user_id,))
         conn.commit()
@@ -132,41 +370,46 @@ def delete_user(user_id: int):
 
 
 @app.post("/api/act")
-def post_act(payload: ActIn):
+def post_act(payload: ActIn, request: Request):
     """Actor approves or rejects a letter's current step."""
-    # Ensure actor exists (create if missing)
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = None
-    cur = conn.cursor()
-    query = "SELECT id FROM users WHERE name = ? AND role = ?"
-    params = (payload.actor_name, payload.actor_role)
-    cur.execute(query, params)
-    found = cur.fetchone()
-    conn.close()
+    def handle(write):
+        # Ensure actor exists (create if missing)
+        conn = get_conn(DB_PATH)
+        cur = conn.cursor()
+        query = "SELECT id FROM users WHERE name = ? AND role_id = ?"
+        params = (payload.actor_name, role_id(payload.actor_role))
+        cur.execute(query, params)
+        found = cur.fetchone()
+        conn.close()
 
-    if found:
-        actor_id = found[0]
-    else:
-        # create user
-        try:
-            actor_id = create_user(DB_PATH, payload.actor_name, payload.actor_role)
-        except Exception as exc:
-            # if creation fails (e.g., invalid role), return error
-            _msg = "Cannot create actor user; invalid role or duplicate"
-            raise HTTPException(status_code=400, detail=_msg) from exc
+        if found:
+            actor_id = found[0]
+        else:
+            # create user
+            try:
+                actor_id = write(create_user, payload.actor_name, payload.actor_role)
+            except Exception as exc:
+                # if creation fails (e.g., invalid role), return error
+                _msg = "Cannot create actor user; invalid role or duplicate"
+                raise HTTPException(status_code=400, detail=_msg) from exc
 
-    try:
-        result = act_on_letter(
-            DB_PATH,
-            payload.letter_id,
-            actor_id,
-            payload.action,
-            payload.comments,
-            payload.recommendations,
-        )
-        return result
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e)) from e
+        try:
+            result = write(
+                act_on_letter,
+                payload.letter_id,
+                actor_id,
+                payload.action,
+                payload.comments,
+                payload.recommendations,
+                ACT_RETRIES,
+            )
+            return result
+        except ConflictError as e:
+            raise HTTPException(status_code=409, detail=str(e)) from e
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e)) from e
+
+    return _idempotent(request, payload, handle)
 
 
 class ResendIn(BaseModel):
@@ -178,17 +421,83 @@ class ResendIn(BaseModel):
 
 
 @app.post("/api/resend")
-def post_resend(payload: ResendIn):
+def post_resend(payload: ResendIn, request: Request):
     """Allow the sender to update and resend a rejected letter."""
-    try:
-        _lid = payload.letter_id
-        _sid = payload.sender_id
-        _title = payload.title
-        _body = payload.body
-        resend_letter(DB_PATH, _lid, _sid, _title, _body)
-        return {"status": "resent", "letter_id": _lid}
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e)) from e
+    def handle(write):
+        try:
+            _lid = payload.letter_id
+            _sid = payload.sender_id
+            _title = payload.title
+            _body = payload.body
+            write(resend_letter, _lid, _sid, _title, _body)
+            return {"status": "resent", "letter_id": _lid}
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e)) from e
+
+    return _idempotent(request, payload, handle)
+
+
+@app.get("/api/admission")
+def get_admission_stats():
+    """Return admission control counters (not rate limited)."""
+    return ADMISSION.stats()
+
+
+@app.get("/api/replica")
+def get_replica_stats():
+    """Return the reporting replica's staleness and refresh counters."""
+    if REPLICA is None:
+        return {"enabled": False}
+    return {"enabled": True, **REPLICA.stats()}
+
+
+class JobIn(BaseModel):
+    kind: str
+    params: dict = {}
+
+
+@app.post("/api/jobs")
+def post_job(payload: JobIn, request: Request):
+    """Queue a background export or report and return its id."""
+    def handle(write):
+        try:
+            job_id = write(submit_job, payload.kind, payload.params)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e)) from e
+        return {"id": job_id, "status": "queued", "url": f"/api/jobs/{job_id}"}
+
+    response = _idempotent(request, payload, handle)
+    JOBS.start().wake()
+    return response
+
+
+def _job_or_404(job_id: int):
+    job = get_job(DB_PATH, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/api/jobs/{job_id}")
+def get_job_status(job_id: int):
+    """Return a job's status and progress, with a result link once done."""
+    job = _job_or_404(job_id)
+    out = {k: job[k] for k in job if k != "result_path"}
+    out["result_url"] = f"/api/jobs/{job_id}/result" if job["status"] == "done" else None
+    return out
+
+
+@app.get("/api/jobs/{job_id}/result")
+def get_job_result(job_id: int):
+    """Download a finished job's result file."""
+    job = _job_or_404(job_id)
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    return FileResponse(
+        job["result_path"],
+        media_type=result_media_type(job),
+        filename=os.path.basename(job["result_path"]),
+    )
 
 
 @app.get("/api/notifications")
@@ -203,7 +512,7 @@ def reset_password(user_id: int):
     """Reset a user's password to the default (demo only)."""
     try:
         # Note: This is a demo API. In production, would store hashed passwords.
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_conn(DB_PATH)
         cur = conn.cursor()
         cur.execute("SELECT id FROM users WHERE id = ?", (user_id,))
         user = cur.fetchone()
@@ -6,12 +6,20 @@ from src.approval_system import (
     send_letter,
     list_pending_for_role,
     list_all_letters,
+    list_letters_page,
+    list_pending_page,
+    get_pending_counts,
     act_on_letter,
     get_letter,
     get_letter_history,
+    resend_letter,
 )
+from src.approval_system.db import DataVersion
+from src.approval_system.jobs import JobQueue, get_job, submit_job
+from src.approval_system.replica import ReplicaManager
+from src.approval_system.timestamps import to_iso
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 
 # Page configuration
 st.set_page_config(
@@ -23,35 +31,125 @@ st.set_page_config(
 # Database path
 DB_PATH = "approval.db"
 
+# How long (seconds) a rerun may serve cached data before checking whether
+# another process wrote to the DB
+CACHE_STALENESS = 2.0
+
+# Rows per page on the letter listings
+PAGE_SIZE = 20
+
 # Initialize database if needed
 init_db(DB_PATH)
 
+
+# Streamlit re-runs this whole script on every interaction. Reads below are
+# cached under the DB data version, so reruns that don't write skip the DB.
+@st.cache_resource
+def data_version():
+    return DataVersion(DB_PATH, max_age=CACHE_STALENESS)
+
+
+def note_write():
+    """Invalidate cached reads after this app changed the DB."""
+    data_version().bump()
+
+
 # Helper function to get all users
-def get_all_users():
+@st.cache_data(max_entries=4)
+def get_all_users(version):
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
     cur = conn.cursor()
-    cur.execute("SELECT id, name, role FROM users ORDER BY role, name")
+    cur.execute(
+        """SELECT u.id, u.name, r.name AS role FROM users u
+           JOIN roles r ON r.id = u.role_id ORDER BY r.name, u.name"""
+    )
     users = [dict(row) for row in cur.fetchall()]
     conn.close()
     return users
 
-# Helper function to get user by ID
-def get_user_by_id(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("SELECT id, name, role FROM users WHERE id = ?", (user_id,))
-    user = cur.fetchone()
-    conn.close()
-    return dict(user) if user else None
+
+@st.cache_data(max_entries=32)
+def cached_letters(version, user_id=None):
+    return list_all_letters(DB_PATH, user_id)
+
+
+@st.cache_resource
+def replica():
+    """Reporting replica refresher, when APPROVAL_REPLICA_INTERVAL is set."""
+    manager = ReplicaManager.from_env(DB_PATH)
+    return manager.start() if manager else None
+
+
+@st.cache_resource
+def job_queue():
+    """Worker pool for exports, started on first use."""
+    return JobQueue.from_env(DB_PATH).start()
+
+
+@st.cache_data(max_entries=4)
+def cached_report_letters(path, version):
+    """All letters from ``path``; ``version`` is the snapshot time or data version."""
+    return list_all_letters(path)
+
+
+@st.cache_data(max_entries=32)
+def cached_pending(version, role):
+    return list_pending_for_role(DB_PATH, role)
+
+
+@st.cache_data(max_entries=4)
+def cached_pending_counts(version):
+    return get_pending_counts(DB_PATH)
+
+
+@st.cache_data(max_entries=64)
+def cached_letter(version, letter_id):
+    return get_letter(DB_PATH, letter_id)
+
+
+@st.cache_data(max_entries=64)
+def cached_letters_page(version, offset, **filters):
+    return list_letters_page(DB_PATH, limit=PAGE_SIZE, offset=offset, **filters)
+
+
+@st.cache_data(max_entries=32)
+def cached_pending_page(version, role, offset):
+    return list_pending_page(DB_PATH, role, limit=PAGE_SIZE, offset=offset)
+
+
+def page_offset(key, total):
+    """Render a page picker for ``total`` rows and return the row offset."""
+    pages = max(1, -(-total // PAGE_SIZE))
+    if pages == 1:
+        return 0
+    number = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, key=f"{key}_{pages}")
+    return (number - 1) * PAGE_SIZE
+
+
+def letter_row(letter_id, label):
+    """Render a one-line letter summary with an open/close toggle.
+
+    Returns True when this letter is the open one; only then does the page
+    load its body and forms.
+    """
+    is_open = st.session_state.get('open_letter') == letter_id
+    col1, col2 = st.columns([8, 1])
+    col1.markdown(label)
+    if col2.button("Close" if is_open else "Open", key=f"toggle_{letter_id}"):
+        st.session_state['open_letter'] = None if is_open else letter_id
+        st.rerun()
+    return is_open
+
+
+version = data_version().token()
 
 # Sidebar for navigation
 st.sidebar.title("📋 Approval System")
 st.sidebar.markdown("---")
 
 # User selection (simulate login)
-users = get_all_users()
+users = get_all_users(version)
 if users:
     user_options = {f"{u['name']} ({u['role']})": u['id'] for u in users}
     selected_user = st.sidebar.selectbox(
@@ -59,13 +157,16 @@ if users:
         options=list(user_options.keys())
     )
     current_user_id = user_options[selected_user]
-    current_user = get_user_by_id(current_user_id)
+    current_user = next(u for u in users if u['id'] == current_user_id)
     
     st.sidebar.success(f"Logged in as: **{current_user['name']}**")
     st.sidebar.info(f"Role: **{current_user['role']}**")
+    waiting = cached_pending_counts(version).get(current_user['role'], 0)
+    if waiting:
+        st.sidebar.info(f"📥 {waiting} letter(s) awaiting your action")
     # notify writer of any rejected letters
     if current_user['id']:
-        all_for_user = list_all_letters(DB_PATH, current_user['id'])
+        all_for_user = cached_letters(version, current_user['id'])
         rejected = [l for l in all_for_user if l['status'] == 'rejected']
         if rejected:
             st.sidebar.warning(f"You have {len(rejected)} rejected letter(s) - please edit & resend.")
@@ -89,7 +190,7 @@ if page == "🏠 Dashboard":
     st.header("Dashboard")
     
     # Get statistics
-    all_letters = list_all_letters(DB_PATH)
+    all_letters = cached_letters(version)
     
     col1, col2, col3, col4 = st.columns(4)
     
@@ -115,6 +216,7 @@ if page == "🏠 Dashboard":
     if all_letters:
         df = pd.DataFrame(all_letters)
         df = df[['id', 'title', 'sender_name', 'status', 'created_at']]
+        df['created_at'] = pd.to_datetime(df['created_at'], unit='ms')
         df.columns = ['ID', 'Title', 'Sender', 'Status', 'Sent']
         st.dataframe(df, width='stretch')
     else:
@@ -143,6 +245,7 @@ elif page == "📨 Send Letter":
                 if submitted and title and body:
                     try:
                         letter_id = send_letter(DB_PATH, current_user_id, title, body)
+                        note_write()
                         st.success(f"✅ Letter sent successfully! ID: {letter_id}")
                         
                         # Show the approval route
@@ -163,17 +266,27 @@ elif page == "📥 Pending Approvals":
     st.header("Pending Approvals")
     
     if current_user:
-        # Get pending letters for current user's role
-        pending = list_pending_for_role(DB_PATH, current_user['role'])
+        # Only the current page of the inbox is fetched; a letter's body and
+        # action form load when it is opened.
+        offset = page_offset("pending_page", cached_pending_page(version, current_user['role'], 0)[1])
+        pending, total = cached_pending_page(version, current_user['role'], offset)
         
         if pending:
-            st.success(f"You have {len(pending)} pending letter(s) to review")
+            st.success(f"You have {total} pending letter(s) to review")
             
             for letter in pending:
-                with st.expander(f"📄 Letter #{letter['letter_id']}: {letter['title']}"):
+                is_open = letter_row(
+                    letter['letter_id'],
+                    f"📄 Letter #{letter['letter_id']}: {letter['title']} — "
+                    f"{letter['sender_name']} · {to_iso(letter['created_at'])[:10]}",
+                )
+                if not is_open:
+                    continue
+                with st.container(border=True):
+                    details = cached_letter(version, letter['letter_id'])
                     st.write(f"**From:** {letter['sender_name']}")
-                    st.write(f"**Sent:** {letter['created_at']}")
-                    st.write(f"**Content:** {letter['body']}")
+                    st.write(f"**Sent:** {to_iso(letter['created_at'])}")
+                    st.write(f"**Content:** {details['letter']['body']}")
                     
                     # Action form
                     with st.form(f"action_form_{letter['letter_id']}"):
@@ -208,6 +321,7 @@ elif page == "📥 Pending Approvals":
                                     comments,
                                     recommendations
                                 )
+                                note_write()
                                 
                                 if action == "approve":
                                     if result['letter']['status'] == 'approved':
@@ -218,6 +332,7 @@ elif page == "📥 Pending Approvals":
                                 else:
                                     st.warning("❌ Letter rejected")
                                 
+                                st.session_state['open_letter'] = None
                                 st.rerun()
                             except Exception as e:
                                 st.error(f"Error: {e}")
@@ -229,32 +344,52 @@ elif page == "📥 Pending Approvals":
 elif page == "📋 All Letters":
     st.header("All Letters")
     
-    # Filters
-    col1, col2 = st.columns(2)
+    # Filters (applied in SQL)
+    col1, col2, col3, col4 = st.columns(4)
     with col1:
         status_filter = st.selectbox(
             "Filter by Status",
             ["All", "pending", "approved", "rejected"]
         )
     with col2:
+        sender_filter = st.text_input("Sender", placeholder="Sender name...")
+    with col3:
+        sent_between = st.date_input("Sent between", value=())
+    with col4:
         search = st.text_input("🔍 Search", placeholder="Search by title or content...")
     
-    # Get letters
-    letters = list_all_letters(DB_PATH)
+    filters = {
+        "status": None if status_filter == "All" else status_filter,
+        "sender": sender_filter or None,
+        "search": search or None,
+        "date_from": None,
+        "date_to": None,
+    }
+    if len(sent_between) >= 1:
+        filters["date_from"] = sent_between[0].isoformat()
+        # the end date is inclusive in the picker, exclusive in the query
+        filters["date_to"] = (sent_between[-1] + timedelta(days=1)).isoformat()
+    
+    offset = page_offset("letters_page", cached_letters_page(version, 0, **filters)[1])
+    letters, total = cached_letters_page(version, offset, **filters)
     
     if letters:
-        # Apply filters
-        if status_filter != "All":
-            letters = [l for l in letters if l['status'] == status_filter]
-        
-        if search:
-            letters = [l for l in letters if 
-                      search.lower() in l['title'].lower() or 
-                      search.lower() in l.get('body', '').lower()]
+        st.caption(f"{total} letter(s) match")
         
-        # Display letters
         for letter in letters:
-            with st.expander(f"📄 Letter #{letter['id']}: {letter['title']} ({letter['status']})"):
+            is_open = letter_row(
+                letter['id'],
+                f"📄 Letter #{letter['id']}: {letter['title']} ({letter['status']}) — "
+                f"{letter['sender_name']} · {to_iso(letter['created_at'])[:10]}",
+            )
+            if not is_open:
+                continue
+            try:
+                details = cached_letter(version, letter['id'])
+            except Exception as e:
+                st.error(f"Error loading details: {e}")
+                continue
+            with st.container(border=True):
                 col1, col2 = st.columns(2)
                 
                 with col1:
@@ -262,51 +397,35 @@ elif page == "📋 All Letters":
                     st.write(f"**Status:** {letter['status']}")
                 
                 with col2:
-                    st.write(f"**Sent:** {letter['created_at']}")
+                    st.write(f"**Sent:** {to_iso(letter['created_at'])}")
                 
                 st.write("**Content:**")
-                st.write(letter.get('body', 'No content'))
+                st.write(details['letter']['body'] or 'No content')
+                
+                # Approval steps
+                st.write("**Approval History:**")
+                steps_df = pd.DataFrame([dict(s) for s in details['steps']])
+                if not steps_df.empty:
+                    steps_df = steps_df[['step_index', 'role', 'status', 'actor_name', 'comments', 'acted_at']]
+                    steps_df['acted_at'] = pd.to_datetime(steps_df['acted_at'], unit='ms')
+                    steps_df.columns = ['Step', 'Role', 'Status', 'Actor', 'Comments', 'Date']
+                    st.dataframe(steps_df, width='stretch')
                 
-                # View details button
-                if st.button(f"View Full Details", key=f"view_{letter['id']}"):
-                    st.session_state['view_letter'] = letter['id']
                 # allow sender to edit & resend if rejected
                 if current_user and letter['sender_id'] == current_user_id and letter['status'] == 'rejected':
                     with st.form(f"resend_form_{letter['id']}"):
                         new_title = st.text_input("Title", value=letter['title'], key=f"rtitle_{letter['id']}")
-                        new_body = st.text_area("Body", value=letter.get('body',''), key=f"rbody_{letter['id']}")
+                        new_body = st.text_area("Body", value=details['letter']['body'] or '', key=f"rbody_{letter['id']}")
                         submitted2 = st.form_submit_button("✏️ Edit & Resend", type="secondary")
                         if submitted2:
                             try:
                                 # call service directly
                                 resend_letter(DB_PATH, letter['id'], current_user_id, new_title, new_body)
+                                note_write()
                                 st.success("Letter resent to approval chain")
                                 st.rerun()
                             except Exception as e:
                                 st.error(f"Resend failed: {e}")
-        
-        # Show selected letter details
-        if 'view_letter' in st.session_state:
-            letter_id = st.session_state['view_letter']
-            try:
-                details = get_letter(DB_PATH, letter_id)
-                
-                st.markdown("---")
-                st.subheader(f"📝 Letter #{letter_id} Details")
-                
-                # Approval steps
-                st.write("**Approval History:**")
-                steps_df = pd.DataFrame(details['steps'])
-                if not steps_df.empty:
-                    steps_df = steps_df[['step_index', 'role', 'status', 'actor_name', 'comments', 'acted_at']]
-                    steps_df.columns = ['Step', 'Role', 'Status', 'Actor', 'Comments', 'Date']
-                    st.dataframe(steps_df, width='stretch')
-                
-                if st.button("Close Details"):
-                    del st.session_state['view_letter']
-                    st.rerun()
-            except Exception as e:
-                st.error(f"Error loading details: {e}")
     else:
         st.info("No letters found")
 
@@ -317,7 +436,7 @@ elif page == "👥 Manage Users":
     
     with tab1:
         st.subheader("Current Users")
-        users = get_all_users()
+        users = get_all_users(version)
         if users:
             df = pd.DataFrame(users)
             st.dataframe(df, width='stretch')
@@ -341,6 +460,7 @@ elif page == "👥 Manage Users":
             if submitted and name:
                 try:
                     user_id = create_user(DB_PATH, name, role)
+                    note_write()
                     st.success(f"✅ User created successfully! ID: {user_id}")
                     st.rerun()
                 except Exception as e:
@@ -349,7 +469,15 @@ elif page == "👥 Manage Users":
 elif page == "📊 Reports":
     st.header("Reports & Analytics")
     
-    letters = list_all_letters(DB_PATH)
+    # Reports and the export read the replica when it is fresh enough, so
+    # they don't hold up approvals
+    manager = replica()
+    report_path = manager.reader_path() if manager else DB_PATH
+    if report_path == DB_PATH:
+        letters = cached_report_letters(DB_PATH, version)
+    else:
+        letters = cached_report_letters(report_path, manager.taken_at())
+        st.caption(f"Data as of {manager.staleness():.0f}s ago (reporting replica)")
     
     if letters:
         df = pd.DataFrame(letters)
@@ -361,19 +489,25 @@ elif page == "📊 Reports":
         
         # Letters over time
         st.subheader("Letters Over Time")
-        df['date'] = pd.to_datetime(df['created_at']).dt.date
+        df['date'] = pd.to_datetime(df['created_at'], unit='ms').dt.date
         daily_counts = df.groupby('date').size()
         st.line_chart(daily_counts)
         
-        # Export
+        # Export runs as a background job so a large one doesn't block the page
         if st.button("📥 Export to CSV"):
-            csv = df.to_csv(index=False)
-            st.download_button(
-                "Download CSV",
-                csv,
-                "letters_export.csv",
-                "text/csv"
-            )
+            st.session_state.export_job = submit_job(DB_PATH, "export_letters", {"format": "csv"})
+            job_queue().wake()
+        job_id = st.session_state.get("export_job")
+        job = get_job(DB_PATH, job_id) if job_id else None
+        if job is not None and job["status"] in ("queued", "running"):
+            st.progress(job["progress"], text=f"Export {job['status']}...")
+            if st.button("🔄 Refresh"):
+                st.rerun()
+        elif job is not None and job["status"] == "done":
+            with open(job["result_path"], "rb") as f:
+                st.download_button("Download CSV", f.read(), "letters_export.csv", "text/csv")
+        elif job is not None:
+            st.error(f"Export failed: {job['error']}")
     else:
         st.info("No data for reports yet")
         
\ No newline at end of file
@@ -29,6 +29,22 @@ function safeShow(elId) {
 
 function show(elId) { safeShow(elId); }
 
+// Idempotency-Key for one logical submission, kept in sessionStorage under
+// `scope`. A double-click, a retry or a resubmit after a network failure
+// sends the same key, so the server applies the write once and replays its
+// response. The key is dropped only after a 2xx (see clearIdempotencyKey);
+// include the payload in `scope` so an edited submission gets a fresh key.
+function idempotencyKey(scope) {
+    const name = `idem:${scope}`;
+    let key = sessionStorage.getItem(name);
+    if (!key) {
+        key = crypto.randomUUID();
+        sessionStorage.setItem(name, key);
+    }
+    return key;
+}
+function clearIdempotencyKey(scope) { sessionStorage.removeItem(`idem:${scope}`); }
+
 // create a simple debug panel on the page
 function ensureDebugPanel() {
     if (document.getElementById('debugPanel')) return;
@@ -85,8 +101,8 @@ async function studentLogin() {
 
     // Try find user by name; if not exists, create as Student
     try {
-        const users = await fetch(`${API_BASE}/users`).then(r => r.json());
-        let user = users.find(u => u.name.toLowerCase() === name.toLowerCase());
+        const users = await fetch(`${API_BASE}/users/lookup?name=${encodeURIComponent(name)}`).then(r => r.json());
+        let user = users[0];
         if (!user) {
             const res = await fetch(`${API_BASE}/users`, {
                 method: 'POST',
@@ -131,13 +147,16 @@ async function sendRequest() {
         return toast(`Please reduce your request to ${WORD_LIMIT} words or less.`, 'warning');
     }
 
+    const scope = `send:${user.id}:${reason}`;
     try {
         const res = await fetch(`${API_BASE}/send`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            // resubmitting this request reuses the key, so it is sent once
+            headers: { 'Content-Type': 'application/json', 'Idempotency-Key': idempotencyKey(scope) },
             body: JSON.stringify({ sender_id: user.id, title: 'Exit Request', body: reason })
         });
         if (!res.ok) throw new Error(await res.text());
+        clearIdempotencyKey(scope);
         const data = await res.json();
         toast('Request sent', 'success');
         document.getElementById('reason').value = '';
@@ -185,12 +204,11 @@ function adminLogin() {
 async function loadAdminOverview() {
     // load pending count and recent activity
     try {
-        const letters = await fetch(`${API_BASE}/letters`).then(r => r.json());
-        const pendingCount = letters.filter(l => l.status === 'pending').length;
-        setText('pendingBadge', pendingCount);
+        const overview = await fetch(`${API_BASE}/admin/overview?recent=10`).then(r => r.json());
+        setText('pendingBadge', overview.counts.pending || 0);
         const log = el('requestLog');
         if (log) log.innerHTML = '';
-        letters.slice(0, 10).forEach(l => {
+        overview.recent.forEach(l => {
             const el = document.createElement('div');
             el.className = 'log-entry';
             el.innerHTML = `<i class="fas fa-envelope"></i><div><strong>${l.title}</strong> — ${l.sender_name} — ${l.status}</div>`;
@@ -252,15 +270,17 @@ async function adminAct(action, comments = '', recommendations = '') {
         action = 'comment';
         toast('Role mismatch detected; sending as comment only', 'info');
     }
+    const scope = `act:${id}:${role}:${action}:${comments}:${recommendations}`;
     try {
         const res = await fetch(`${API_BASE}/act`, {
-            method: 'POST', headers: { 'Content-Type': 'application/json' },
+            method: 'POST', headers: { 'Content-Type': 'application/json', 'Idempotency-Key': idempotencyKey(scope) },
             body: JSON.stringify({ letter_id: Number(id), actor_name: 'Admin', actor_role: role, action, comments, recommendations })
         });
         if (!res.ok) {
             const txt = await res.text();
             throw new Error(txt);
         }
+        clearIdempotencyKey(scope);
         toast('Action submitted', 'success');
         loadAdminOverview();
         loadPendingRequest();
@@ -272,12 +292,14 @@ async function adminAct(action) {
     if (!id) return toast('No pending selected', 'warning');
     // ask which role to act as
     const role = prompt('Act as which role?', 'SRC') || 'SRC';
+    const scope = `act:${id}:${role}:${action}`;
     try {
         const res = await fetch(`${API_BASE}/act`, {
-            method: 'POST', headers: { 'Content-Type': 'application/json' },
+            method: 'POST', headers: { 'Content-Type': 'application/json', 'Idempotency-Key': idempotencyKey(scope) },
             body: JSON.stringify({ letter_id: Number(id), actor_name: 'Admin', actor_role: role, action })
         });
         if (!res.ok) throw new Error(await res.text());
+        clearIdempotencyKey(scope);
         toast('Action submitted', 'success');
         loadAdminOverview();
         loadPendingRequest();
@@ -0,0 +1,61 @@
+"""Write throughput of ShardedStorage by shard count.
+
+Each worker process sends letters as its own sender, and senders are spread
+evenly over the shards. With one shard every commit queues on the same file
+lock. With N shards up to N commits run at once, until cores or disk run
+out::
+
+    python benchmarks/shard_writes.py --shards 1,2,4,8 --workers 8 --letters 200
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.approval_system import ShardedStorage, create_user, send_letter
+
+
+def worker(paths, sender, letters, start):
+    store = ShardedStorage(paths)
+    start.wait()
+    began = time.perf_counter()
+    for i in range(letters):
+        send_letter(store, sender, f"Letter {i}", "Please approve my request. " * 20)
+    return began, time.perf_counter()
+
+
+def run(shards: int, workers: int, letters: int) -> float:
+    """Send ``workers * letters`` letters over ``shards`` shards; return letters per second."""
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, f"shard{i}.db") for i in range(shards)]
+        store = ShardedStorage(paths)
+        senders = [create_user(store, f"sender{i}", "Student") for i in range(workers)]
+        with multiprocessing.Manager() as manager:
+            start = manager.Barrier(workers)
+            with multiprocessing.Pool(workers) as pool:
+                spans = pool.starmap(worker, [(paths, s, letters, start) for s in senders])
+        elapsed = max(end for _, end in spans) - min(began for began, _ in spans)
+        return workers * letters / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", default="1,2,4,8", help="Comma-separated shard counts")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Writer processes")
+    parser.add_argument("--letters", type=int, default=200, help="Letters sent per worker")
+    args = parser.parse_args()
+
+    print(f"{args.workers} writer process(es), {args.letters} letters each, {os.cpu_count()} CPU(s)")
+    print(f"{'shards':>6}  {'letters/s':>10}  {'speedup':>7}")
+    baseline = None
+    for shards in (int(n) for n in args.shards.split(",")):
+        rate = run(shards, args.workers, args.letters)
+        baseline = baseline or rate
+        print(f"{shards:>6}  {rate:>10.0f}  {rate / baseline:>6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,44 @@
 """Simple CLI to interact with the approval system for manual testing."""
 import argparse
-from pathlib import Path
-from src.approval_system import (
-    init_db,
-    create_user,
-    send_letter,
-    list_pending_for_role,
-    list_all_letters,
-    act_on_letter,
-    get_letter,
-    get_letter_history,
-)
-import json
+import sys
+
+LIST_FORMATS = ["text", "json", "ndjson", "tsv"]
+
+
+def _tsv_field(value) -> str:
+    if value is None:
+        return ""
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def write_rows(rows, fmt: str, out=None) -> int:
+    """Stream ``rows`` to ``out`` as json, ndjson or tsv; return the row count.
+
+    Rows are written as they arrive, so memory use does not grow with the
+    size of the listing.
+    """
+    import json
+    from src.approval_system.records import json_default
+    from src.approval_system.timestamps import isoformat_fields
+
+    out = out or sys.stdout
+    count = 0
+    if fmt == "json":
+        out.write("[")
+    for row in rows:
+        row = isoformat_fields(row)
+        if fmt == "tsv":
+            if count == 0:
+                out.write("\t".join(row.keys()) + "\n")
+            out.write("\t".join(_tsv_field(v) for v in row.values()) + "\n")
+        elif fmt == "json":
+            out.write(("," if count else "") + "\n" + json.dumps(row, default=json_default))
+        else:
+            out.write(json.dumps(row, default=json_default) + "\n")
+        count += 1
+    if fmt == "json":
+        out.write("\n]\n" if count else "]\n")
+    return count
 
 
 def main():
@@ -27,6 +54,13 @@ def main():
     cu.add_argument("name", help="User's full name")
     cu.add_argument("role", help="User's role (e.g., Faculty, HOD, Dean, etc.)")
 
+    iu = sub.add_parser("import-users", help="Create users from a CSV file with name,role columns")
+    iu.add_argument("file", nargs="?", default="-", help="CSV file (default: stdin)")
+    iu.add_argument("--chunk-size", type=int, default=1000, help="Rows per transaction")
+    iu.add_argument(
+        "--format", choices=LIST_FORMATS, default="text", help="Output format for rejected rows"
+    )
+
     # Letter commands
     sl = sub.add_parser("send", help="Send a new letter")
     sl.add_argument("sender_id", type=int, help="ID of the sender (must be Faculty Association)")
@@ -34,10 +68,22 @@ def main():
     sl.add_argument("body", help="Letter body content")
 
     lp = sub.add_parser("list-pending", help="List pending letters for a role")
-    lp.add_argument("role", help="Role to check pending letters for")
+    lp.add_argument("role", nargs="?", help="Role to check pending letters for")
+    lp.add_argument("--format", choices=LIST_FORMATS, default="text", help="Output format")
+    lp.add_argument(
+        "--counts", action="store_true", help="Only count pending letters (for every role if none given)"
+    )
+    lp.add_argument("--from", dest="date_from", help="Only letters created on or after this ISO date")
+    lp.add_argument("--to", dest="date_to", help="Only letters created before this ISO date")
 
     la = sub.add_parser("list-all", help="List all letters")
     la.add_argument("--user-id", type=int, help="Filter by user ID (optional)")
+    la.add_argument("--format", choices=LIST_FORMATS, default="text", help="Output format")
+    la.add_argument(
+        "--replica", action="store_true", help="Read the reporting replica if it is fresh"
+    )
+    la.add_argument("--from", dest="date_from", help="Only letters created on or after this ISO date")
+    la.add_argument("--to", dest="date_to", help="Only letters created before this ISO date")
 
     act = sub.add_parser("act", help="Act on a letter (approve/reject)")
     act.add_argument("letter_id", type=int, help="ID of the letter")
@@ -52,12 +98,33 @@ def main():
     history = sub.add_parser("history", help="Show letter history")
     history.add_argument("letter_id", type=int, help="ID of the letter")
 
+    arc = sub.add_parser("archive", help="Move old finalized letters to the archive DB")
+    arc.add_argument("--days", type=int, default=365, help="Archive letters finalized more than this many days ago")
+    arc.add_argument("--batch-size", type=int, default=500, help="Letters moved per transaction")
+
+    sub.add_parser("stats", help="Show body storage and deduplication statistics")
+
+    rb = sub.add_parser("rebalance", help="Move letters to the shard their sender maps to")
+    rb.add_argument("shards", nargs="+", help="Shard DB files, in shard order (--db is ignored)")
+    rb.add_argument("--key", choices=["sender", "role"], default="sender", help="Shard key")
+    rb.add_argument("--batch-size", type=int, default=500, help="Letters moved per transaction")
+
+    bt = sub.add_parser("batch", help="Run NDJSON commands from a file or stdin")
+    bt.add_argument("file", nargs="?", default="-", help="NDJSON file (default: stdin)")
+    bt.add_argument("--chunk-size", type=int, default=500, help="Commands per transaction")
+
     args = p.parse_args()
     db_path = args.db
 
+    # service functions are imported per command to keep startup short
     try:
-        if args.cmd == "init":
+        # bring the schema up to date once, so every command works on old DBs
+        # (rebalance ignores --db and opens its shards itself)
+        if args.cmd and args.cmd != "rebalance":
+            from src.approval_system.service import init_db
             init_db(db_path)
+
+        if args.cmd == "init":
             print(f"✅ Database initialized: {db_path}")
             print("\nValid roles:", ", ".join([
                 "Faculty Association", "SRC", "Faculty", "HOD", "Dean",
@@ -65,10 +132,25 @@ def main():
             ]))
 
         elif args.cmd == "create-user":
+            from src.approval_system.service import create_user
             uid = create_user(db_path, args.name, args.role)
             print(f"✅ User created with ID: {uid}")
 
+        elif args.cmd == "import-users":
+            from src.approval_system.service import import_users
+            src = sys.stdin if args.file == "-" else open(args.file, newline="", encoding="utf-8")
+            with src:
+                result = import_users(db_path, src, args.chunk_size)
+            rejected = result["rejected"]
+            if args.format != "text":
+                write_rows(rejected, args.format)
+            else:
+                for r in rejected:
+                    print(f"  row {r['row']}: {r['error']}")
+            print(f"✅ Imported {result['imported']} user(s), rejected {len(rejected)}", file=sys.stderr)
+
         elif args.cmd == "send":
+            from src.approval_system.service import send_letter
             lid = send_letter(db_path, args.sender_id, args.title, args.body)
             print(f"✅ Letter created with ID: {lid}")
             print("\nApproval route:")
@@ -78,7 +160,27 @@ def main():
                 print(f"  {i+1}. {role}")
 
         elif args.cmd == "list-pending":
-            rows = list_pending_for_role(db_path, args.role)
+            from src.approval_system.service import iter_pending_for_role, list_pending_for_role
+            from src.approval_system.timestamps import to_iso
+            if args.counts:
+                from src.approval_system.service import get_pending_counts
+                counts = get_pending_counts(db_path)
+                if args.role:
+                    counts = {args.role: counts.get(args.role, 0)}
+                if args.format != "text":
+                    write_rows(({"role": r, "pending": n} for r, n in counts.items()), args.format)
+                    return
+                width = max(len(r) for r in counts)
+                for role, n in counts.items():
+                    print(f"{role:<{width}}  {n}")
+                return
+            if not args.role:
+                p.error("list-pending: a role is required unless --counts is given")
+            if args.format != "text":
+                rows = iter_pending_for_role(db_path, args.role, None, args.date_from, args.date_to)
+                write_rows(rows, args.format)
+                return
+            rows = list_pending_for_role(db_path, args.role, None, args.date_from, args.date_to)
             if not rows:
                 print(f"No pending letters for role: {args.role}")
             else:
@@ -87,11 +189,19 @@ def main():
                     print(f"\nID: {r['letter_id']}")
                     print(f"Title: {r['title']}")
                     print(f"From: {r['sender_name']}")
-                    print(f"Sent: {r['created_at']}")
+                    print(f"Sent: {to_iso(r['created_at'])}")
                     print(f"Step: {r['step_index'] + 1} of ?")
 
         elif args.cmd == "list-all":
-            rows = list_all_letters(db_path, args.user_id)
+            from src.approval_system.service import iter_letters, list_all_letters
+            from src.approval_system.timestamps import to_iso
+            if args.replica:
+                from src.approval_system.replica import ReplicaManager
+                db_path = (ReplicaManager.from_env(db_path) or ReplicaManager(db_path)).reader_path()
+            if args.format != "text":
+                write_rows(iter_letters(db_path, args.user_id, None, args.date_from, args.date_to), args.format)
+                return
+            rows = list_all_letters(db_path, args.user_id, None, args.date_from, args.date_to)
             if not rows:
                 print("No letters found")
             else:
@@ -101,9 +211,10 @@ def main():
                     print(f"Title: {r['title']}")
                     print(f"From: {r['sender_name']}")
                     print(f"Status: {r['status']}")
-                    print(f"Sent: {r['created_at']}")
+                    print(f"Sent: {to_iso(r['created_at'])}")
 
         elif args.cmd == "act":
+            from src.approval_system.service import act_on_letter
             out = act_on_letter(
                 db_path, 
                 args.letter_id, 
@@ -119,13 +230,15 @@ def main():
                 print(f"Next approver: {next_step['role']}")
 
         elif args.cmd == "show":
+            from src.approval_system.service import get_letter
+            from src.approval_system.timestamps import to_iso
             letter = get_letter(db_path, args.letter_id)
             print(f"\n📄 Letter ID: {letter['letter']['id']}")
             print(f"Title: {letter['letter']['title']}")
             print(f"From: {letter['letter']['sender_name']} ({letter['letter']['sender_role']})")
             print(f"Body: {letter['letter']['body']}")
             print(f"Status: {letter['letter']['status']}")
-            print(f"Sent: {letter['letter']['created_at']}")
+            print(f"Sent: {to_iso(letter['letter']['created_at'])}")
             print(f"\nApproval Steps:")
             for step in letter['steps']:
                 status_icon = "✅" if step['status'] == 'approved' else "❌" if step['status'] == 'rejected' else "⏳"
@@ -134,20 +247,53 @@ def main():
                 print(f"  {status_icon} Step {step['step_index'] + 1}: {step['role']}{actor}{comments}")
 
         elif args.cmd == "history":
+            from src.approval_system.service import get_letter_history
+            from src.approval_system.timestamps import to_iso
             history = get_letter_history(db_path, args.letter_id)
             print(f"\n📜 History for letter ID: {args.letter_id}")
             for entry in history:
                 status_icon = "✅" if entry['status'] == 'approved' else "❌" if entry['status'] == 'rejected' else "⏳"
                 actor = f" by {entry['actor_name']}" if entry['actor_name'] else ""
-                date = f" on {entry['acted_at']}" if entry['acted_at'] else ""
+                date = f" on {to_iso(entry['acted_at'])}" if entry['acted_at'] else ""
                 comments = f"\n      Comments: {entry['comments']}" if entry['comments'] else ""
                 print(f"\n  {status_icon} Step {entry['step_index'] + 1}: {entry['role']}{actor}{date}{comments}")
 
+        elif args.cmd == "archive":
+            from src.approval_system.service import archive_letters
+            moved = archive_letters(db_path, args.days, args.batch_size)
+            print(f"✅ Archived {moved} letter(s) older than {args.days} days")
+
+        elif args.cmd == "rebalance":
+            from src.approval_system.sharding import ShardedStorage
+            moved = ShardedStorage(args.shards, key=args.key).rebalance(args.batch_size)
+            for (src, dst), n in sorted(moved.items()):
+                print(f"  shard {src} -> {dst}: {n} letter(s)")
+            print(f"✅ Moved {sum(moved.values())} letter(s)")
+
+        elif args.cmd == "stats":
+            from src.approval_system.service import body_stats
+            stats = body_stats(db_path)
+            print(f"\n📦 Letter bodies")
+            print(f"Letters: {stats['references']}")
+            print(f"Stored bodies: {stats['bodies']}")
+            print(f"Dedup ratio: {stats['dedup_ratio']:.2f}x")
+            print(f"Text size: {stats['logical_bytes']} bytes")
+            print(f"Stored size: {stats['stored_bytes']} bytes ({stats['compression_ratio']:.2f}x)")
+
+        elif args.cmd == "batch":
+            from src.approval_system.batch import run_batch
+            src = sys.stdin if args.file == "-" else open(args.file, encoding="utf-8")
+            with src:
+                ok, failed = run_batch(db_path, src, sys.stdout, args.chunk_size)
+            print(f"{ok} succeeded, {failed} failed", file=sys.stderr)
+
         else:
             p.print_help()
 
     except Exception as e:
-        print(f"❌ Error: {e}")
+        # stderr, so errors never mix into NDJSON/TSV output on stdout
+        print(f"❌ Error: {e}", file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
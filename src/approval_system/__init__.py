@@ -1,21 +1,54 @@
-"""Approval system core package."""
-
-from .service import (
-    init_db,
-    create_user,
-    send_letter,
-    list_pending_for_role,
-    act_on_letter,
-    get_letter,
-    resend_letter,
-)
-
-__all__ = [
-    "init_db",
-    "create_user",
-    "send_letter",
-    "list_pending_for_role",
-    "act_on_letter",
-    "get_letter",
-    "resend_letter",
-]
+"""Approval system core package.
+
+Names are resolved on first use so that importing the package (or one
+function from it) does not load every submodule.
+"""
+
+_EXPORTS = {
+    "init_db": "service",
+    "create_user": "service",
+    "import_users": "service",
+    "send_letter": "service",
+    "list_pending_for_role": "service",
+    "list_all_letters": "service",
+    "iter_pending_for_role": "service",
+    "iter_letters": "service",
+    "list_letters_page": "service",
+    "list_pending_page": "service",
+    "get_pending_counts": "service",
+    "get_admin_overview": "service",
+    "find_users_by_name": "service",
+    "act_on_letter": "service",
+    "ConflictError": "service",
+    "get_letter": "service",
+    "get_letter_history": "service",
+    "get_letter_events": "service",
+    "resend_letter": "service",
+    "archive_letters": "service",
+    "body_stats": "service",
+    "ReplicaManager": "replica",
+    "JobQueue": "jobs",
+    "submit_job": "jobs",
+    "get_job": "jobs",
+    "Storage": "storage",
+    "SQLiteStorage": "storage",
+    "MemoryStorage": "storage",
+    "ShardedStorage": "sharding",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from importlib import import_module
+
+    value = getattr(import_module(f".{module}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
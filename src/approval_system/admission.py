@@ -0,0 +1,198 @@
+"""Admission control for the HTTP API.
+
+Two checks run before a request reaches the DB:
+
+* ``RateLimiter`` gives every client a token bucket. A client is its IP
+  address; the ``X-User-Id`` header is only believed on requests from a
+  trusted proxy (``APPROVAL_TRUSTED_PROXIES``), since anyone else could send
+  a fresh value per request or spend another user's budget. Reads and
+  writes have separate buckets, so a client polling ``/api/letters`` cannot
+  spend the budget its approvals need. An empty bucket means
+  ``429 Too Many Requests`` with ``Retry-After``.
+* ``ConcurrencyLimiter`` lets at most ``limit`` requests do DB work at once.
+  Up to ``max_queue`` more wait for a slot; beyond that, or after waiting
+  ``timeout`` seconds, requests get ``503 Service Unavailable``.
+
+``Admission.from_env()`` reads the limits from ``APPROVAL_*`` environment
+variables; ``Admission.stats()`` returns the counters for tuning. Call
+``Admission.bind()`` from the serving event loop's startup.
+"""
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+import asyncio
+import math
+import os
+import threading
+import time
+
+
+# Retry-After (seconds) sent with 503 when the queue is full
+SHED_RETRY_AFTER = 1
+
+
+class RateLimiter:
+    """Token buckets of ``burst`` tokens refilled at ``rate`` per second."""
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        # client -> (tokens, last refill); least recently seen first
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key: str, now: Optional[float] = None) -> float:
+        """Take a token for ``key``.
+
+        Returns 0 when the request is admitted, otherwise the seconds until a
+        token will be available.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class ConcurrencyLimiter:
+    """Bound the requests in flight, with a short bounded wait queue.
+
+    The slots are an ``asyncio.Semaphore``, which belongs to one event loop:
+    ``bind()`` creates them for the running loop. A limiter must not be
+    shared by loops running at the same time. An idle limiter used from a
+    new loop (each request of a ``TestClient`` outside ``with``, say) is
+    rebound; a busy one raises RuntimeError.
+    """
+
+    def __init__(self, limit: int, max_queue: int, timeout: float = 10.0) -> None:
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.peak_queued = 0
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def bind(self) -> None:
+        """Create the slots for the running event loop."""
+        if self.in_flight or self.queued:
+            raise RuntimeError("ConcurrencyLimiter is in use on another event loop")
+        self._slots = asyncio.Semaphore(self.limit)
+        self._loop = asyncio.get_running_loop()
+
+    async def acquire(self) -> bool:
+        """Wait for a slot; False when the queue is full or the wait timed out."""
+        if self._loop is not asyncio.get_running_loop():
+            self.bind()
+        if self._slots.locked():
+            if self.queued >= self.max_queue:
+                return False
+            self.queued += 1
+            self.peak_queued = max(self.peak_queued, self.queued)
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                self.queued -= 1
+        else:
+            await self._slots.acquire()
+        self.in_flight += 1
+        return True
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._slots.release()
+
+
+class Admission:
+    """Per-client read/write rate limits plus the global concurrency limit."""
+
+    def __init__(
+        self,
+        read_rate: float = 50,
+        read_burst: float = 100,
+        write_rate: float = 20,
+        write_burst: float = 40,
+        max_concurrency: int = 16,
+        max_queue: int = 64,
+        queue_timeout: float = 10.0,
+        enabled: bool = True,
+        trusted_proxies: Iterable[str] = (),
+    ) -> None:
+        self.enabled = enabled
+        self.trusted_proxies = frozenset(trusted_proxies)
+        self.reads = RateLimiter(read_rate, read_burst)
+        self.writes = RateLimiter(write_rate, write_burst)
+        self.slots = ConcurrencyLimiter(max_concurrency, max_queue, queue_timeout)
+        self.counters = {"admitted": 0, "rate_limited_read": 0, "rate_limited_write": 0, "shed": 0}
+
+    @classmethod
+    def from_env(cls) -> "Admission":
+        env = os.environ.get
+        return cls(
+            read_rate=float(env("APPROVAL_READ_RATE", "50")),
+            read_burst=float(env("APPROVAL_READ_BURST", "100")),
+            write_rate=float(env("APPROVAL_WRITE_RATE", "20")),
+            write_burst=float(env("APPROVAL_WRITE_BURST", "40")),
+            max_concurrency=int(env("APPROVAL_MAX_CONCURRENCY", "16")),
+            max_queue=int(env("APPROVAL_MAX_QUEUE", "64")),
+            queue_timeout=float(env("APPROVAL_QUEUE_TIMEOUT", "10")),
+            enabled=env("APPROVAL_ADMISSION", "1") != "0",
+            trusted_proxies=[h.strip() for h in env("APPROVAL_TRUSTED_PROXIES", "").split(",") if h.strip()],
+        )
+
+    def client_key(self, host: Optional[str], user_id: Optional[str]) -> str:
+        """Rate-limit key for a request from ``host`` claiming ``X-User-Id: user_id``."""
+        if user_id and host in self.trusted_proxies:
+            return f"user:{user_id}"
+        return host or "-"
+
+    def check_rate(self, client: str, write: bool) -> float:
+        """Charge ``client``'s read or write bucket; seconds to wait, or 0."""
+        wait = (self.writes if write else self.reads).acquire(client)
+        if wait:
+            self.counters["rate_limited_write" if write else "rate_limited_read"] += 1
+        return wait
+
+    async def enter(self, client: str, write: bool) -> Optional[Tuple[int, int]]:
+        """Admit a request, or return ``(status, retry_after)`` to reject it with.
+
+        Admitted requests must call ``leave()`` when done.
+        """
+        wait = self.check_rate(client, write)
+        if wait:
+            return 429, math.ceil(wait)
+        if not await self.slots.acquire():
+            self.counters["shed"] += 1
+            return 503, SHED_RETRY_AFTER
+        self.counters["admitted"] += 1
+        return None
+
+    def leave(self) -> None:
+        self.slots.release()
+
+    def bind(self) -> None:
+        """Tie the concurrency limit to the running event loop (see ``ConcurrencyLimiter``)."""
+        self.slots.bind()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "in_flight": self.slots.in_flight,
+            "queued": self.slots.queued,
+            "peak_queued": self.slots.peak_queued,
+            "clients": {"read": len(self.reads), "write": len(self.writes)},
+        }
@@ -0,0 +1,107 @@
+"""Run NDJSON command streams against one connection.
+
+Each input line is a JSON object naming an operation and its arguments::
+
+    {"op": "create-user", "name": "Ada", "role": "Student"}
+    {"op": "send", "sender_id": 1, "title": "Exit Request", "body": "..."}
+    {"op": "act", "letter_id": 1, "actor_id": 2, "action": "approve", "comments": "ok"}
+    {"op": "show", "letter_id": 1}
+    {"op": "history", "letter_id": 1}
+
+Every command gets one output line: ``{"line": n, "ok": true, "result": ...}``
+or ``{"line": n, "ok": false, "error": "..."}``, echoing the command's ``id``
+when it has one. Commands run in savepoints inside transactions of
+``chunk_size`` commands; results of a chunk are written once it commits.
+Timestamps in results are ISO-8601 text, as in the API and CLI.
+"""
+from typing import IO, Any, Dict, Iterable, Tuple
+import json
+
+from .db import attach_archive, get_conn, use_connection
+from .records import json_default
+from .service import (
+    act_on_letter,
+    create_user,
+    get_letter,
+    get_letter_history,
+    init_db,
+    send_letter,
+)
+from .timestamps import isoformat_fields
+
+# op -> (function, required arguments, optional arguments)
+OPERATIONS = {
+    "create-user": (create_user, ("name", "role"), ()),
+    "send": (send_letter, ("sender_id", "title", "body"), ("route",)),
+    "act": (
+        act_on_letter,
+        ("letter_id", "actor_id", "action"),
+        ("comments", "recommendations"),
+    ),
+    "show": (get_letter, ("letter_id",), ()),
+    "history": (get_letter_history, ("letter_id",), ()),
+}
+
+
+def _execute(db_path: str, command: Dict[str, Any]) -> Any:
+    if not isinstance(command, dict):
+        raise ValueError("Each line must be a JSON object")
+    op = command.get("op")
+    if op not in OPERATIONS:
+        raise ValueError(f"Unknown op: {op!r}. Valid ops: {', '.join(OPERATIONS)}")
+    func, required, optional = OPERATIONS[op]
+    missing = [name for name in required if name not in command]
+    if missing:
+        raise ValueError(f"Missing argument(s) for {op}: {', '.join(missing)}")
+    kwargs = {name: command[name] for name in required + optional if name in command}
+    return func(db_path, **kwargs)
+
+
+def run_batch(
+    db_path: str, lines: Iterable[str], out: IO[str], chunk_size: int = 500
+) -> Tuple[int, int]:
+    """Run every command in ``lines`` and write NDJSON results to ``out``.
+
+    Returns (succeeded, failed).
+    """
+    init_db(db_path)
+    conn = get_conn(db_path)
+    conn.isolation_level = None  # transactions are managed below
+    attach_archive(conn, db_path)
+    succeeded = failed = 0
+    results = []
+
+    def flush() -> None:
+        if conn.in_transaction:
+            conn.execute("COMMIT")
+        for result in results:
+            out.write(json.dumps(isoformat_fields(result), default=json_default) + "\n")
+        results.clear()
+
+    with use_connection(conn, db_path):
+        for lineno, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            result: Dict[str, Any] = {"line": lineno}
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            conn.execute("SAVEPOINT command")
+            try:
+                command = json.loads(line)
+                if isinstance(command, dict) and "id" in command:
+                    result["id"] = command["id"]
+                value = _execute(db_path, command)
+            except Exception as exc:
+                conn.execute("ROLLBACK TO command")
+                result.update(ok=False, error=str(exc))
+                failed += 1
+            else:
+                result.update(ok=True, result=value)
+                succeeded += 1
+            conn.execute("RELEASE command")
+            results.append(result)
+            if len(results) >= chunk_size:
+                flush()
+        flush()
+    conn.close()
+    return succeeded, failed
@@ -0,0 +1,104 @@
+"""Compression of letter bodies at rest.
+
+Bodies live in the ``letter_bodies`` table as ``(codec, data)`` pairs rather
+than inline in ``letters``, so listing queries read narrow rows. Bodies of
+``COMPRESS_MIN_BYTES`` or more are compressed with zstd when the
+``zstandard`` package is installed and with zlib otherwise. Shorter bodies,
+or ones that do not shrink, are stored as plain text (codec ``raw``).
+
+Every connection from ``db.get_conn`` has an ``unpack_body(codec, data)``
+SQL function, so a query decompresses a body only when it selects one.
+
+Identical bodies are stored once: each row carries the SHA-256 of its text
+in ``hash`` (unique) and the number of letters pointing at it in
+``refcount``. Rows whose count drops to zero are deleted.
+"""
+from typing import Any, Tuple
+import hashlib
+import zlib
+
+# Bodies shorter than this (UTF-8 bytes) are stored uncompressed
+COMPRESS_MIN_BYTES = 512
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+_zstd: Any = None
+
+
+def _zstandard():
+    """Return the ``zstandard`` module, or None when it is not installed."""
+    global _zstd
+    if _zstd is None:
+        try:
+            import zstandard as _zstd
+        except ImportError:
+            _zstd = False
+    return _zstd or None
+
+
+def pack(text: str) -> Tuple[str, Any]:
+    """Return the ``(codec, data)`` pair to store for ``text``."""
+    raw = text.encode("utf-8")
+    if len(raw) < COMPRESS_MIN_BYTES:
+        return "raw", text
+    zstd = _zstandard()
+    if zstd:
+        codec, data = "zstd", zstd.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    else:
+        codec, data = "zlib", zlib.compress(raw, ZLIB_LEVEL)
+    if len(data) >= len(raw):
+        return "raw", text
+    return codec, data
+
+
+def digest(text: str) -> bytes:
+    """Content hash that identifies a body in ``letter_bodies.hash``."""
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+def store(cur, text: str) -> int:
+    """Return the id of the ``letter_bodies`` row holding ``text``.
+
+    An existing row with the same content gains a reference; otherwise a
+    new row is written. Runs inside the caller's transaction.
+    """
+    key = digest(text)
+    cur.execute("SELECT id FROM letter_bodies WHERE hash = ?", (key,))
+    row = cur.fetchone()
+    if row:
+        cur.execute("UPDATE letter_bodies SET refcount = refcount + 1 WHERE id = ?", (row[0],))
+        return row[0]
+    # another connection may have stored the same body since the SELECT
+    cur.execute(
+        """INSERT INTO letter_bodies(hash, codec, data, refcount) VALUES(?, ?, ?, 1)
+           ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1
+           RETURNING id""",
+        (key, *pack(text)),
+    )
+    return cur.fetchone()[0]
+
+
+def release(cur, body_id: int) -> None:
+    """Drop one reference to ``body_id``, deleting the row when none remain."""
+    cur.execute("UPDATE letter_bodies SET refcount = refcount - 1 WHERE id = ?", (body_id,))
+    cur.execute("DELETE FROM letter_bodies WHERE id = ? AND refcount <= 0", (body_id,))
+
+
+def unpack(codec: str, data: Any) -> str:
+    """Inverse of ``pack``."""
+    if codec == "raw" or data is None:
+        return data
+    if codec == "zlib":
+        return zlib.decompress(data).decode("utf-8")
+    if codec == "zstd":
+        zstd = _zstandard()
+        if not zstd:
+            raise RuntimeError("zstandard is required to read zstd-compressed bodies")
+        return zstd.ZstdDecompressor().decompress(data).decode("utf-8")
+    raise ValueError(f"Unknown body codec: {codec!r}")
+
+
+def register(conn) -> None:
+    """Add the ``unpack_body(codec, data)`` SQL function to ``conn``."""
+    conn.create_function("unpack_body", 2, unpack, deterministic=True)
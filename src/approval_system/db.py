@@ -1,25 +1,595 @@
 """SQLite DB helpers for the approval system."""
-from typing import Iterator
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+import os
+import re
 import sqlite3
+import threading
+import time
 
+from . import bodies, roles
+from .records import record_factory
 
-def get_conn(path: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Statements slower than this (milliseconds) are logged with their query plan
+# while tracing is enabled.
+SLOW_QUERY_MS = float(os.environ.get("APPROVAL_SLOW_QUERY_MS", "50"))
 
+_trace_enabled = os.environ.get("APPROVAL_SQL_TRACE", "") not in ("", "0")
+_current_stats: ContextVar[Optional["QueryStats"]] = ContextVar(
+    "approval_query_stats", default=None
+)
 
-def init_db(path: str) -> None:
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_sql(sql: str) -> str:
+    """Collapse whitespace and replace literals so equal statements group together."""
+    return _SPACE_RE.sub(" ", _LITERAL_RE.sub("?", sql)).strip()
+
+
+class QueryStats:
+    """Query counts and timings aggregated by normalized SQL."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total_ms = 0.0
+        self.by_sql: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, sql: str) -> List[float]:
+        key = normalize_sql(sql)
+        entry = self.by_sql.get(key)
+        if entry is None:
+            entry = self.by_sql[key] = [0, 0.0]
+        return entry
+
+    def count_statement(self, sql: str) -> None:
+        with self._lock:
+            self.count += 1
+            self._entry(sql)[0] += 1
+
+    def add_time(self, sql: str, elapsed_ms: float) -> None:
+        with self._lock:
+            self.total_ms += elapsed_ms
+            self._entry(sql)[1] += elapsed_ms
+
+    def top(self, n: int = 10) -> List[Tuple[str, int, float]]:
+        """Return the ``n`` most frequent statements as (sql, count, total_ms)."""
+        rows = [(sql, int(c), ms) for sql, (c, ms) in self.by_sql.items()]
+        rows.sort(key=lambda r: (r[1], r[2]), reverse=True)
+        return rows[:n]
+
+    def report(self, n: int = 10) -> str:
+        lines = [f"{self.count} queries, {self.total_ms:.1f} ms"]
+        for sql, c, ms in self.top(n):
+            lines.append(f"  {c:>4}x {ms:8.2f} ms  {sql}")
+        return "\n".join(lines)
+
+
+global_stats = QueryStats()
+
+
+def enable_tracing(slow_query_ms: Optional[float] = None) -> None:
+    """Trace every connection opened by ``get_conn`` from now on."""
+    global _trace_enabled, SLOW_QUERY_MS
+    _trace_enabled = True
+    if slow_query_ms is not None:
+        SLOW_QUERY_MS = slow_query_ms
+
+
+def disable_tracing() -> None:
+    global _trace_enabled
+    _trace_enabled = False
+
+
+@contextmanager
+def track_queries() -> Iterator[QueryStats]:
+    """Count the statements run by ``get_conn`` connections inside the block."""
+    stats = QueryStats()
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+class _TracingCursor(sqlite3.Cursor):
+    """Cursor that times ``execute`` calls and logs slow statements."""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_time(self, sql, parameters, (time.perf_counter() - start) * 1000)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_time(self, sql, None, (time.perf_counter() - start) * 1000)
+
+
+class _TracingConnection(sqlite3.Connection):
+    _explaining = False
+
+    def cursor(self, factory=_TracingCursor):
+        return super().cursor(factory)
+
+
+def _record_time(cursor, sql: str, parameters, elapsed_ms: float) -> None:
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.add_time(sql, elapsed_ms)
+    if _trace_enabled:
+        global_stats.add_time(sql, elapsed_ms)
+        if elapsed_ms >= SLOW_QUERY_MS:
+            import logging  # only needed once something is slow
+
+            logging.getLogger("approval_system.sql").warning(
+                "slow query (%.1f ms): %s\n%s",
+                elapsed_ms,
+                normalize_sql(sql),
+                _explain(cursor.connection, sql, parameters),
+            )
+
+
+def _explain(conn: _TracingConnection, sql: str, parameters) -> str:
+    verb = sql.lstrip()[:6].upper()
+    if parameters is None or verb not in ("SELECT", "INSERT", "UPDATE", "DELETE"):
+        return "  (no plan)"
+    conn._explaining = True
+    try:
+        rows = sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    except sqlite3.Error as exc:
+        return f"  (plan unavailable: {exc})"
+    finally:
+        conn._explaining = False
+    return "\n".join(f"  {r[-1]}" for r in rows)
+
+
+def _trace_callback(conn: _TracingConnection):
+    def callback(statement: str) -> None:
+        if conn._explaining:
+            return
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.count_statement(statement)
+        if _trace_enabled:
+            global_stats.count_statement(statement)
+
+    return callback
+
+
+_borrowed = threading.local()
+
+
+class _SharedConnection:
+    """A connection lent out by ``use_connection``.
+
+    ``commit`` and ``close`` are no-ops: the owner decides when the
+    transaction ends and when the connection goes away.
+    """
+
+    __slots__ = ("_conn",)
+
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def commit(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+@contextmanager
+def use_connection(conn: sqlite3.Connection, path: str) -> Iterator[sqlite3.Connection]:
+    """Make ``get_conn(path)`` in this thread return ``conn`` inside the block."""
+    previous = getattr(_borrowed, "value", None)
+    _borrowed.value = (path, _SharedConnection(conn))
+    try:
+        yield conn
+    finally:
+        _borrowed.value = previous
+
+
+@contextmanager
+def transaction(path: str) -> Iterator[sqlite3.Connection]:
+    """Run the block, and service calls made in it, as one write transaction.
+
+    Inside ``use_connection`` for ``path`` (the write queue, batches) the
+    block joins the owner's transaction instead.
+    """
+    borrowed = getattr(_borrowed, "value", None)
+    if borrowed is not None and borrowed[0] == path:
+        yield borrowed[1]
+        return
     conn = get_conn(path)
-    cur = conn.cursor()
-    cur.executescript(
+    conn.isolation_level = None
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        with use_connection(conn, path):
+            yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    else:
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+
+def get_conn(path: str, traced: bool = False) -> sqlite3.Connection:
+    """Open ``path`` (or return the connection borrowed for it in this thread).
+
+    ``traced`` makes the connection report to ``track_queries`` blocks even
+    when it outlives the block it was opened in (the write queue's).
+    """
+    borrowed = getattr(_borrowed, "value", None)
+    if borrowed is not None and borrowed[0] == path:
+        return borrowed[1]
+    if traced or _trace_enabled or _current_stats.get() is not None:
+        conn = sqlite3.connect(
+            path, detect_types=sqlite3.PARSE_DECLTYPES, factory=_TracingConnection
+        )
+        conn.set_trace_callback(_trace_callback(conn))
+    else:
+        conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.row_factory = record_factory
+    bodies.register(conn)
+    roles.register(conn)
+    return conn
+
+
+class DataVersion:
+    """Cheap change detector for caches in front of the DB.
+
+    ``token()`` changes whenever any connection commits to the file, as
+    reported by ``PRAGMA data_version``, or when this process calls
+    ``bump()`` after its own writes. The pragma is re-read at most every
+    ``max_age`` seconds, which bounds how stale a cache can get while keeping
+    repeated reads free of DB round trips.
+    """
+
+    def __init__(self, path: str, max_age: float = 2.0) -> None:
+        self.max_age = max_age
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._checked = float("-inf")
+        self._version = 0
+        self._writes = 0
+
+    def bump(self) -> None:
+        with self._lock:
+            self._writes += 1
+
+    def token(self) -> Tuple[int, int]:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked >= self.max_age:
+                self._version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+                self._checked = now
+            return (self._version, self._writes)
+
+
+def archive_path_for(path: str) -> Optional[str]:
+    """Return the cold archive file that belongs to the DB at ``path``."""
+    if path == ":memory:" or path.startswith("file:"):
+        return None
+    root, ext = os.path.splitext(path)
+    return f"{root}.archive{ext or '.db'}"
+
+
+def attach_archive(conn: sqlite3.Connection, path: str, create: bool = False) -> bool:
+    """ATTACH the archive of ``path`` as schema ``archive``.
+
+    Returns False when there is no archive yet (and ``create`` is not set).
+    """
+    if any(r[1] == "archive" for r in conn.execute("PRAGMA database_list")):
+        return True
+    archive = archive_path_for(path)
+    if archive is None or not (create or os.path.exists(archive)):
+        return False
+    init_db(archive)  # archives are migrated along with their hot DB
+    conn.execute("ATTACH DATABASE ? AS archive", (archive,))
+    return True
+
+
+def table_columns(conn: sqlite3.Connection, table: str, schema: str = "main") -> List[str]:
+    return [r[1] for r in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def _rebuild_table(conn: sqlite3.Connection, table: str, create_sql: str, select_sql: str) -> None:
+    """Replace ``table`` with ``create_sql`` filled from ``select_sql``.
+
+    ``create_sql`` has a ``{name}`` placeholder for the table name and
+    ``select_sql`` reads from the old table. Indexes are recreated and the
+    AUTOINCREMENT counter is kept, so ids of deleted or archived rows are
+    never handed out again.
+    """
+    indexes = [
+        r[0]
+        for r in conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+            (table,),
+        )
+    ]
+    seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+    conn.execute(create_sql.format(name=f"{table}__new"))
+    conn.execute(f"INSERT INTO {table}__new {select_sql}")
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"ALTER TABLE {table}__new RENAME TO {table}")
+    for sql in indexes:
+        conn.execute(sql)
+    if seq is not None:
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = ?", (table,))
+        conn.execute("INSERT INTO sqlite_sequence(name, seq) VALUES(?, ?)", (table, seq[0]))
+
+
+def _split_letter_bodies(conn: sqlite3.Connection) -> None:
+    """Move ``letters.body`` into compressed ``letter_bodies`` rows."""
+    conn.execute(
+        """
+        CREATE TABLE letter_bodies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            codec TEXT NOT NULL DEFAULT 'raw',
+            data BLOB NOT NULL
+        )
+        """
+    )
+    # existing bodies take their letter's id, which is unique across the
+    # hot DB and its archive; new bodies are numbered after every letter id
+    rows = conn.execute("SELECT id, body FROM letters")
+    conn.executemany(
+        "INSERT INTO letter_bodies(id, codec, data) VALUES(?, ?, ?)",
+        ((row[0], *bodies.pack(row[1])) for row in rows),
+    )
+    conn.execute("DELETE FROM sqlite_sequence WHERE name = 'letter_bodies'")
+    conn.execute(
+        """INSERT INTO sqlite_sequence(name, seq)
+           SELECT 'letter_bodies', MAX(seq) FROM (
+               SELECT seq FROM sqlite_sequence WHERE name = 'letters'
+               UNION ALL SELECT COALESCE(MAX(id), 0) FROM letter_bodies)"""
+    )
+    _rebuild_table(
+        conn,
+        "letters",
+        """
+        CREATE TABLE {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            body_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at TEXT NOT NULL,
+            current_step INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(sender_id) REFERENCES users(id),
+            FOREIGN KEY(body_id) REFERENCES letter_bodies(id)
+        )
+        """,
+        "SELECT id, title, id, sender_id, status, created_at, current_step FROM letters",
+    )
+
+
+def _dedup_letter_bodies(conn: sqlite3.Connection) -> None:
+    """Hash bodies, merge identical ones and count their references."""
+    conn.create_function(
+        "body_digest", 2, lambda codec, data: bodies.digest(bodies.unpack(codec, data))
+    )
+    conn.execute("ALTER TABLE letter_bodies ADD COLUMN hash BLOB")
+    conn.execute("ALTER TABLE letter_bodies ADD COLUMN refcount INTEGER NOT NULL DEFAULT 0")
+    conn.execute("UPDATE letter_bodies SET hash = body_digest(codec, data)")
+    # point every letter at the lowest id holding its content
+    conn.execute("CREATE TEMP TABLE body_keep(id INTEGER PRIMARY KEY, keep INTEGER NOT NULL)")
+    conn.execute(
+        """INSERT INTO temp.body_keep(id, keep)
+           SELECT b.id, k.keep FROM letter_bodies b
+           JOIN (SELECT hash, MIN(id) AS keep FROM letter_bodies GROUP BY hash) k
+             ON k.hash = b.hash"""
+    )
+    conn.execute(
+        "UPDATE letters SET body_id = (SELECT keep FROM temp.body_keep WHERE id = letters.body_id)"
+    )
+    conn.execute("DELETE FROM temp.body_keep")
+    conn.execute(
+        "INSERT INTO temp.body_keep(id, keep) SELECT body_id, COUNT(*) FROM letters GROUP BY body_id"
+    )
+    conn.execute(
+        """UPDATE letter_bodies
+           SET refcount = COALESCE((SELECT keep FROM temp.body_keep WHERE id = letter_bodies.id), 0)"""
+    )
+    conn.execute("DROP TABLE temp.body_keep")
+    conn.execute("DELETE FROM letter_bodies WHERE refcount = 0")
+    conn.execute("CREATE UNIQUE INDEX idx_letter_bodies_hash ON letter_bodies(hash)")
+
+
+def _intern_roles(conn: sqlite3.Connection) -> None:
+    """Replace the role names on ``users`` and ``steps`` with ``roles`` ids."""
+    roles.seed(conn)
+    # names outside roles.ROLES (there should be none) are kept, numbered after them
+    conn.execute(
+        """INSERT OR IGNORE INTO roles(name)
+           SELECT role FROM users UNION SELECT role FROM steps ORDER BY 1"""
+    )
+    # rebuilt below on the new column
+    conn.execute("DROP INDEX IF EXISTS idx_users_name_role")
+    conn.execute("DROP INDEX IF EXISTS idx_steps_role")
+    _rebuild_table(
+        conn,
+        "users",
+        """
+        CREATE TABLE {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            role_id INTEGER NOT NULL REFERENCES roles(id)
+        )
+        """,
+        "SELECT u.id, u.name, r.id FROM users u JOIN roles r ON r.name = u.role",
+    )
+    _rebuild_table(
+        conn,
+        "steps",
+        """
+        CREATE TABLE {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            letter_id INTEGER NOT NULL,
+            step_index INTEGER NOT NULL,
+            role_id INTEGER NOT NULL REFERENCES roles(id),
+            status TEXT NOT NULL DEFAULT 'pending',
+            actor_id INTEGER,
+            comments TEXT,
+            acted_at TEXT,
+            version INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(letter_id) REFERENCES letters(id),
+            FOREIGN KEY(actor_id) REFERENCES users(id)
+        )
+        """,
+        """SELECT s.id, s.letter_id, s.step_index, r.id, s.status, s.actor_id,
+                  s.comments, s.acted_at, s.version
+           FROM steps s JOIN roles r ON r.name = s.role""",
+    )
+    conn.execute("CREATE INDEX idx_users_name_role ON users(name, role_id)")
+    conn.execute("CREATE INDEX idx_steps_role ON steps(role_id, status)")
+
+
+def _ms(column: str) -> str:
+    """SQL turning ISO text in ``column`` into epoch milliseconds (NULL stays NULL)."""
+    return (
+        f"CAST(strftime('%s', {column}) AS INTEGER) * 1000"
+        f" + CAST(substr(strftime('%f', {column}), 4) AS INTEGER)"
+    )
+
+
+# Timestamp columns _epoch_timestamps converts, by table
+_TEXT_TIMESTAMPS = {
+    "letters": ("created_at",),
+    "steps": ("acted_at",),
+    "letter_events": ("ts",),
+    "jobs": ("created_at", "started_at", "finished_at"),
+}
+
+
+def _epoch_timestamps(conn: sqlite3.Connection) -> None:
+    """Store ISO text timestamps as integer epoch milliseconds (see timestamps.py).
+
+    Raises ValueError, before changing anything, if a value is not a date
+    SQLite can read; such rows have to be fixed by hand first.
+    """
+    for table, columns in _TEXT_TIMESTAMPS.items():
+        for column in columns:
+            bad = conn.execute(
+                f"""SELECT {column} FROM {table}
+                    WHERE {column} IS NOT NULL AND strftime('%s', {column}) IS NULL LIMIT 1"""
+            ).fetchone()
+            if bad is not None:
+                raise ValueError(
+                    f"Cannot migrate {table}.{column}: {bad[0]!r} is not an ISO timestamp. "
+                    "Fix or remove the row and run init again"
+                )
+    _rebuild_table(
+        conn,
+        "letters",
+        """
+        CREATE TABLE {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            body_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at INTEGER NOT NULL,
+            current_step INTEGER NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(sender_id) REFERENCES users(id),
+            FOREIGN KEY(body_id) REFERENCES letter_bodies(id)
+        )
+        """,
+        f"""SELECT id, title, body_id, sender_id, status, {_ms('created_at')}, current_step, version
+            FROM letters""",
+    )
+    _rebuild_table(
+        conn,
+        "steps",
+        """
+        CREATE TABLE {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            letter_id INTEGER NOT NULL,
+            step_index INTEGER NOT NULL,
+            role_id INTEGER NOT NULL REFERENCES roles(id),
+            status TEXT NOT NULL DEFAULT 'pending',
+            actor_id INTEGER,
+            comments TEXT,
+            acted_at INTEGER,
+            version INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(letter_id) REFERENCES letters(id),
+            FOREIGN KEY(actor_id) REFERENCES users(id)
+        )
+        """,
+        f"""SELECT id, letter_id, step_index, role_id, status, actor_id, comments,
+                   {_ms('acted_at')}, version
+            FROM steps""",
+    )
+    _rebuild_table(
+        conn,
+        "letter_events",
+        """
+        CREATE TABLE {name} (
+            letter_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            actor_id INTEGER,
+            payload TEXT,
+            ts INTEGER NOT NULL,
+            PRIMARY KEY (letter_id, seq)
+        ) WITHOUT ROWID
+        """,
+        f"SELECT letter_id, seq, type, actor_id, payload, {_ms('ts')} FROM letter_events",
+    )
+    _rebuild_table(
+        conn,
+        "jobs",
+        """
+        CREATE TABLE {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            params TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress REAL NOT NULL DEFAULT 0,
+            result_path TEXT,
+            error TEXT,
+            created_at INTEGER NOT NULL,
+            started_at INTEGER,
+            finished_at INTEGER
+        )
+        """,
+        f"""SELECT id, kind, params, status, progress, result_path, error,
+                   {_ms('created_at')}, {_ms('started_at')}, {_ms('finished_at')}
+            FROM jobs""",
+    )
+    # date-range filters on letters use idx_letters_created; this gives
+    # step activity over a period the same range scan
+    conn.execute("CREATE INDEX idx_steps_acted ON steps(acted_at)")
+
+
+# Schema changes in order; entry N brings ``PRAGMA user_version`` from N to
+# N + 1. Each entry is a list of statements or a callable taking the connection.
+_MIGRATIONS: List = [
+    [
         """
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
             role TEXT NOT NULL
-        );
-
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS letters (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             title TEXT NOT NULL,
@@ -29,8 +599,9 @@ def init_db(path: str) -> None:
             created_at TEXT NOT NULL,
             current_step INTEGER NOT NULL DEFAULT 0,
             FOREIGN KEY(sender_id) REFERENCES users(id)
-        );
-
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS steps (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             letter_id INTEGER NOT NULL,
@@ -42,8 +613,160 @@ def init_db(path: str) -> None:
             acted_at TEXT,
             FOREIGN KEY(letter_id) REFERENCES letters(id),
             FOREIGN KEY(actor_id) REFERENCES users(id)
-        );
+        )
+        """,
+    ],
+    # act_on_letter and get_letter look steps up by letter; without this
+    # every action scanned the whole steps table.
+    ["CREATE UNIQUE INDEX IF NOT EXISTS idx_steps_letter ON steps(letter_id, step_index)"],
+    # paginated listings sort by date and filter by status / sender
+    [
+        "CREATE INDEX IF NOT EXISTS idx_letters_created ON letters(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_letters_status ON letters(status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_steps_role ON steps(role, status)",
+    ],
+    # case-insensitive user lookup by name
+    ["CREATE INDEX IF NOT EXISTS idx_users_name_nocase ON users(name COLLATE NOCASE)"],
+    # bodies move out of the letters rows and are compressed (see bodies.py)
+    _split_letter_bodies,
+    # identical bodies are stored once, with a reference count
+    _dedup_letter_bodies,
+    # responses of writes sent with an Idempotency-Key (see idempotency.py)
+    [
         """
-    )
-    conn.commit()
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            request_hash BLOB NOT NULL,
+            status INTEGER NOT NULL,
+            response BLOB NOT NULL,
+            expires_at INTEGER NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_idempotency_expiry ON idempotency_keys(expires_at)",
+    ],
+    # optimistic concurrency: transitions compare-and-swap on these
+    [
+        "ALTER TABLE letters ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE steps ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+    ],
+    # append-only history; backfilled with what the steps still remember
+    [
+        """CREATE TABLE IF NOT EXISTS letter_events (
+            letter_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            actor_id INTEGER,
+            payload TEXT,
+            ts TEXT NOT NULL,
+            PRIMARY KEY (letter_id, seq)
+        ) WITHOUT ROWID""",
+        """INSERT INTO letter_events(letter_id, seq, type, actor_id, payload, ts)
+           SELECT id, 1, 'sent', sender_id, json_object('title', title), created_at FROM letters""",
+        """INSERT INTO letter_events(letter_id, seq, type, actor_id, payload, ts)
+           SELECT s.letter_id,
+                  1 + ROW_NUMBER() OVER (PARTITION BY s.letter_id ORDER BY s.step_index),
+                  CASE s.status WHEN 'pending' THEN 'commented' ELSE s.status END,
+                  s.actor_id,
+                  json_object('step', s.step_index, 'role', s.role, 'comments', s.comments),
+                  COALESCE(s.acted_at, l.created_at)
+           FROM steps s JOIN letters l ON l.id = s.letter_id
+           WHERE s.status != 'pending' OR s.comments IS NOT NULL""",
+    ],
+    # letters a shard rebalance moved away, and their id on the new shard
+    [
+        """CREATE TABLE IF NOT EXISTS letter_relocations (
+            letter_id INTEGER PRIMARY KEY,
+            new_id INTEGER NOT NULL
+        )""",
+    ],
+    # background exports and reports (see jobs.py)
+    [
+        """CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            params TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress REAL NOT NULL DEFAULT 0,
+            result_path TEXT,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, id)",
+    ],
+    # duplicate checks in create_user and import_users
+    ["CREATE INDEX IF NOT EXISTS idx_users_name_role ON users(name, role)"],
+    # role names become ids into a roles table (see roles.py)
+    _intern_roles,
+    # timestamps become integer epoch milliseconds
+    _epoch_timestamps,
+    # idempotency key expiry in milliseconds like every other timestamp
+    ["UPDATE idempotency_keys SET expires_at = expires_at * 1000"],
+    # job leases: running jobs heartbeat, and stale ones are retried (see jobs.py)
+    [
+        "ALTER TABLE jobs ADD COLUMN heartbeat_at INTEGER",
+        "ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0",
+    ],
+]
+SCHEMA_VERSION = len(_MIGRATIONS)
+
+# (device, inode) -> (mtime, size) of DB files seen at SCHEMA_VERSION, least
+# recently used first. A file that changed since is checked again, so a new
+# file that reuses an inode is never taken for a migrated one.
+_current_files: "OrderedDict[Tuple[int, int], Tuple[int, int]]" = OrderedDict()
+_current_files_lock = threading.Lock()
+
+# Entries kept in _current_files; replica snapshots and archives add new inodes
+CURRENT_FILES_MAX = 256
+
+
+def _file_state(path: str) -> Optional[Tuple[Tuple[int, int], Tuple[int, int]]]:
+    """((device, inode), (mtime, size)) of ``path``, or None if not a plain file."""
+    if path == ":memory:" or path.startswith("file:"):
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if st.st_size == 0:  # fresh or recreated file, nothing to trust yet
+        return None
+    return (st.st_dev, st.st_ino), (st.st_mtime_ns, st.st_size)
+
+
+def init_db(path: str) -> None:
+    """Create or upgrade the schema; files unchanged since the last call are skipped."""
+    state = _file_state(path)
+    if state is not None:
+        with _current_files_lock:
+            if _current_files.get(state[0]) == state[1]:
+                _current_files.move_to_end(state[0])
+                return
+    conn = get_conn(path)
+    if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+        conn.isolation_level = None
+        conn.execute("BEGIN IMMEDIATE")
+        # re-read under the write lock in case another process just upgraded
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        try:
+            for migration in _MIGRATIONS[version:]:
+                if callable(migration):
+                    migration(conn)
+                else:
+                    for statement in migration:
+                        conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {max(version, SCHEMA_VERSION)}")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            conn.close()
+            raise
+        conn.execute("COMMIT")
+    roles.load(conn)
     conn.close()
+    state = _file_state(path)
+    if state is not None:
+        with _current_files_lock:
+            _current_files[state[0]] = state[1]
+            _current_files.move_to_end(state[0])
+            while len(_current_files) > CURRENT_FILES_MAX:
+                _current_files.popitem(last=False)
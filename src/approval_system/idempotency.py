@@ -0,0 +1,94 @@
+"""Exactly-once writes for retried requests.
+
+Clients that retry a write send the same ``Idempotency-Key`` each time. The
+first attempt runs and its response is stored in ``idempotency_keys``; later
+attempts with that key get the stored response back without running the
+write again::
+
+    status, body, replayed = run(db_path, key, fingerprint("/api/send", payload), attempt)
+
+``attempt`` returns ``(status, body_bytes)``. It runs in the same
+transaction that records the key, so two concurrent attempts cannot both
+write. Responses with status 400 or above are stored too, but whatever the
+attempt wrote before failing is rolled back. Exceptions are not stored:
+the transaction rolls back and the next retry runs again.
+
+Keys expire ``ttl`` seconds after they are recorded; ``expires_at`` holds
+epoch milliseconds like the other timestamps.
+"""
+from typing import Any, Callable, Optional, Tuple
+import hashlib
+import json
+
+from .db import get_conn, transaction
+from .timestamps import now_ms
+
+# Seconds a stored response is replayed for
+DEFAULT_TTL = 24 * 3600
+
+
+class IdempotencyKeyReused(ValueError):
+    """The key was already used for a different request."""
+
+
+def fingerprint(*parts: Any) -> bytes:
+    """Hash identifying a request (e.g. its path and payload)."""
+    encoded = json.dumps(parts, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).digest()
+
+
+def _stored(conn, key: str, request_hash: bytes, now: int) -> Optional[Tuple[int, bytes]]:
+    row = conn.execute(
+        """SELECT request_hash, status, response FROM idempotency_keys
+           WHERE key = ? AND expires_at > ?""",
+        (key, now),
+    ).fetchone()
+    if row is None:
+        return None
+    if row["request_hash"] != request_hash:
+        raise IdempotencyKeyReused(f"Idempotency-Key {key!r} was used for a different request")
+    return row["status"], row["response"]
+
+
+def lookup(db_path: str, key: str, request_hash: bytes) -> Optional[Tuple[int, bytes]]:
+    """Return the stored ``(status, body)`` for ``key``, or None."""
+    conn = get_conn(db_path)
+    try:
+        return _stored(conn, key, request_hash, now_ms())
+    finally:
+        conn.close()
+
+
+def run(
+    db_path: str,
+    key: str,
+    request_hash: bytes,
+    attempt: Callable[[], Tuple[int, bytes]],
+    ttl: int = DEFAULT_TTL,
+) -> Tuple[int, bytes, bool]:
+    """Run ``attempt`` unless ``key`` already has a response.
+
+    Returns ``(status, body, replayed)``.
+    """
+    now = now_ms()
+    with transaction(db_path) as conn:
+        stored = _stored(conn, key, request_hash, now)
+        if stored is not None:
+            return stored[0], stored[1], True
+        conn.execute("SAVEPOINT idempotent_attempt")
+        try:
+            status, body = attempt()
+        except BaseException:
+            conn.execute("ROLLBACK TO idempotent_attempt")
+            conn.execute("RELEASE idempotent_attempt")
+            raise
+        if status >= 400:
+            conn.execute("ROLLBACK TO idempotent_attempt")
+        conn.execute("RELEASE idempotent_attempt")
+        conn.execute("DELETE FROM idempotency_keys WHERE expires_at <= ?", (now,))
+        conn.execute(
+            """INSERT INTO idempotency_keys(key, request_hash, status, response, expires_at)
+               VALUES(?, ?, ?, ?, ?)""",
+            (key, request_hash, status, body, now + ttl * 1000),
+        )
+    return status, body, False
@@ -0,0 +1,402 @@
+"""Background jobs for exports and reports.
+
+Exports and rollups over all letters can take longer than a request should.
+They are queued as rows in the ``jobs`` table instead, and ``JobQueue``
+runs them in a process pool. Each job writes its result to a file in the
+results directory (``<db>.jobs/``)::
+
+    job_id = submit_job("approval.db", "export_letters", {"format": "csv"})
+    JobQueue("approval.db").start()      # in a long-running process
+    get_job("approval.db", job_id)       # status, progress, result_path
+
+Jobs move from ``queued`` to ``running`` to ``done`` or ``failed``.
+Claiming a job is a single UPDATE, so several processes may run queues on
+the same DB. A running job refreshes ``heartbeat_at`` while it works; one
+that stops for longer than its lease (``APPROVAL_JOB_LEASE`` seconds,
+default 300), because its process died, is queued again, or failed
+after ``MAX_ATTEMPTS`` tries. Jobs read from the reporting replica when one is configured
+(see ``replica.py``). Finished jobs and their result files are purged after
+``retention_days`` (``APPROVAL_JOB_RETENTION_DAYS``, default 7).
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Optional
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+
+from . import service
+from .db import get_conn
+from .records import Record, json_default
+from .replica import ReplicaManager
+from .timestamps import MS_PER_DAY, isoformat_fields, now_ms, to_iso, to_ms
+
+# Rows written between progress updates
+PROGRESS_EVERY = 1000
+
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+# Days finished jobs are kept, and seconds between purges in JobQueue
+RETENTION_DAYS = 7
+PURGE_EVERY = 3600
+
+# Seconds a running job may go without a heartbeat, and tries before it fails
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 3
+
+_log = logging.getLogger("approval_system.jobs")
+
+
+def results_dir_for(db_path: str) -> str:
+    """Return the directory holding job results for the DB at ``db_path``."""
+    root, _ = os.path.splitext(db_path)
+    return f"{root}.jobs"
+
+
+def _export_letters(source: str, params: Dict[str, Any], out, progress) -> None:
+    """Letters as CSV or NDJSON.
+
+    ``status``, ``user_id``, ``fields`` and ``date_from``/``date_to`` filter.
+    """
+    fmt = params.get("format", "csv")
+    status = params.get("status")
+    user_id = params.get("user_id")
+    total = None
+    if not user_id:
+        total = service.count_letters(source, status, params.get("date_from"), params.get("date_to"))
+    writer = None
+    written = 0
+    rows = service.iter_letters(
+        source, user_id, params.get("fields"), params.get("date_from"), params.get("date_to"), status
+    )
+    for row in rows:
+        row = isoformat_fields(row)
+        if fmt == "csv":
+            if writer is None:
+                writer = csv.writer(out)
+                writer.writerow(row.keys())
+            writer.writerow(row.values())
+        else:
+            out.write(json.dumps(row, default=json_default) + "\n")
+        written += 1
+        if total and written % PROGRESS_EVERY == 0:
+            progress(written / total)
+
+
+def _letter_rollup(source: str, params: Dict[str, Any], out, progress) -> None:
+    """Letters per day and status, plus the current pending counts, as JSON."""
+    by_day: Dict[tuple, int] = {}
+    for row in service.iter_letters(source, None, ["created_at", "status"]):
+        key = (to_iso(row["created_at"])[:10], row["status"])
+        by_day[key] = by_day.get(key, 0) + 1
+    json.dump(
+        {
+            "by_day": [
+                {"date": day, "status": status, "count": n}
+                for (day, status), n in sorted(by_day.items())
+            ],
+            "pending_by_role": service.get_pending_counts(source),
+        },
+        out,
+    )
+
+
+def _check_export(params: Dict[str, Any]) -> None:
+    if params.get("format", "csv") not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format. Use one of: {', '.join(EXPORT_FORMATS)}")
+    if params.get("fields"):
+        service.check_fields(params["fields"], service.LETTER_FIELDS)
+    for name in ("date_from", "date_to"):
+        to_ms(params.get(name))
+
+
+# kind -> (runner, params validator, result file extension)
+JOB_KINDS: Dict[str, tuple] = {
+    "export_letters": (_export_letters, _check_export, lambda p: p.get("format", "csv")),
+    "letter_rollup": (_letter_rollup, None, lambda p: "json"),
+}
+
+
+def submit_job(db_path: str, kind: str, params: Optional[Dict[str, Any]] = None) -> int:
+    """Queue a job and return its id."""
+    if kind not in JOB_KINDS:
+        raise ValueError(f"Unknown job kind: {kind}. Valid kinds: {', '.join(JOB_KINDS)}")
+    params = params or {}
+    check = JOB_KINDS[kind][1]
+    if check:
+        check(params)
+    conn = get_conn(db_path)
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO jobs(kind, params, created_at) VALUES(?, ?, ?)",
+        (kind, json.dumps(params), now_ms()),
+    )
+    conn.commit()
+    job_id = cur.lastrowid
+    conn.close()
+    return job_id
+
+
+def get_job(db_path: str, job_id: int) -> Optional[Record]:
+    """Return a job's row (``params`` decoded), or None."""
+    conn = get_conn(db_path)
+    row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    conn.close()
+    if row is None:
+        return None
+    return Record.from_dict({**row, "params": json.loads(row["params"])})
+
+
+def claim_job(db_path: str) -> Optional[int]:
+    """Mark the oldest queued job running and return its id, or None."""
+    now = now_ms()
+    conn = get_conn(db_path)
+    row = conn.execute(
+        """UPDATE jobs SET status = 'running', started_at = ?, heartbeat_at = ?,
+                           attempts = attempts + 1
+           WHERE id = (SELECT id FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1)
+           RETURNING id""",
+        (now, now),
+    ).fetchone()
+    conn.commit()
+    conn.close()
+    return row[0] if row else None
+
+
+def run_job(db_path: str, job_id: int, lease: float = LEASE_SECONDS) -> None:
+    """Run a claimed job to completion, recording the outcome in its row.
+
+    ``heartbeat_at`` is refreshed every third of ``lease`` meanwhile. If the
+    job was requeued after all (its lease ran out), the outcome is dropped.
+    """
+    job = get_job(db_path, job_id)
+    runner, _, extension = JOB_KINDS[job["kind"]]
+    replica = ReplicaManager.from_env(db_path)
+    source = replica.reader_path() if replica else db_path
+    results = results_dir_for(db_path)
+    os.makedirs(results, exist_ok=True)
+    path = os.path.join(results, f"job-{job_id}.{extension(job['params'])}")
+
+    def finish(**columns) -> None:
+        sets = ", ".join(f"{name} = ?" for name in columns)
+        conn = get_conn(db_path)
+        conn.execute(
+            f"""UPDATE jobs SET {sets}
+                WHERE id = ? AND status = 'running' AND attempts = ?""",
+            (*columns.values(), job_id, job["attempts"]),
+        )
+        conn.commit()
+        conn.close()
+
+    stop = threading.Event()
+
+    def heartbeat() -> None:
+        while not stop.wait(lease / 3):
+            try:
+                finish(heartbeat_at=now_ms())
+            except sqlite3.Error:
+                _log.exception("Heartbeat of job %s failed", job_id)
+
+    beat = threading.Thread(target=heartbeat, name=f"job-{job_id}-heartbeat", daemon=True)
+    beat.start()
+    try:
+        with open(path + ".part", "w", newline="", encoding="utf-8") as out:
+            runner(source, job["params"], out, lambda done: finish(progress=round(done, 3)))
+        os.replace(path + ".part", path)
+    except Exception as e:
+        if os.path.exists(path + ".part"):
+            os.remove(path + ".part")
+        finish(status="failed", error=str(e), finished_at=now_ms())
+        return
+    finally:
+        stop.set()
+        beat.join()
+    finish(status="done", progress=1.0, result_path=path, finished_at=now_ms())
+
+
+def purge_jobs(db_path: str, older_than_days: float = RETENTION_DAYS) -> int:
+    """Delete jobs finished more than ``older_than_days`` ago, and their result files.
+
+    Returns the number of jobs deleted.
+    """
+    cutoff = now_ms() - int(older_than_days * MS_PER_DAY)
+    conn = get_conn(db_path)
+    rows = conn.execute(
+        """DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?
+           RETURNING result_path""",
+        (cutoff,),
+    ).fetchall()
+    conn.commit()
+    conn.close()
+    for row in rows:
+        if row["result_path"] and os.path.exists(row["result_path"]):
+            os.remove(row["result_path"])
+    return len(rows)
+
+
+def requeue_stale_jobs(
+    db_path: str, lease: float = LEASE_SECONDS, max_attempts: int = MAX_ATTEMPTS
+) -> int:
+    """Queue again running jobs without a heartbeat for ``lease`` seconds.
+
+    A job that has already been tried ``max_attempts`` times is failed
+    instead. Returns the number of jobs changed.
+    """
+    now = now_ms()
+    conn = get_conn(db_path)
+    cur = conn.execute(
+        """UPDATE jobs SET
+               status = CASE WHEN attempts >= :max THEN 'failed' ELSE 'queued' END,
+               error = CASE WHEN attempts >= :max THEN 'lease expired' END,
+               finished_at = CASE WHEN attempts >= :max THEN :now END,
+               progress = 0
+           WHERE status = 'running' AND COALESCE(heartbeat_at, started_at) < :cutoff""",
+        {"max": max_attempts, "now": now, "cutoff": now - int(lease * 1000)},
+    )
+    conn.commit()
+    conn.close()
+    return cur.rowcount
+
+
+def _fail(db_path: str, job_id: int, error: str) -> None:
+    """Mark a job that is still ``running`` failed."""
+    conn = get_conn(db_path)
+    conn.execute(
+        """UPDATE jobs SET status = 'failed', error = ?, finished_at = ?
+           WHERE id = ? AND status = 'running'""",
+        (error, now_ms(), job_id),
+    )
+    conn.commit()
+    conn.close()
+
+
+def result_media_type(job) -> str:
+    """Content type of a finished job's result file."""
+    fmt = job["params"].get("format", "csv") if job["kind"] == "export_letters" else "json"
+    return EXPORT_FORMATS.get(fmt, "application/json")
+
+
+class JobQueue:
+    """Claim queued jobs and run up to ``workers`` of them at once in child processes.
+
+    ``wake()`` after submitting makes the dispatcher look right away; it
+    also polls every ``poll`` seconds for jobs queued by other processes,
+    purges jobs older than ``retention_days`` every ``PURGE_EVERY`` seconds
+    and requeues jobs whose ``lease`` ran out (see ``requeue_stale_jobs``)
+    every half lease. DB errors (a locked DB, say) are logged and the dispatcher
+    carries on.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        workers: int = 2,
+        poll: float = 1.0,
+        retention_days: float = RETENTION_DAYS,
+        lease: float = LEASE_SECONDS,
+    ) -> None:
+        self.db_path = db_path
+        self.workers = workers
+        self.poll = poll
+        self.retention_days = retention_days
+        self.lease = lease
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._slots = threading.Semaphore(workers)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls, db_path: str) -> "JobQueue":
+        return cls(
+            db_path,
+            workers=int(os.environ.get("APPROVAL_JOB_WORKERS", "2")),
+            retention_days=float(os.environ.get("APPROVAL_JOB_RETENTION_DAYS", str(RETENTION_DAYS))),
+            lease=float(os.environ.get("APPROVAL_JOB_LEASE", str(LEASE_SECONDS))),
+        )
+
+    def start(self) -> "JobQueue":
+        if self._thread is None:
+            # spawn: the parent runs threads, which fork does not copy safely
+            self._pool = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="job-dispatcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def stop(self) -> None:
+        """Stop claiming jobs and wait for running ones to finish."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            self._pool.shutdown()
+
+    def __enter__(self) -> "JobQueue":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def _run(self) -> None:
+        next_purge = next_requeue = 0.0
+        while not self._stop.is_set():
+            if time.monotonic() >= next_purge:
+                next_purge = time.monotonic() + PURGE_EVERY
+                try:
+                    purge_jobs(self.db_path, self.retention_days)
+                except (sqlite3.Error, OSError):
+                    _log.exception("Purging old jobs failed")
+            if time.monotonic() >= next_requeue:
+                next_requeue = time.monotonic() + self.lease / 2
+                try:
+                    if requeue_stale_jobs(self.db_path, self.lease):
+                        _log.warning("Requeued or failed jobs whose lease ran out")
+                except sqlite3.Error:
+                    _log.exception("Requeuing stale jobs failed")
+            self._slots.acquire()
+            try:
+                job_id = None if self._stop.is_set() else claim_job(self.db_path)
+            except sqlite3.Error:
+                _log.exception("Claiming a job failed")
+                job_id = None
+            if job_id is None:
+                self._slots.release()
+                self._wake.wait(self.poll)
+                self._wake.clear()
+                continue
+            try:
+                future = self._pool.submit(run_job, self.db_path, job_id, self.lease)
+            except Exception as e:
+                # a broken pool; fail the job rather than leave it running
+                _log.exception("Starting job %s failed", job_id)
+                self._slots.release()
+                self._try_fail(job_id, str(e))
+                continue
+            future.add_done_callback(self._done(job_id))
+
+    def _try_fail(self, job_id: int, error: str) -> None:
+        try:
+            _fail(self.db_path, job_id, error)
+        except sqlite3.Error:
+            _log.exception("Recording failure of job %s failed", job_id)
+
+    def _done(self, job_id: int) -> Callable[[Any], None]:
+        def callback(future) -> None:
+            self._slots.release()
+            self._wake.set()
+            if future.exception() is not None:
+                # the child died before it could record the failure itself
+                self._try_fail(job_id, str(future.exception()))
+
+        return callback
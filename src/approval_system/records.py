@@ -0,0 +1,108 @@
+"""Compact row objects returned by the service layer.
+
+``sqlite3.Row`` results used to be copied into a dict per row, which costs a
+hash table for every letter, step or user in a listing. ``Record`` keeps the
+tuple SQLite already produced and shares one field-name index between all
+rows of a query, so a row adds a single two-slot object on top of its values.
+
+Records are read-only mappings: ``row["title"]``, ``row.get("body")``,
+``dict(row)``, ``row.keys()`` and ``==`` against dicts all work as before.
+Integer indexes (``row[0]``) also work, as they did with ``sqlite3.Row``.
+When a query returns a column name twice, the name refers to the first such
+column (as with ``sqlite3.Row``) and the mapping holds each name once; the
+later columns are reachable by position only.
+"""
+from collections.abc import Mapping
+from functools import lru_cache
+from typing import Any, Dict, Tuple
+import json
+
+
+@lru_cache(maxsize=512)
+def fields_for(names: Tuple[str, ...]) -> Dict[str, int]:
+    """Return the shared name -> position index for a column list."""
+    fields: Dict[str, int] = {}
+    for i, name in enumerate(names):
+        fields.setdefault(name, i)
+    return fields
+
+
+class Record(Mapping):
+    """Read-only row backed by a tuple of values."""
+
+    __slots__ = ("_fields", "_values")
+
+    def __init__(self, fields: Dict[str, int], values: tuple) -> None:
+        self._fields = fields
+        self._values = values
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Record":
+        return cls(fields_for(tuple(data)), tuple(data.values()))
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._values[self._fields[key]]
+        return self._values[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self) -> int:
+        return len(self._fields)
+
+    def __repr__(self) -> str:
+        inner = ", ".join(f"{k}={v!r}" for k, v in self.to_dict().items())
+        return f"Record({inner})"
+
+    def __reduce__(self):
+        return (Record.from_dict, (self.to_dict(),))
+
+    def to_dict(self) -> Dict[str, Any]:
+        values = self._values
+        return {name: values[i] for name, i in self._fields.items()}
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), default=json_default)
+
+
+def json_default(obj: Any) -> Any:
+    """``default=`` hook for ``json.dumps`` that understands records."""
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+_orjson: Any = None
+
+
+def dumps(obj: Any) -> bytes:
+    """Encode ``obj`` as compact UTF-8 JSON, using orjson when it is installed."""
+    global _orjson
+    if _orjson is None:
+        try:
+            import orjson as _orjson
+        except ImportError:
+            _orjson = False
+    if _orjson:
+        return _orjson.dumps(obj, default=json_default)
+    return json.dumps(
+        obj, default=json_default, ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+_last_description: Tuple[Any, Dict[str, int]] = (None, {})
+
+
+def record_factory(cursor, values: tuple) -> Record:
+    """``sqlite3`` row factory producing ``Record`` objects."""
+    global _last_description
+    description, fields = _last_description
+    if cursor.description is not description:
+        description = cursor.description
+        fields = fields_for(tuple(d[0] for d in description))
+        _last_description = (description, fields)
+    return Record(fields, values)
@@ -0,0 +1,166 @@
+"""Read-only snapshot of the DB for reports and exports.
+
+Long reads (the Reports page, CSV exports, dashboard aggregates) hold a
+shared lock on ``approval.db`` while they run, which delays the approvals
+writing to it. ``ReplicaManager`` instead copies the DB every ``interval``
+seconds with ``sqlite3.Connection.backup``, ``pages`` at a time so writers
+get the lock back between steps, into a temporary file that then replaces
+``<db>.replica.db``. Readers that already have the old snapshot open keep
+reading it.
+
+``reader_path()`` is the routing switch: it names the replica while it is
+fresh enough and the primary DB otherwise, so callers can pass it as
+``db_path`` to any read-only service function. The replica's age, which is
+the staleness gauge, comes from its file time. Any process can therefore
+check it, not only the one doing the refreshing.
+
+Writes to the replica are not prevented but are lost at the next refresh.
+"""
+from typing import Any, Dict, Optional
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from .db import archive_path_for
+
+
+def replica_path_for(path: str) -> Optional[str]:
+    """Return the snapshot file that belongs to the DB at ``path``."""
+    if path == ":memory:" or path.startswith("file:"):
+        return None
+    root, ext = os.path.splitext(path)
+    return f"{root}.replica{ext or '.db'}"
+
+
+class ReplicaManager:
+    """Keep ``replica_path`` a recent copy of the DB at ``path``.
+
+    ``max_staleness`` (default: three intervals) is how old the replica may
+    get before ``reader_path()`` falls back to the primary.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        interval: float = 30.0,
+        pages: int = 256,
+        sleep: float = 0.005,
+        max_staleness: Optional[float] = None,
+        replica_path: Optional[str] = None,
+    ) -> None:
+        self.path = path
+        self.replica_path = replica_path or replica_path_for(path)
+        if self.replica_path is None:
+            raise ValueError(f"Cannot keep a replica of {path!r}")
+        self.interval = interval
+        self.pages = pages
+        self.sleep = sleep
+        self.max_staleness = 3 * interval if max_staleness is None else max_staleness
+        self.refreshes = 0
+        self.failures = 0
+        self.last_duration_ms: Optional[float] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls, path: str) -> Optional["ReplicaManager"]:
+        """A manager per ``APPROVAL_REPLICA_INTERVAL`` (seconds), or None when unset or 0."""
+        interval = float(os.environ.get("APPROVAL_REPLICA_INTERVAL", "0"))
+        if interval <= 0:
+            return None
+        return cls(path, interval=interval)
+
+    def refresh(self) -> None:
+        """Take a new snapshot now."""
+        started = time.time()
+        # The archive goes first: a letter archived between the two copies
+        # is then missing from the snapshot for one interval rather than
+        # listed twice.
+        archive = archive_path_for(self.path)
+        if archive and os.path.exists(archive):
+            self._copy(archive, archive_path_for(self.replica_path), started)
+        self._copy(self.path, self.replica_path, started)
+        self.refreshes += 1
+        self.last_duration_ms = (time.time() - started) * 1000
+
+    def _copy(self, src_path: str, dst_path: str, taken_at: float) -> None:
+        fd, tmp = tempfile.mkstemp(
+            prefix=os.path.basename(dst_path) + ".", dir=os.path.dirname(os.path.abspath(dst_path))
+        )
+        os.close(fd)
+        try:
+            src = sqlite3.connect(src_path)
+            dst = sqlite3.connect(tmp)
+            try:
+                src.backup(dst, pages=self.pages, sleep=self.sleep)
+                # a lone file: no -wal that could pair with the next snapshot
+                dst.execute("PRAGMA journal_mode = DELETE")
+            finally:
+                dst.close()
+                src.close()
+            # the file time records when the snapshot was taken
+            os.utime(tmp, (taken_at, taken_at))
+            os.replace(tmp, dst_path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def taken_at(self) -> Optional[float]:
+        """Epoch seconds when the current snapshot was taken; None when there is none."""
+        try:
+            return os.path.getmtime(self.replica_path)
+        except OSError:
+            return None
+
+    def staleness(self) -> Optional[float]:
+        """Seconds since the current snapshot was taken; None when there is none."""
+        taken_at = self.taken_at()
+        return None if taken_at is None else max(0.0, time.time() - taken_at)
+
+    def reader_path(self) -> str:
+        """The replica when it is at most ``max_staleness`` old, else the primary."""
+        age = self.staleness()
+        if age is None or age > self.max_staleness:
+            return self.path
+        return self.replica_path
+
+    def start(self) -> "ReplicaManager":
+        """Refresh now and then every ``interval`` seconds in a daemon thread."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="replica-refresh", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except (sqlite3.Error, OSError):
+                # keep serving the previous snapshot; reader_path() falls
+                # back to the primary once it is too old
+                self.failures += 1
+                logging.getLogger("approval_system.replica").exception("Replica refresh failed")
+            self._stop.wait(self.interval)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "replica_path": self.replica_path,
+            "staleness_s": self.staleness(),
+            "max_staleness_s": self.max_staleness,
+            "interval_s": self.interval,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "last_duration_ms": self.last_duration_ms,
+            "serving": "replica" if self.reader_path() == self.replica_path else "primary",
+        }
@@ -0,0 +1,59 @@
+"""Role names and their integer ids.
+
+``users`` and ``steps`` store a ``role_id``; the ``roles`` table maps ids to
+names. Ids of the roles below are fixed by their position, so every DB file
+(shards, archives, replicas) numbers them the same and rows can move between
+files as they are. New roles go at the end.
+
+Lookups use an in-process map instead of joining ``roles``. Every connection
+from ``db.get_conn`` has a ``role_name(role_id)`` SQL function for turning
+ids back into names in queries.
+"""
+from typing import Dict, Optional
+import sqlite3
+import sys
+
+ROLES = (
+    "SRC",
+    "Faculty",
+    "HOD",
+    "Dean",
+    "Students Affairs Officer",
+    "Dean of Student Affairs",
+    "Vice Chancellor",
+    "Faculty Association",
+    "Student",
+    "Staff",
+)
+
+_ids: Dict[str, int] = {sys.intern(name): i for i, name in enumerate(ROLES, 1)}
+_names: Dict[int, str] = {i: name for name, i in _ids.items()}
+
+
+def role_id(name: str) -> Optional[int]:
+    """Return the id of role ``name``, or None for an unknown role."""
+    return _ids.get(name)
+
+
+def role_name(role_id: Optional[int]) -> Optional[str]:
+    return _names.get(role_id)
+
+
+def seed(conn: sqlite3.Connection) -> None:
+    """Create the ``roles`` table holding ``ROLES``."""
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS roles (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)"
+    )
+    conn.executemany("INSERT OR IGNORE INTO roles(id, name) VALUES(?, ?)", enumerate(ROLES, 1))
+
+
+def load(conn: sqlite3.Connection) -> None:
+    """Add roles found only in this DB (from before roles were fixed) to the map."""
+    for row in conn.execute("SELECT id, name FROM roles WHERE id > ?", (len(ROLES),)):
+        rid, name = row[0], sys.intern(row[1])
+        _ids.setdefault(name, rid)
+        _names.setdefault(rid, name)
+
+
+def register(conn: sqlite3.Connection) -> None:
+    conn.create_function("role_name", 1, role_name, deterministic=True)
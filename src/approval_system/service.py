@@ -1,7 +1,19 @@
 """Core service functions for creating and routing letters."""
-from typing import List, Optional, Dict, Any, Tuple
-from datetime import datetime
-from .db import get_conn, init_db as db_init
+from typing import List, Optional, Dict, Any, Iterable, Iterator, Tuple, Union
+from collections.abc import Mapping
+from operator import itemgetter
+import csv
+import functools
+import itertools
+import json
+import os
+import random
+import time
+from . import bodies
+from .roles import ROLES, role_id
+from .timestamps import MS_PER_DAY, now_ms, to_iso, to_ms
+from .db import get_conn, init_db as db_init, attach_archive, table_columns, transaction
+from .records import Record
 
 DEFAULT_ROUTE = [
     "SRC",
@@ -13,14 +25,33 @@ DEFAULT_ROUTE = [
     "Vice Chancellor",
 ]
 
-VALID_ROLES = set(DEFAULT_ROUTE + ["Faculty Association", "Student", "SRC", "Staff"])
+VALID_ROLES = set(ROLES)
 
 
+def _storage_api(func):
+    """Let ``func`` take a storage backend in place of ``db_path``.
+
+    Anything that is not a path (see ``storage.MemoryStorage``) is handed the
+    call as a method of the same name.
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(db_path, *args, **kwargs):
+        if isinstance(db_path, (str, os.PathLike)):
+            return func(db_path, *args, **kwargs)
+        return getattr(db_path, name)(*args, **kwargs)
+
+    return wrapper
+
+
+@_storage_api
 def init_db(path: str) -> None:
     """Initialize database with tables."""
     db_init(path)
 
 
+@_storage_api
 def create_user(db_path: str, name: str, role: str) -> int:
     """Create a new user with given role."""
     if role not in VALID_ROLES:
@@ -30,19 +61,108 @@ def create_user(db_path: str, name: str, role: str) -> int:
     cur = conn.cursor()
     
     # Check if user already exists with same name and role
-    cur.execute("SELECT id FROM users WHERE name = ? AND role = ?", (name, role))
+    cur.execute("SELECT id FROM users WHERE name = ? AND role_id = ?", (name, role_id(role)))
     existing = cur.fetchone()
     if existing:
         conn.close()
         raise ValueError(f"User '{name}' with role '{role}' already exists")
     
-    cur.execute("INSERT INTO users(name, role) VALUES(?, ?)", (name, role))
+    cur.execute("INSERT INTO users(name, role_id) VALUES(?, ?)", (name, role_id(role)))
     conn.commit()
     uid = cur.lastrowid
     conn.close()
     return uid
 
 
+def _user_rows(source) -> Iterator[Tuple[int, Optional[str], Optional[str]]]:
+    """Yield (row number, name, role) from a CSV path, CSV lines or mappings."""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, newline="", encoding="utf-8") as f:
+            yield from _user_rows(f)
+        return
+    rows = iter(source)
+    first = next(rows, None)
+    if first is None:
+        return
+    rows = itertools.chain([first], rows)
+    records = rows if isinstance(first, Mapping) else csv.DictReader(rows)
+    for number, row in enumerate(records, 1):
+        name = (row.get("name") or "").strip()
+        role = (row.get("role") or "").strip()
+        yield number, name, role
+
+
+@_storage_api
+def import_users(
+    db_path: str,
+    source: Union[str, os.PathLike, Iterable],
+    chunk_size: int = 1000,
+) -> Dict[str, Any]:
+    """Create users in bulk from a CSV file with ``name`` and ``role`` columns.
+
+    ``source`` is a path, an iterable of CSV lines (header first) or of
+    mappings with ``name`` and ``role``. Rows are read as a stream and
+    checked a chunk at a time: roles against ``VALID_ROLES`` as a set,
+    duplicates with one join of the chunk against ``users``. Each chunk is
+    inserted in its own transaction.
+
+    Returns ``{"imported": n, "rejected": [{"row", "name", "role", "error"}]}``;
+    ``row`` counts data rows from 1. Rejected rows do not stop the import.
+    """
+    imported = 0
+    rejected: List[Dict[str, Any]] = []
+
+    def reject(number, name, role, error) -> None:
+        rejected.append({"row": number, "name": name, "role": role, "error": error})
+
+    rows = _user_rows(source)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        bad_roles = {role for _, _, role in chunk} - VALID_ROLES
+        staged, seen = [], set()
+        for number, name, role in chunk:
+            if not name or not role:
+                reject(number, name, role, "Missing name or role")
+            elif role in bad_roles:
+                reject(number, name, role, f"Invalid role: {role}")
+            elif (name, role) in seen:
+                reject(number, name, role, f"User '{name}' with role '{role}' already exists")
+            else:
+                seen.add((name, role))
+                staged.append((number, name, role))
+        if not staged:
+            continue
+        with transaction(db_path) as conn:
+            conn.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS user_import (seq INTEGER PRIMARY KEY, name TEXT, role_id INTEGER)"
+            )
+            conn.executemany(
+                "INSERT INTO temp.user_import(seq, name, role_id) VALUES(?, ?, ?)",
+                [(number, name, role_id(role)) for number, name, role in staged],
+            )
+            existing = {
+                r["seq"]
+                for r in conn.execute(
+                    """SELECT i.seq FROM temp.user_import i
+                       JOIN users u ON u.name = i.name AND u.role_id = i.role_id"""
+                )
+            }
+            new = []
+            for number, name, role in staged:
+                if number in existing:
+                    reject(number, name, role, f"User '{name}' with role '{role}' already exists")
+                else:
+                    new.append((name, role_id(role)))
+            conn.executemany("INSERT INTO users(name, role_id) VALUES(?, ?)", new)
+            conn.execute("DELETE FROM temp.user_import")
+        imported += len(new)
+    rejected.sort(key=lambda r: r["row"])
+    return {"imported": imported, "rejected": rejected}
+
+
+@_storage_api
 def send_letter(
     db_path: str, 
     sender_id: int, 
@@ -54,7 +174,7 @@ def send_letter(
     # Validate sender exists and has correct role
     conn = get_conn(db_path)
     cur = conn.cursor()
-    cur.execute("SELECT role FROM users WHERE id = ?", (sender_id,))
+    cur.execute("SELECT role_name(role_id) AS role FROM users WHERE id = ?", (sender_id,))
     sender = cur.fetchone()
     if not sender:
         conn.close()
@@ -65,111 +185,484 @@ def send_letter(
         raise ValueError(f"Invalid sender role: {sender['role']}")
     
     route = route or DEFAULT_ROUTE
-    now = datetime.utcnow().isoformat()
+    route_ids = [role_id(role) for role in route]
+    if None in route_ids:
+        conn.close()
+        raise ValueError(f"Invalid role in route: {route[route_ids.index(None)]}")
+    now = now_ms()
     
+    body_id = bodies.store(cur, body)
     cur.execute(
-        """INSERT INTO letters(title, body, sender_id, created_at, status, current_step) 
+        """INSERT INTO letters(title, body_id, sender_id, created_at, status, current_step) 
            VALUES(?, ?, ?, ?, 'pending', 0)""",
-        (title, body, sender_id, now),
+        (title, body_id, sender_id, now),
     )
     lid = cur.lastrowid
     
-    for idx, role in enumerate(route):
-        cur.execute(
-            "INSERT INTO steps(letter_id, step_index, role) VALUES(?, ?, ?)", 
-            (lid, idx, role)
-        )
+    # one multi-row INSERT rather than a statement per step
+    cur.execute(
+        "INSERT INTO steps(letter_id, step_index, role_id) VALUES "
+        + ", ".join(["(?, ?, ?)"] * len(route)),
+        [v for idx, rid in enumerate(route_ids) for v in (lid, idx, rid)],
+    )
+    _log_event(cur, lid, "sent", sender_id, {"title": title}, now, first=True)
     
     conn.commit()
     conn.close()
     return lid
 
 
+def _log_event(cur, letter_id: int, type: str, actor_id, payload, ts: int, first=False) -> None:
+    """Append an event to ``letter_id``'s log inside the caller's transaction.
+
+    ``first`` skips looking up the last ``seq`` for a letter just created.
+    """
+    payload = json.dumps(payload) if payload is not None else None
+    if first:
+        cur.execute(
+            "INSERT INTO letter_events(letter_id, seq, type, actor_id, payload, ts) VALUES(?, 1, ?, ?, ?, ?)",
+            (letter_id, type, actor_id, payload, ts),
+        )
+        return
+    cur.execute(
+        """INSERT INTO letter_events(letter_id, seq, type, actor_id, payload, ts)
+           SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ?, ? FROM letter_events WHERE letter_id = ?""",
+        (letter_id, type, actor_id, payload, ts, letter_id),
+    )
+
+
+def _step_event(step, comments: str) -> Dict[str, Any]:
+    return {"step": step["step_index"], "role": step["role"], "comments": comments}
+
+
+# steps rows as callers see them, with the role by name
+_STEP_COLUMNS = """s.id, s.letter_id, s.step_index, role_name(s.role_id) AS role, s.status,
+    s.actor_id, s.comments, s.acted_at, s.version"""
+
+
 def _get_step(conn, letter_id: int, step_index: int):
     """Get a specific step for a letter."""
     cur = conn.cursor()
     cur.execute(
-        "SELECT * FROM steps WHERE letter_id=? AND step_index=?", 
+        f"SELECT {_STEP_COLUMNS}, s.role_id FROM steps s WHERE letter_id=? AND step_index=?",
         (letter_id, step_index)
     )
     return cur.fetchone()
 
 
-def list_pending_for_role(db_path: str, role: str) -> List[Dict[str, Any]]:
-    """List all pending letters for a specific role."""
+# Rows fetched per round trip by the iter_* functions.
+FETCH_SIZE = 500
+
+
+def _iter_rows(conn, cur) -> Iterator[Dict[str, Any]]:
+    """Yield ``cur``'s rows, ``FETCH_SIZE`` at a time, then close ``conn``."""
+    try:
+        while True:
+            rows = cur.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+
+# Fields the list functions can return, with the SQL that selects each one.
+# Bodies are joined from letter_bodies (alias b) and only decompressed when
+# "body" is selected.
+_BODY = "unpack_body(b.codec, b.data)"
+
+LETTER_FIELDS = {
+    "id": "l.id",
+    "title": "l.title",
+    "body": _BODY,
+    "sender_id": "l.sender_id",
+    "status": "l.status",
+    "created_at": "l.created_at",
+    "current_step": "l.current_step",
+    "version": "l.version",
+    "sender_name": "u.name",
+}
+
+PENDING_FIELDS = {
+    "id": "s.id",
+    "letter_id": "s.letter_id",
+    "step_index": "s.step_index",
+    "role": "role_name(s.role_id)",
+    "status": "s.status",
+    "actor_id": "s.actor_id",
+    "comments": "s.comments",
+    "acted_at": "s.acted_at",
+    "version": "s.version",
+    "title": "l.title",
+    "body": _BODY,
+    "sender_id": "l.sender_id",
+    "created_at": "l.created_at",
+    "letter_status": "l.status",
+    "sender_name": "u.name",
+}
+
+
+def check_fields(fields: List[str], available: Dict[str, str]) -> List[str]:
+    """Validate a ``fields=`` projection and return it without duplicates."""
+    unknown = [f for f in fields if f not in available]
+    if unknown:
+        raise ValueError(
+            f"Unknown field(s): {', '.join(unknown)}. Valid fields: {', '.join(available)}"
+        )
+    return list(dict.fromkeys(fields))
+
+
+def _projection(fields: Optional[List[str]], available: Dict[str, str]) -> str:
+    """SELECT list for ``fields``; every available field when none are given."""
+    fields = check_fields(fields, available) if fields else available
+    return ", ".join(f"{available[f]} AS {f}" for f in fields)
+
+
+def _created_between(date_from, date_to) -> Tuple[List[str], List[int]]:
+    """WHERE conditions (and params) keeping letters created in [from, to).
+
+    Bounds are epoch ms ints or ISO dates/datetimes (see ``timestamps.to_ms``).
+    """
+    where, params = [], []
+    if date_from is not None:
+        where.append("l.created_at >= ?")
+        params.append(to_ms(date_from))
+    if date_to is not None:
+        where.append("l.created_at < ?")
+        params.append(to_ms(date_to))
+    return where, params
+
+
+@_storage_api
+def list_pending_for_role(
+    db_path: str,
+    role: str,
+    fields: Optional[List[str]] = None,
+    date_from: Optional[Union[int, str]] = None,
+    date_to: Optional[Union[int, str]] = None,
+) -> List[Dict[str, Any]]:
+    """List all pending letters for a specific role.
+
+    ``fields`` limits the columns returned (see ``PENDING_FIELDS``);
+    ``date_from``/``date_to`` keep letters created in [from, to).
+    """
+    return list(iter_pending_for_role(db_path, role, fields, date_from, date_to))
+
+
+@_storage_api
+def iter_pending_for_role(
+    db_path: str,
+    role: str,
+    fields: Optional[List[str]] = None,
+    date_from: Optional[Union[int, str]] = None,
+    date_to: Optional[Union[int, str]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """Yield pending letters for a role without loading them all at once.
+
+    The connection stays open until the iterator is exhausted or closed.
+    """
+    columns = _projection(fields, PENDING_FIELDS)
+    where, params = _created_between(date_from, date_to)
     conn = get_conn(db_path)
     cur = conn.cursor()
     cur.execute(
-        """
-        SELECT 
-            s.*, 
-            l.title, 
-            l.body, 
-            l.sender_id, 
-            l.created_at, 
-            l.status as letter_status,
-            u.name as sender_name
+        f"""
+        SELECT {columns}
         FROM steps s
         JOIN letters l ON l.id = s.letter_id
         JOIN users u ON u.id = l.sender_id
-        WHERE s.role = ? AND s.status = 'pending' AND l.status = 'pending'
-        ORDER BY l.created_at
+        LEFT JOIN letter_bodies b ON b.id = l.body_id
+        WHERE s.role_id = ? AND s.status = 'pending' AND l.status = 'pending'
+              {"".join(f" AND {w}" for w in where)}
+        ORDER BY l.created_at, s.id
         """,
-        (role,),
+        [role_id(role), *params],
     )
-    rows = cur.fetchall()
-    conn.close()
-    return [dict(r) for r in rows]
+    return _iter_rows(conn, cur)
+
 
+@_storage_api
+def list_all_letters(
+    db_path: str,
+    user_id: Optional[int] = None,
+    fields: Optional[List[str]] = None,
+    date_from: Optional[Union[int, str]] = None,
+    date_to: Optional[Union[int, str]] = None,
+    status: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """List all letters (sent/received) for a user.
 
-def list_all_letters(db_path: str, user_id: Optional[int] = None) -> List[Dict[str, Any]]:
-    """List all letters (sent/received) for a user."""
+    ``fields`` limits the columns returned (see ``LETTER_FIELDS``);
+    ``date_from``/``date_to`` keep letters created in [from, to) and
+    ``status`` those with that status.
+    """
+    return list(iter_letters(db_path, user_id, fields, date_from, date_to, status))
+
+
+@_storage_api
+def iter_letters(
+    db_path: str,
+    user_id: Optional[int] = None,
+    fields: Optional[List[str]] = None,
+    date_from: Optional[Union[int, str]] = None,
+    date_to: Optional[Union[int, str]] = None,
+    status: Optional[str] = None,
+) -> Iterator[Dict[str, Any]]:
+    """Yield letters like ``list_all_letters`` without loading them all at once.
+
+    The connection stays open until the iterator is exhausted or closed.
+    """
+    columns = _projection(fields, LETTER_FIELDS)
+    where, params = _created_between(date_from, date_to)
+    if status:
+        where.append("l.status = ?")
+        params.append(status)
     conn = get_conn(db_path)
     cur = conn.cursor()
+    letters, steps, letter_bodies = _read_through(conn, db_path)
     
     if user_id:
         # Get letters sent by user or where user is an approver
-        cur.execute(
-            """
-            SELECT DISTINCT l.*, u.name as sender_name
-            FROM letters l
-            JOIN users u ON u.id = l.sender_id
-            LEFT JOIN steps s ON s.letter_id = l.id
-            WHERE l.sender_id = ? OR s.actor_id = ?
-            ORDER BY l.created_at DESC
-            """,
-            (user_id, user_id),
+        where.insert(
+            0,
+            f"(l.sender_id = ? OR l.id IN (SELECT letter_id FROM {steps} WHERE actor_id = ?))",
         )
-    else:
-        # Get all letters
+        params[:0] = [user_id, user_id]
+    clause = f"WHERE {' AND '.join(where)}" if where else ""
+    cur.execute(
+        f"""
+        SELECT {columns}
+        FROM {letters} l
+        JOIN users u ON u.id = l.sender_id
+        LEFT JOIN {letter_bodies} b ON b.id = l.body_id
+        {clause}
+        ORDER BY l.created_at DESC, l.id DESC
+        """,
+        params,
+    )
+    return _iter_rows(conn, cur)
+
+
+def count_letters(
+    db_path: str,
+    status: Optional[str] = None,
+    date_from: Optional[Union[int, str]] = None,
+    date_to: Optional[Union[int, str]] = None,
+) -> int:
+    """Count the letters ``iter_letters`` would yield for these filters (no user)."""
+    where, params = _created_between(date_from, date_to)
+    if status:
+        where.append("l.status = ?")
+        params.append(status)
+    conn = get_conn(db_path)
+    letters, _, _ = _read_through(conn, db_path)
+    clause = f"WHERE {' AND '.join(where)}" if where else ""
+    total = conn.execute(f"SELECT COUNT(*) FROM {letters} l {clause}", params).fetchone()[0]
+    conn.close()
+    return total
+
+
+# Columns for listing pages; bodies are loaded per letter with get_letter.
+_SUMMARY_COLUMNS = "l.id, l.title, l.sender_id, l.status, l.created_at, l.current_step"
+
+
+@_storage_api
+def list_letters_page(
+    db_path: str,
+    status: Optional[str] = None,
+    sender: Optional[str] = None,
+    date_from: Optional[Union[int, str]] = None,
+    date_to: Optional[Union[int, str]] = None,
+    search: Optional[str] = None,
+    limit: int = 25,
+    offset: int = 0,
+) -> Tuple[List[Dict[str, Any]], int]:
+    """Return one page of letter summaries (no bodies) and the total match count.
+
+    Filters run in SQL: ``status`` exact, ``sender`` a substring of the
+    sender's name, ``date_from``/``date_to`` bounding ``created_at`` as
+    [from, to) (epoch ms ints or ISO dates), and ``search`` a substring of the
+    title or body.
+    """
+    conn = get_conn(db_path)
+    cur = conn.cursor()
+    letters, _, letter_bodies = _read_through(conn, db_path)
+    where, params = _created_between(date_from or None, date_to or None)
+    if status:
+        where.append("l.status = ?")
+        params.append(status)
+    if sender:
+        where.append("u.name LIKE ?")
+        params.append(f"%{sender}%")
+    if search:
+        # last, so the cheaper filters go first. A body is read only when
+        # the title does not match, and only compressed ones are unpacked.
+        where.append(
+            f"""CASE WHEN l.title LIKE ? THEN 1 ELSE (
+                    SELECT CASE b.codec WHEN 'raw' THEN b.data ELSE {_BODY} END
+                    FROM {letter_bodies} b WHERE b.id = l.body_id
+                ) LIKE ? END"""
+        )
+        params.extend([f"%{search}%"] * 2)
+    clause = f"WHERE {' AND '.join(where)}" if where else ""
+    source = f"FROM {letters} l JOIN users u ON u.id = l.sender_id {clause}"
+
+    cur.execute(f"SELECT COUNT(*) AS c {source}", params)
+    total = cur.fetchone()["c"]
+    cur.execute(
+        f"""SELECT {_SUMMARY_COLUMNS}, u.name AS sender_name {source}
+            ORDER BY l.created_at DESC, l.id DESC LIMIT ? OFFSET ?""",
+        params + [limit, offset],
+    )
+    rows = cur.fetchall()
+    conn.close()
+    return rows, total
+
+
+@_storage_api
+def list_pending_page(
+    db_path: str, role: str, limit: int = 25, offset: int = 0
+) -> Tuple[List[Dict[str, Any]], int]:
+    """Return one page of a role's inbox (no bodies) and the inbox size."""
+    conn = get_conn(db_path)
+    cur = conn.cursor()
+    source = """
+        FROM steps s
+        JOIN letters l ON l.id = s.letter_id
+        JOIN users u ON u.id = l.sender_id
+        WHERE s.role_id = ? AND s.status = 'pending' AND l.status = 'pending'
+        """
+    cur.execute(f"SELECT COUNT(*) AS c {source}", (role_id(role),))
+    total = cur.fetchone()["c"]
+    cur.execute(
+        f"""SELECT s.letter_id, s.step_index, l.title, l.sender_id, l.created_at,
+                   u.name AS sender_name {source}
+            ORDER BY l.created_at, s.id LIMIT ? OFFSET ?""",
+        (role_id(role), limit, offset),
+    )
+    rows = cur.fetchall()
+    conn.close()
+    return rows, total
+
+
+@_storage_api
+def get_admin_overview(db_path: str, recent: int = 10) -> Dict[str, Any]:
+    """Return dashboard figures without loading the letters table.
+
+    ``counts`` maps status to letter count (archived letters included),
+    ``pending_by_role`` maps role to the size of its inbox and ``recent``
+    holds the ``recent`` newest letter summaries.
+    """
+    conn = get_conn(db_path)
+    cur = conn.cursor()
+    schemas = ["main"]
+    if attach_archive(conn, db_path):
+        schemas.append("archive")
+
+    counts: Dict[str, int] = {}
+    latest = []
+    for schema in schemas:
+        cur.execute(f"SELECT status, COUNT(*) AS c FROM {schema}.letters GROUP BY status")
+        for row in cur.fetchall():
+            counts[row["status"]] = counts.get(row["status"], 0) + row["c"]
         cur.execute(
-            """
-            SELECT l.*, u.name as sender_name
-            FROM letters l
-            JOIN users u ON u.id = l.sender_id
-            ORDER BY l.created_at DESC
-            """
+            f"""SELECT {_SUMMARY_COLUMNS}, u.name AS sender_name
+                FROM {schema}.letters l JOIN users u ON u.id = l.sender_id
+                ORDER BY l.created_at DESC, l.id DESC LIMIT ?""",
+            (recent,),
         )
-    
+        latest.extend(cur.fetchall())
+    latest.sort(key=itemgetter("created_at", "id"), reverse=True)
+
+    pending_by_role = _pending_counts(cur)
+    conn.close()
+    return {
+        "counts": counts,
+        "total": sum(counts.values()),
+        "pending_by_role": pending_by_role,
+        "recent": latest[:recent],
+    }
+
+
+def _pending_counts(cur) -> Dict[str, int]:
+    """Inbox size per role, for roles that have any pending steps."""
+    cur.execute(
+        """SELECT role_name(s.role_id) AS role, COUNT(*) AS c
+           FROM steps s
+           JOIN letters l ON l.id = s.letter_id
+           JOIN users u ON u.id = l.sender_id
+           WHERE s.status = 'pending' AND l.status = 'pending'
+           GROUP BY s.role_id"""
+    )
+    return {row["role"]: row["c"] for row in cur.fetchall()}
+
+
+@_storage_api
+def get_pending_counts(db_path: str) -> Dict[str, int]:
+    """Return ``len(list_pending_for_role(role))`` for every role, from one grouped query.
+
+    Every role in ``VALID_ROLES`` is present, with 0 when its inbox is empty.
+    """
+    conn = get_conn(db_path)
+    counts = _pending_counts(conn.cursor())
+    conn.close()
+    return {role: counts.get(role, 0) for role in sorted(VALID_ROLES | set(counts))}
+
+
+def find_users_by_name(db_path: str, name: str) -> List[Dict[str, Any]]:
+    """Return users whose name matches ``name`` ignoring case."""
+    conn = get_conn(db_path)
+    cur = conn.cursor()
+    cur.execute(
+        """SELECT id, name, role_name(role_id) AS role FROM users
+           WHERE name = ? COLLATE NOCASE ORDER BY role, id""",
+        (name,),
+    )
     rows = cur.fetchall()
     conn.close()
-    return [dict(r) for r in rows]
+    return rows
+
 
+class ConflictError(ValueError):
+    """Another transition changed the letter between our read and our write."""
 
+
+# Pause before retry N of a conflicted transition is up to N times this (seconds)
+CONFLICT_BACKOFF = 0.005
+
+
+@_storage_api
 def act_on_letter(
     db_path: str, 
     letter_id: int, 
     actor_id: int, 
     action: str, 
     comments: Optional[str] = None,
-    recommendations: Optional[str] = None
+    recommendations: Optional[str] = None,
+    retries: int = 0,
 ) -> Dict[str, Any]:
     """Actor approves, rejects or merely comments on a pending step.
     
     action: 'approve', 'reject', or 'comment'
     comments: Optional comments on the decision
     recommendations: Optional recommendations for improvement
+    retries: How often to re-read and retry after a ConflictError
+
+    Transitions are compare-and-swap on the step and letter ``version``
+    columns, so of two concurrent actions on one step only the first is
+    applied; the other raises ``ConflictError`` (or, retried, sees the step
+    already acted on).
     """
+    for attempt in range(retries + 1):
+        try:
+            return _act_once(db_path, letter_id, actor_id, action, comments, recommendations)
+        except ConflictError:
+            if attempt == retries:
+                raise
+            time.sleep(random.uniform(0, CONFLICT_BACKOFF * (attempt + 1)))
+
+
+def _act_once(db_path, letter_id, actor_id, action, comments, recommendations) -> Dict[str, Any]:
     conn = get_conn(db_path)
     cur = conn.cursor()
     
@@ -181,14 +674,16 @@ def act_on_letter(
         raise ValueError("Letter not found")
     
     # Get actor
-    cur.execute("SELECT * FROM users WHERE id = ?", (actor_id,))
+    cur.execute(
+        "SELECT id, name, role_id, role_name(role_id) AS role FROM users WHERE id = ?", (actor_id,)
+    )
     user = cur.fetchone()
     if not user:
         conn.close()
         raise ValueError("Actor not found")
 
     # handle comment action separately (does not advance or close steps)
-    now = datetime.utcnow().isoformat()
+    now = now_ms()
     if action == 'comment':
         # allow anyone except students to comment
         if user['role'].lower() == 'student':
@@ -204,13 +699,17 @@ def act_on_letter(
         if recommendations:
             full_comments += f"\nRecommendations: {recommendations}"
         # append comment with actor info and timestamp
-        existing = step.get('comments') or ''
-        new_comment = f"[{now}] {user['name']} ({user['role']}): {full_comments}"
+        existing = step['comments'] or ''
+        new_comment = f"[{to_iso(now)}] {user['name']} ({user['role']}): {full_comments}"
         combined = existing + ('\n' if existing else '') + new_comment
         cur.execute(
-            """UPDATE steps SET comments=? WHERE id=?""",
-            (combined, step['id'])
+            """UPDATE steps SET comments=?, version=version+1 WHERE id=? AND version=?""",
+            (combined, step['id'], step['version'])
         )
+        if cur.rowcount != 1:
+            conn.close()
+            raise ConflictError(f"Letter {letter_id} changed while commenting; try again")
+        _log_event(cur, letter_id, "commented", actor_id, _step_event(step, full_comments), now)
         conn.commit()
         result = get_letter(db_path, letter_id)
         conn.close()
@@ -234,24 +733,44 @@ def act_on_letter(
         raise ValueError("Step already acted on")
     
     # Role validation
-    if user["role"] != step["role"]:
+    if user["role_id"] != step["role_id"]:
         conn.close()
         raise ValueError(f"User role '{user['role']}' cannot act on step role '{step['role']}'")
 
-    now = datetime.utcnow().isoformat()
+    if action not in ("approve", "reject"):
+        conn.close()
+        raise ValueError("Unknown action. Use 'approve' or 'reject'")
+
+    now = now_ms()
     full_comments = comments or ""
     if recommendations:
         full_comments += f"\nRecommendations: {recommendations}"
     
+    # Claim the step; this fails if anyone acted on or commented on it since
+    # we read it. From here on this connection holds the write lock, so the
+    # letter cannot change under us either. The savepoint lets a conflict
+    # undo the claim even when the connection is borrowed (write queue,
+    # batches), where close() leaves the owner's transaction open.
+    cur.execute("SAVEPOINT act")
+    cur.execute(
+        """UPDATE steps 
+           SET status=?, actor_id=?, comments=?, acted_at=?, version=version+1 
+           WHERE id=? AND version=? AND status='pending'""",
+        (
+            "approved" if action == "approve" else "rejected",
+            actor_id,
+            full_comments,
+            now,
+            step["id"],
+            step["version"],
+        ),
+    )
+    if cur.rowcount != 1:
+        _rollback_to(cur, "act")
+        conn.close()
+        raise ConflictError(f"Step {current_step + 1} of letter {letter_id} was changed concurrently")
+
     if action == "approve":
-        # Update current step
-        cur.execute(
-            """UPDATE steps 
-               SET status='approved', actor_id=?, comments=?, acted_at=? 
-               WHERE id=?""",
-            (actor_id, full_comments, now, step["id"]),
-        )
-        
         # Check if there are more steps
         cur.execute("SELECT COUNT(1) as c FROM steps WHERE letter_id = ?", (letter_id,))
         total = cur.fetchone()["c"]
@@ -259,36 +778,37 @@ def act_on_letter(
         
         if next_index >= total:
             # All steps approved
-            cur.execute(
-                "UPDATE letters SET status='approved', current_step = ? WHERE id=?", 
-                (current_step, letter_id)
-            )
+            status, next_index = "approved", current_step
         else:
             # Move to next step
-            cur.execute(
-                "UPDATE letters SET current_step = ? WHERE id = ?", 
-                (next_index, letter_id)
-            )
-            
-    elif action == "reject":
-        # Update current step as rejected
-        cur.execute(
-            """UPDATE steps 
-               SET status='rejected', actor_id=?, comments=?, acted_at=? 
-               WHERE id=?""",
-            (actor_id, full_comments, now, step["id"]),
-        )
+            status = "pending"
+    else:
         # Mark letter as rejected
-        cur.execute(
-            "UPDATE letters SET status='rejected', current_step = ? WHERE id=?", 
-            (current_step, letter_id)
-        )
+        status, next_index = "rejected", current_step
+
+    cur.execute(
+        """UPDATE letters SET status=?, current_step=?, version=version+1
+           WHERE id=? AND version=?""",
+        (status, next_index, letter_id, letter["version"]),
+    )
+    if cur.rowcount != 1:
+        _rollback_to(cur, "act")
+        conn.close()
+        raise ConflictError(f"Letter {letter_id} was changed concurrently")
+    _log_event(
+        cur,
+        letter_id,
+        "approved" if action == "approve" else "rejected",
+        actor_id,
+        _step_event(step, full_comments),
+        now,
+    )
+
+    if action == "reject":
         # Notify sender that their letter was rejected
         notify_sender(db_path, letter_id, full_comments)
-    else:
-        conn.close()
-        raise ValueError("Unknown action. Use 'approve' or 'reject'")
 
+    cur.execute("RELEASE act")
     conn.commit()
     
     # Return updated letter with all steps
@@ -297,6 +817,12 @@ def act_on_letter(
     return result
 
 
+def _rollback_to(cur, savepoint: str) -> None:
+    """Undo everything since ``savepoint`` and drop it."""
+    cur.execute(f"ROLLBACK TO {savepoint}")
+    cur.execute(f"RELEASE {savepoint}")
+
+
 def notify_sender(db_path: str, letter_id: int, reason: str) -> None:
     """Send a notification to the original sender about rejection.
     This is currently a stub; in a real system it might send an email.
@@ -306,11 +832,16 @@ def notify_sender(db_path: str, letter_id: int, reason: str) -> None:
     cur.execute("SELECT sender_id FROM letters WHERE id = ?", (letter_id,))
     row = cur.fetchone()
     if row:
-        sender_id = row["sender_id"]
-        print(f"Notification: letter {letter_id} rejected; notifying user {sender_id}. Reason: {reason}")
+        send_rejection_notice(letter_id, row["sender_id"], reason)
     conn.close()
 
 
+def send_rejection_notice(letter_id: int, sender_id: int, reason: str) -> None:
+    """Deliver the rejection notice for ``letter_id`` to ``sender_id`` (stub: prints it)."""
+    print(f"Notification: letter {letter_id} rejected; notifying user {sender_id}. Reason: {reason}")
+
+
+@_storage_api
 def resend_letter(db_path: str, letter_id: int, sender_id: int, title: str, body: str) -> None:
     """Allow sender to update content and reset letter for approval.
     Only permitted if the sender_id matches and letter is rejected.
@@ -320,6 +851,11 @@ def resend_letter(db_path: str, letter_id: int, sender_id: int, title: str, body
     cur = conn.cursor()
     cur.execute("SELECT sender_id, status FROM letters WHERE id = ?", (letter_id,))
     row = cur.fetchone()
+    archived = False
+    if not row and attach_archive(conn, db_path):
+        cur.execute("SELECT sender_id, status FROM archive.letters WHERE id = ?", (letter_id,))
+        row = cur.fetchone()
+        archived = True
     if not row:
         conn.close()
         raise ValueError("Letter not found")
@@ -329,44 +865,66 @@ def resend_letter(db_path: str, letter_id: int, sender_id: int, title: str, body
     if row["status"] != "rejected":
         conn.close()
         raise ValueError("Only rejected letters can be resent")
-    cur.execute("UPDATE letters SET title = ?, body = ?, status = 'pending', current_step = 0 WHERE id = ?", (title, body, letter_id))
-    cur.execute("UPDATE steps SET status='pending', actor_id=NULL, comments=NULL, acted_at=NULL WHERE letter_id = ?", (letter_id,))
+    if archived:
+        # bring the letter back into the hot DB before reopening it
+        _move_letters(conn, "archive", "main", "SELECT ?", (letter_id,))
+    cur.execute("SELECT body_id FROM letters WHERE id = ?", (letter_id,))
+    old_body = cur.fetchone()["body_id"]
+    body_id = bodies.store(cur, body)
+    bodies.release(cur, old_body)
+    cur.execute(
+        """UPDATE letters SET title = ?, body_id = ?, status = 'pending', current_step = 0,
+               version = version + 1 WHERE id = ?""",
+        (title, body_id, letter_id),
+    )
+    cur.execute(
+        """UPDATE steps SET status='pending', actor_id=NULL, comments=NULL, acted_at=NULL,
+               version = version + 1 WHERE letter_id = ?""",
+        (letter_id,),
+    )
+    _log_event(cur, letter_id, "resent", sender_id, {"title": title}, now_ms())
     conn.commit()
     conn.close()
 
 
+@_storage_api
 def get_letter(db_path: str, letter_id: int) -> Dict[str, Any]:
     """Get a letter with all its approval steps."""
     conn = get_conn(db_path)
     cur = conn.cursor()
     
-    # Get letter with sender info
-    cur.execute(
-        """
-        SELECT l.*, u.name as sender_name, u.role as sender_role
-        FROM letters l
-        JOIN users u ON u.id = l.sender_id
+    # Get letter with sender info, falling back to the archive
+    query = """
+        SELECT {columns}, role_name(u.role_id) as sender_role
+        FROM {schema}.letters l
+        JOIN main.users u ON u.id = l.sender_id
+        LEFT JOIN {schema}.letter_bodies b ON b.id = l.body_id
         WHERE l.id = ?
-        """,
-        (letter_id,),
-    )
+        """
+    columns = _projection(None, LETTER_FIELDS)
+    schema = "main"
+    cur.execute(query.format(schema=schema, columns=columns), (letter_id,))
     letter = cur.fetchone()
+    if not letter and attach_archive(conn, db_path):
+        schema = "archive"
+        cur.execute(query.format(schema=schema, columns=columns), (letter_id,))
+        letter = cur.fetchone()
     if not letter:
         conn.close()
         raise ValueError("Letter not found")
     
     # Get all steps with actor info
     cur.execute(
-        """
-        SELECT s.*, u.name as actor_name, u.role as actor_role
-        FROM steps s
-        LEFT JOIN users u ON u.id = s.actor_id
+        f"""
+        SELECT {_STEP_COLUMNS}, u.name as actor_name, role_name(u.role_id) as actor_role
+        FROM {schema}.steps s
+        LEFT JOIN main.users u ON u.id = s.actor_id
         WHERE s.letter_id = ?
         ORDER BY s.step_index
         """,
         (letter_id,),
     )
-    steps = [dict(r) for r in cur.fetchall()]
+    steps = cur.fetchall()
     
     # Get current pending step info
     current_step_info = None
@@ -381,36 +939,231 @@ def get_letter(db_path: str, letter_id: int) -> Dict[str, Any]:
     
     conn.close()
     return {
-        "letter": dict(letter),
+        "letter": letter,
         "steps": steps,
         "current_step": current_step_info,
         "total_steps": len(steps)
     }
 
 
+@_storage_api
 def get_letter_history(db_path: str, letter_id: int) -> List[Dict[str, Any]]:
-    """Get the complete history of a letter (all actions taken)."""
+    """Get the complete history of a letter (all actions taken).
+
+    One row per approval, rejection or comment, oldest first, across every
+    resend round.
+    """
+    return _read_events(
+        db_path,
+        letter_id,
+        """SELECT
+            json_extract(e.payload, '$.step') AS step_index,
+            json_extract(e.payload, '$.role') AS role,
+            e.type AS status,
+            json_extract(e.payload, '$.comments') AS comments,
+            e.ts AS acted_at,
+            u.name AS actor_name,
+            role_name(u.role_id) AS actor_role
+        FROM {schema}.letter_events e
+        LEFT JOIN main.users u ON u.id = e.actor_id
+        WHERE e.letter_id = ? AND e.type IN ('approved', 'rejected', 'commented')
+        ORDER BY e.seq""",
+    )
+
+
+@_storage_api
+def get_letter_events(db_path: str, letter_id: int) -> List[Dict[str, Any]]:
+    """Get every event in a letter's log (sent, approved, rejected, commented, resent).
+
+    ``payload`` is decoded from JSON.
+    """
+    rows = _read_events(
+        db_path,
+        letter_id,
+        """SELECT e.seq, e.type, e.actor_id, u.name AS actor_name, role_name(u.role_id) AS actor_role,
+                  e.payload, e.ts
+        FROM {schema}.letter_events e
+        LEFT JOIN main.users u ON u.id = e.actor_id
+        WHERE e.letter_id = ?
+        ORDER BY e.seq""",
+    )
+    return [
+        Record.from_dict({**row, "payload": json.loads(row["payload"]) if row["payload"] else None})
+        for row in rows
+    ]
+
+
+def _read_events(db_path: str, letter_id: int, query: str):
+    """Run an event-log query (a range scan of one letter's events), falling back to the archive."""
     conn = get_conn(db_path)
     cur = conn.cursor()
-    
+    cur.execute(query.format(schema="main"), (letter_id,))
+    rows = cur.fetchall()
+    if not rows and attach_archive(conn, db_path):
+        cur.execute(query.format(schema="archive"), (letter_id,))
+        rows = cur.fetchall()
+    conn.close()
+    return rows
+
+
+def body_stats(db_path: str) -> Dict[str, Any]:
+    """Report how much body storage deduplication and compression save.
+
+    ``references`` letters point at ``bodies`` stored rows; ``dedup_ratio``
+    is references per stored body. ``logical_bytes`` is the text the letters
+    hold and ``stored_bytes`` what the rows take after compression. Archived
+    letters are included.
+    """
+    conn = get_conn(db_path)
+    schemas = ["main"]
+    if attach_archive(conn, db_path):
+        schemas.append("archive")
+    totals = dict.fromkeys(("bodies", "references", "stored_bytes", "logical_bytes"), 0)
+    for schema in schemas:
+        row = conn.execute(
+            f"""SELECT COUNT(*) AS bodies,
+                       SUM(refcount) AS "references",
+                       SUM(LENGTH(CAST(data AS BLOB))) AS stored_bytes,
+                       SUM(LENGTH(CAST(unpack_body(codec, data) AS BLOB)) * refcount) AS logical_bytes
+                FROM {schema}.letter_bodies"""
+        ).fetchone()
+        for key in totals:
+            totals[key] += row[key] or 0
+    conn.close()
+    totals["dedup_ratio"] = totals["references"] / totals["bodies"] if totals["bodies"] else 1.0
+    totals["compression_ratio"] = (
+        totals["logical_bytes"] / totals["stored_bytes"] if totals["stored_bytes"] else 1.0
+    )
+    return totals
+
+
+# Tables moved to the archive, with the column that holds the letter id.
+_ARCHIVED_TABLES = (("letters", "id"), ("steps", "letter_id"), ("letter_events", "letter_id"))
+
+# Tables read through to the archive: the above plus the (shared) bodies.
+_READ_THROUGH_TABLES = ("letters", "steps", "letter_bodies")
+
+
+def _read_through(conn, db_path: str) -> Tuple[str, ...]:
+    """Return table expressions (in ``_READ_THROUGH_TABLES`` order) that include archived rows."""
+    if not attach_archive(conn, db_path):
+        return _READ_THROUGH_TABLES
+    sources = []
+    for table in _READ_THROUGH_TABLES:
+        cols = ", ".join(table_columns(conn, table))
+        sources.append(
+            f"(SELECT {cols} FROM main.{table} UNION ALL SELECT {cols} FROM archive.{table})"
+        )
+    return tuple(sources)
+
+
+def _move_letters(conn, src: str, dst: str, ids_sql: str, params: tuple = ()) -> int:
+    """Move the letters selected by ``ids_sql`` (and their rows) from ``src`` to ``dst``.
+
+    Runs inside the caller's transaction; the caller commits.
+    """
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS archive_batch(id INTEGER PRIMARY KEY)")
+    cur.execute("DELETE FROM temp.archive_batch")
+    cur.execute(f"INSERT INTO temp.archive_batch(id) {ids_sql}", params)
+    moved = cur.rowcount
+    if not moved:
+        return 0
+    _move_bodies(cur, src, dst)
+    for table, key in _ARCHIVED_TABLES:
+        cols = ", ".join(table_columns(conn, table))
+        cur.execute(
+            f"""INSERT INTO {dst}.{table}({cols}) SELECT {cols} FROM {src}.{table}
+                WHERE {key} IN (SELECT id FROM temp.archive_batch)"""
+        )
+    for table, key in reversed(_ARCHIVED_TABLES):
+        cur.execute(
+            f"DELETE FROM {src}.{table} WHERE {key} IN (SELECT id FROM temp.archive_batch)"
+        )
+    # moved letters point at dst's copy of their body, which may have
+    # another id there; src copies nobody references any more are dropped
     cur.execute(
-        """
-        SELECT 
-            s.step_index,
-            s.role,
-            s.status,
-            s.comments,
-            s.acted_at,
-            u.name as actor_name,
-            u.role as actor_role
-        FROM steps s
-        LEFT JOIN users u ON u.id = s.actor_id
-        WHERE s.letter_id = ?
-        ORDER BY s.step_index
-        """,
-        (letter_id,),
+        f"""UPDATE {dst}.letters SET body_id = (
+                SELECT d.id FROM temp.body_moves m
+                JOIN {dst}.letter_bodies d ON d.hash = m.hash
+                WHERE m.src_id = letters.body_id)
+            WHERE id IN (SELECT id FROM temp.archive_batch)"""
     )
-    
-    history = [dict(r) for r in cur.fetchall()]
+    cur.execute(
+        f"""UPDATE {src}.letter_bodies SET refcount = refcount - (
+                SELECT n FROM temp.body_moves WHERE src_id = letter_bodies.id)
+            WHERE id IN (SELECT src_id FROM temp.body_moves)"""
+    )
+    cur.execute(
+        f"""DELETE FROM {src}.letter_bodies
+            WHERE id IN (SELECT src_id FROM temp.body_moves) AND refcount <= 0"""
+    )
+    return moved
+
+
+def _move_bodies(cur, src: str, dst: str) -> None:
+    """Add references in ``dst`` for the bodies of the letters in temp.archive_batch.
+
+    Bodies dst lacks are copied under their src id (ids come from one
+    sequence in the hot DB, so they never clash); ones it has by hash just
+    gain references. ``temp.body_moves`` records src id, hash and count.
+    """
+    cur.execute(
+        """CREATE TEMP TABLE IF NOT EXISTS body_moves(
+               src_id INTEGER PRIMARY KEY, hash BLOB, n INTEGER)"""
+    )
+    cur.execute("DELETE FROM temp.body_moves")
+    cur.execute(
+        f"""INSERT INTO temp.body_moves(src_id, hash, n)
+            SELECT b.id, b.hash, COUNT(*) FROM {src}.letters l
+            JOIN {src}.letter_bodies b ON b.id = l.body_id
+            WHERE l.id IN (SELECT id FROM temp.archive_batch)
+            GROUP BY b.id"""
+    )
+    cur.execute(
+        f"""INSERT INTO {dst}.letter_bodies(id, hash, codec, data, refcount)
+            SELECT b.id, b.hash, b.codec, b.data, 0 FROM {src}.letter_bodies b
+            WHERE b.id IN (SELECT src_id FROM temp.body_moves)
+              AND b.hash NOT IN (SELECT hash FROM {dst}.letter_bodies)"""
+    )
+    cur.execute(
+        f"""UPDATE {dst}.letter_bodies SET refcount = refcount + (
+                SELECT n FROM temp.body_moves WHERE hash = letter_bodies.hash)
+            WHERE hash IN (SELECT hash FROM temp.body_moves)"""
+    )
+
+
+def archive_letters(db_path: str, older_than_days: int, batch_size: int = 500) -> int:
+    """Move finalized letters older than ``older_than_days`` to the archive DB.
+
+    Steps (and the comments they carry) move with their letter. Each batch of
+    ``batch_size`` letters is one transaction. Reads through ``get_letter``,
+    ``get_letter_history`` and ``list_all_letters`` still see archived letters.
+    Returns the number of letters moved.
+    """
+    cutoff = now_ms() - older_than_days * MS_PER_DAY
+    conn = get_conn(db_path)
+    if not attach_archive(conn, db_path, create=True):
+        conn.close()
+        raise ValueError("Archiving needs a file-backed database")
+    total = 0
+    while True:
+        moved = _move_letters(
+            conn,
+            "main",
+            "archive",
+            """SELECT l.id FROM main.letters l
+               WHERE l.status IN ('approved', 'rejected')
+                 AND COALESCE(
+                     (SELECT MAX(s.acted_at) FROM main.steps s WHERE s.letter_id = l.id),
+                     l.created_at
+                 ) < ?
+               ORDER BY l.id LIMIT ?""",
+            (cutoff, batch_size),
+        )
+        conn.commit()
+        total += moved
+        if moved < batch_size:
+            break
     conn.close()
-    return history
\ No newline at end of file
+    return total
\ No newline at end of file
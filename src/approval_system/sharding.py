@@ -0,0 +1,390 @@
+"""Horizontal sharding of the approval store over several SQLite files.
+
+A single DB file allows one writer at a time. ``ShardedStorage`` spreads
+letters over N files (shards) so writes to different shards run in
+parallel. It is a storage backend like the ones in ``storage``: pass it
+where a ``db_path`` goes and the service call is routed::
+
+    store = ShardedStorage(["cs.db", "law.db", "med.db"], key="role")
+    lid = send_letter(store, sender_id, "Exit Request", "...")
+    act_on_letter(store, lid, approver_id, "approve")
+
+Routing:
+
+* A letter lives on the shard chosen by ``key`` from its sender: ``sender``
+  (user id, the default), ``role``, or any callable taking the user row.
+  Integer keys are taken modulo N and other keys are hashed.
+* Ids are globally unique because each shard issues ids for letters, steps
+  and bodies from its own range, starting at ``shard << SHARD_BITS``.
+  A letter id therefore names its home shard, and ``get_letter``,
+  ``act_on_letter`` and the like go straight to one file.
+* Users are few and needed everywhere, for sender names and actor checks.
+  They are created on shard 0, which issues their ids, and copied to every
+  other shard.
+* Listings, pages, counts and the admin overview query every shard and
+  merge the results by ``created_at``.
+
+``rebalance()`` moves letters whose sender now maps to another shard,
+for example after adding a shard. A moved letter gets a new id from its new
+shard's range. Every shard issues ids above the largest row it holds, so
+foreign ids cannot be kept. The source shard's ``letter_relocations`` table
+maps the old id to the new one, so old ids keep working. Responses carry
+the new id.
+"""
+from itertools import islice
+from operator import itemgetter
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+import heapq
+import json
+import zlib
+
+from . import bodies, service
+from .db import get_conn, table_columns, transaction
+from .roles import role_id
+from .storage import _project
+
+# Low bits of an id that number rows within a shard
+SHARD_BITS = 40
+
+SHARD_KEYS: Dict[str, Callable[[Any], Any]] = {
+    "sender": itemgetter("id"),
+    "role": itemgetter("role"),
+}
+
+# Users as shard keys see them, with the role by name
+_USER_SQL = "SELECT id, name, role_name(role_id) AS role FROM users"
+
+# Tables whose ids a shard issues from its own range
+_SHARD_SEQUENCES = ("letters", "steps", "letter_bodies")
+
+
+class ShardedStorage:
+    """Route service calls over the shard files at ``paths``."""
+
+    def __init__(
+        self, paths: Sequence[str], key: Union[str, Callable[[Any], Any]] = "sender"
+    ) -> None:
+        if not paths:
+            raise ValueError("At least one shard is required")
+        self.paths = list(paths)
+        self.key = SHARD_KEYS[key] if isinstance(key, str) else key
+        # old letter id -> id after a rebalance moved it
+        self._relocated: Dict[int, int] = {}
+        self.init_db()
+
+    # -- routing --------------------------------------------------------
+
+    def shard_for_user(self, user) -> int:
+        key = self.key(user)
+        if isinstance(key, int):
+            return key % len(self.paths)
+        return zlib.crc32(str(key).encode("utf-8")) % len(self.paths)
+
+    def shard_for_letter(self, letter_id: int) -> int:
+        shard = self._current_id(letter_id) >> SHARD_BITS
+        if not 0 <= shard < len(self.paths):
+            raise ValueError("Letter not found")
+        return shard
+
+    def _current_id(self, letter_id: int) -> int:
+        while letter_id in self._relocated:
+            letter_id = self._relocated[letter_id]
+        return letter_id
+
+    def _user(self, user_id: int):
+        conn = get_conn(self.paths[0])
+        user = conn.execute(_USER_SQL + " WHERE id = ?", (user_id,)).fetchone()
+        conn.close()
+        return user
+
+    def _route(self, func, letter_id: int, *args):
+        """Call ``func`` on the shard holding ``letter_id``, following relocations."""
+        # a miss (an error or an empty history) may mean the letter moved
+        while True:
+            shard = self.shard_for_letter(letter_id)
+            current = self._current_id(letter_id)
+            try:
+                result = func(self.paths[shard], current, *args)
+            except ValueError as e:
+                if str(e) != "Letter not found" or not self._follow(shard, current):
+                    raise
+            else:
+                if result != [] or not self._follow(shard, current):
+                    return result
+
+    def _follow(self, shard: int, letter_id: int) -> bool:
+        """Look ``letter_id`` up in ``shard``'s relocations; True if it moved on."""
+        conn = get_conn(self.paths[shard])
+        row = conn.execute(
+            "SELECT new_id FROM letter_relocations WHERE letter_id = ?", (letter_id,)
+        ).fetchone()
+        conn.close()
+        if row is None:
+            return False
+        self._relocated[letter_id] = row["new_id"]
+        return True
+
+    def _merge(self, func, args, fields, available, reverse, after=()) -> Iterator[Dict[str, Any]]:
+        """Merge ``func``'s per-shard streams, each sorted by ``created_at``.
+
+        ``func`` is called as ``func(path, *args, fields, *after)``.
+        """
+        wanted = service.check_fields(fields, available) if fields else None
+        fetch = wanted if not wanted or "created_at" in wanted else wanted + ["created_at"]
+        streams = [func(path, *args, fetch, *after) for path in self.paths]
+        merged = heapq.merge(*streams, key=itemgetter("created_at"), reverse=reverse)
+        if fetch is wanted:
+            return merged
+        return (_project(row, wanted) for row in merged)
+
+    # -- setup ----------------------------------------------------------
+
+    def init_db(self) -> None:
+        for shard, path in enumerate(self.paths):
+            service.init_db(path)
+            if shard:
+                _seed_sequences(path, shard)
+        self.sync_users()
+
+    def sync_users(self) -> None:
+        """Copy users missing from shards 1.. over from shard 0."""
+        for path in self.paths[1:]:
+            conn = get_conn(path)
+            conn.execute("ATTACH DATABASE ? AS catalog", (self.paths[0],))
+            cols = ", ".join(table_columns(conn, "users"))
+            conn.execute(
+                f"INSERT OR IGNORE INTO main.users({cols}) SELECT {cols} FROM catalog.users"
+            )
+            conn.commit()
+            conn.close()
+
+    # -- writes ---------------------------------------------------------
+
+    def create_user(self, name: str, role: str) -> int:
+        uid = service.create_user(self.paths[0], name, role)
+        for path in self.paths[1:]:
+            conn = get_conn(path)
+            conn.execute(
+                "INSERT OR IGNORE INTO users(id, name, role_id) VALUES(?, ?, ?)",
+                (uid, name, role_id(role)),
+            )
+            conn.commit()
+            conn.close()
+        return uid
+
+    def import_users(self, source, chunk_size: int = 1000) -> Dict[str, Any]:
+        result = service.import_users(self.paths[0], source, chunk_size)
+        self.sync_users()
+        return result
+
+    def send_letter(self, sender_id, title, body, route=None) -> int:
+        sender = self._user(sender_id)
+        if not sender:
+            raise ValueError(f"Sender with id {sender_id} not found")
+        path = self.paths[self.shard_for_user(sender)]
+        return service.send_letter(path, sender_id, title, body, route)
+
+    def act_on_letter(
+        self, letter_id, actor_id, action, comments=None, recommendations=None, retries=0
+    ):
+        return self._route(
+            service.act_on_letter, letter_id, actor_id, action, comments, recommendations, retries
+        )
+
+    def resend_letter(self, letter_id, sender_id, title, body) -> None:
+        return self._route(service.resend_letter, letter_id, sender_id, title, body)
+
+    # -- shard-local reads ----------------------------------------------
+
+    def get_letter(self, letter_id):
+        return self._route(service.get_letter, letter_id)
+
+    def get_letter_history(self, letter_id):
+        return self._route(service.get_letter_history, letter_id)
+
+    def get_letter_events(self, letter_id):
+        return self._route(service.get_letter_events, letter_id)
+
+    # -- scatter-gather reads -------------------------------------------
+
+    def list_pending_for_role(self, role, fields=None, date_from=None, date_to=None):
+        return list(self.iter_pending_for_role(role, fields, date_from, date_to))
+
+    def iter_pending_for_role(self, role, fields=None, date_from=None, date_to=None):
+        return self._merge(
+            service.iter_pending_for_role, (role,), fields, service.PENDING_FIELDS,
+            reverse=False, after=(date_from, date_to),
+        )
+
+    def list_all_letters(self, user_id=None, fields=None, date_from=None, date_to=None, status=None):
+        return list(self.iter_letters(user_id, fields, date_from, date_to, status))
+
+    def iter_letters(self, user_id=None, fields=None, date_from=None, date_to=None, status=None):
+        return self._merge(
+            service.iter_letters, (user_id,), fields, service.LETTER_FIELDS,
+            reverse=True, after=(date_from, date_to, status),
+        )
+
+    def list_letters_page(
+        self, status=None, sender=None, date_from=None, date_to=None, search=None, limit=25, offset=0
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        # every shard's first offset + limit rows hold the merged page
+        pages = [
+            service.list_letters_page(
+                path, status, sender, date_from, date_to, search, offset + limit, 0
+            )
+            for path in self.paths
+        ]
+        merged = heapq.merge(*(rows for rows, _ in pages), key=itemgetter("created_at"), reverse=True)
+        return list(islice(merged, offset, offset + limit)), sum(total for _, total in pages)
+
+    def list_pending_page(self, role, limit=25, offset=0) -> Tuple[List[Dict[str, Any]], int]:
+        pages = [service.list_pending_page(path, role, offset + limit, 0) for path in self.paths]
+        merged = heapq.merge(*(rows for rows, _ in pages), key=itemgetter("created_at"))
+        return list(islice(merged, offset, offset + limit)), sum(total for _, total in pages)
+
+    def get_pending_counts(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for path in self.paths:
+            for role, n in service.get_pending_counts(path).items():
+                counts[role] = counts.get(role, 0) + n
+        return counts
+
+    def get_admin_overview(self, recent: int = 10) -> Dict[str, Any]:
+        parts = [service.get_admin_overview(path, recent) for path in self.paths]
+        counts: Dict[str, int] = {}
+        pending_by_role: Dict[str, int] = {}
+        for part in parts:
+            for status, n in part["counts"].items():
+                counts[status] = counts.get(status, 0) + n
+            for role, n in part["pending_by_role"].items():
+                pending_by_role[role] = pending_by_role.get(role, 0) + n
+        latest = heapq.merge(
+            *(part["recent"] for part in parts), key=itemgetter("created_at"), reverse=True
+        )
+        return {
+            "counts": counts,
+            "total": sum(counts.values()),
+            "pending_by_role": pending_by_role,
+            "recent": list(islice(latest, recent)),
+        }
+
+    # -- rebalancing ----------------------------------------------------
+
+    def rebalance(self, batch_size: int = 500) -> Dict[Tuple[int, int], int]:
+        """Move every letter to the shard its sender maps to now.
+
+        Returns the number of letters moved per ``(from, to)`` shard pair.
+        Each batch of ``batch_size`` letters moves in one transaction over
+        both files. Archived letters stay in their shard's archive, where
+        their id still finds them.
+        """
+        self.sync_users()
+        conn = get_conn(self.paths[0])
+        users = {u["id"]: u for u in conn.execute(_USER_SQL)}
+        conn.close()
+        moved: Dict[Tuple[int, int], int] = {}
+        for src, path in enumerate(self.paths):
+            conn = get_conn(path)
+            targets: Dict[int, List[int]] = {}
+            for row in conn.execute("SELECT id, sender_id FROM letters ORDER BY id"):
+                user = users.get(row["sender_id"])
+                dst = self.shard_for_user(user) if user else src
+                if dst != src:
+                    targets.setdefault(dst, []).append(row["id"])
+            conn.close()
+            for dst, ids in targets.items():
+                for i in range(0, len(ids), batch_size):
+                    self._move(src, dst, ids[i:i + batch_size])
+                moved[(src, dst)] = len(ids)
+        return moved
+
+    def _move(self, src: int, dst: int, ids: List[int]) -> None:
+        """Move letters ``ids`` (with steps, events and bodies) from shard ``src`` to ``dst``."""
+        conn = get_conn(self.paths[src])
+        conn.isolation_level = None
+        conn.execute("ATTACH DATABASE ? AS dst", (self.paths[dst],))
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                renamed = _move_letters(conn, ids)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        self._relocated.update(renamed)
+
+
+def _move_letters(conn, ids: List[int]) -> Dict[int, int]:
+    """Copy letters ``ids`` from ``main`` to ``dst`` under new ids, then delete them.
+
+    Runs inside the caller's transaction. Returns old id -> new id.
+    """
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS letter_map(old_id INTEGER PRIMARY KEY, new_id INTEGER)")
+    cur.execute("DELETE FROM temp.letter_map")
+    # bodies dst lacks are copied; all are then matched by hash
+    cur.execute(
+        """INSERT INTO dst.letter_bodies(hash, codec, data, refcount)
+           SELECT DISTINCT b.hash, b.codec, b.data, 0 FROM main.letter_bodies b
+           JOIN main.letters l ON l.body_id = b.id
+           WHERE l.id IN (SELECT value FROM json_each(?))
+             AND b.hash NOT IN (SELECT hash FROM dst.letter_bodies)""",
+        (json.dumps(ids),),
+    )
+    cols = [c for c in table_columns(conn, "letters") if c not in ("id", "body_id")]
+    for old_id in ids:
+        cur.execute(
+            f"""INSERT INTO dst.letters({", ".join(cols)}, body_id)
+                SELECT {", ".join("l." + c for c in cols)}, d.id FROM main.letters l
+                JOIN main.letter_bodies b ON b.id = l.body_id
+                JOIN dst.letter_bodies d ON d.hash = b.hash
+                WHERE l.id = ?""",
+            (old_id,),
+        )
+        cur.execute("INSERT INTO temp.letter_map(old_id, new_id) VALUES(?, ?)", (old_id, cur.lastrowid))
+    cur.execute(
+        """UPDATE dst.letter_bodies SET refcount = refcount + (
+               SELECT COUNT(*) FROM dst.letters l JOIN temp.letter_map m ON m.new_id = l.id
+               WHERE l.body_id = letter_bodies.id)
+           WHERE id IN (SELECT l.body_id FROM dst.letters l JOIN temp.letter_map m ON m.new_id = l.id)"""
+    )
+    for table in ("steps", "letter_events"):
+        cols = [c for c in table_columns(conn, table) if c not in ("id", "letter_id")]
+        cur.execute(
+            f"""INSERT INTO dst.{table}(letter_id, {", ".join(cols)})
+                SELECT m.new_id, {", ".join("t." + c for c in cols)} FROM main.{table} t
+                JOIN temp.letter_map m ON m.old_id = t.letter_id"""
+        )
+        cur.execute(f"DELETE FROM main.{table} WHERE letter_id IN (SELECT old_id FROM temp.letter_map)")
+    body_ids = [
+        r["body_id"] for r in cur.execute(
+            "SELECT body_id FROM main.letters WHERE id IN (SELECT old_id FROM temp.letter_map)"
+        ).fetchall()
+    ]
+    cur.execute("DELETE FROM main.letters WHERE id IN (SELECT old_id FROM temp.letter_map)")
+    for body_id in body_ids:
+        bodies.release(cur, body_id)
+    cur.execute(
+        """INSERT OR REPLACE INTO main.letter_relocations(letter_id, new_id)
+           SELECT old_id, new_id FROM temp.letter_map"""
+    )
+    return {r["old_id"]: r["new_id"] for r in cur.execute("SELECT old_id, new_id FROM temp.letter_map")}
+
+
+def _seed_sequences(path: str, shard: int) -> None:
+    """Make ``path`` issue letter, step and body ids from ``shard``'s range."""
+    floor = shard << SHARD_BITS
+    with transaction(path) as conn:
+        for table in _SHARD_SEQUENCES:
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+            if row is not None and row["seq"] >= floor:
+                continue
+            if conn.execute(f"SELECT 1 FROM {table} WHERE id < ? LIMIT 1", (floor,)).fetchone():
+                raise ValueError(f"{path} holds {table} outside shard {shard}'s id range")
+            if row is None:
+                conn.execute("INSERT INTO sqlite_sequence(name, seq) VALUES(?, ?)", (table, floor))
+            else:
+                conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = ?", (floor, table))
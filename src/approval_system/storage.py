@@ -0,0 +1,580 @@
+"""Storage backends behind the service API.
+
+Every public function in ``service`` takes a ``db_path`` as its first
+argument. Passing one of the objects below instead routes the call to that
+backend, so callers can switch storage without changing code::
+
+    store = MemoryStorage()
+    uid = create_user(store, "Ada", "SRC")
+
+``SQLiteStorage`` is the file-backed store used in production.
+``MemoryStorage`` keeps everything in indexed dicts and per-role queues; it is
+meant for tests and what-if simulations where file I/O would dominate.
+"""
+from bisect import insort
+from operator import itemgetter
+from typing import Any, Dict, Iterator, List, Optional, Protocol, Set, Tuple
+import threading
+
+from . import service
+from .records import Record
+from .roles import role_id
+from .timestamps import now_ms, to_iso, to_ms
+
+
+def _project(row: Dict[str, Any], fields: Optional[List[str]]) -> Record:
+    if fields:
+        row = {name: row[name] for name in fields}
+    return Record.from_dict(row)
+
+
+# Columns of a letter summary row, before ``sender_name`` (see service._SUMMARY_COLUMNS)
+_SUMMARY_FIELDS = ("id", "title", "sender_id", "status", "created_at", "current_step")
+
+
+def _between(date_from, date_to):
+    """Predicate on epoch ms for the [from, to) range filters."""
+    low, high = to_ms(date_from), to_ms(date_to)
+    return lambda ms: (low is None or ms >= low) and (high is None or ms < high)
+
+
+class Storage(Protocol):
+    """Operations every backend provides (``service`` minus ``db_path``)."""
+
+    def init_db(self) -> None: ...
+
+    def create_user(self, name: str, role: str) -> int: ...
+
+    def import_users(self, source, chunk_size: int = 1000) -> Dict[str, Any]: ...
+
+    def send_letter(
+        self, sender_id: int, title: str, body: str, route: Optional[List[str]] = None
+    ) -> int: ...
+
+    def list_pending_for_role(
+        self, role: str, fields: Optional[List[str]] = None, date_from=None, date_to=None
+    ) -> List[Dict[str, Any]]: ...
+
+    def list_all_letters(
+        self, user_id: Optional[int] = None, fields: Optional[List[str]] = None,
+        date_from=None, date_to=None, status: Optional[str] = None,
+    ) -> List[Dict[str, Any]]: ...
+
+    def iter_pending_for_role(
+        self, role: str, fields: Optional[List[str]] = None, date_from=None, date_to=None
+    ) -> Iterator[Dict[str, Any]]: ...
+
+    def get_pending_counts(self) -> Dict[str, int]: ...
+
+    def iter_letters(
+        self, user_id: Optional[int] = None, fields: Optional[List[str]] = None,
+        date_from=None, date_to=None, status: Optional[str] = None,
+    ) -> Iterator[Dict[str, Any]]: ...
+
+    def list_letters_page(
+        self,
+        status: Optional[str] = None,
+        sender: Optional[str] = None,
+        date_from=None,
+        date_to=None,
+        search: Optional[str] = None,
+        limit: int = 25,
+        offset: int = 0,
+    ) -> Tuple[List[Dict[str, Any]], int]: ...
+
+    def list_pending_page(
+        self, role: str, limit: int = 25, offset: int = 0
+    ) -> Tuple[List[Dict[str, Any]], int]: ...
+
+    def get_admin_overview(self, recent: int = 10) -> Dict[str, Any]: ...
+
+    def act_on_letter(
+        self,
+        letter_id: int,
+        actor_id: int,
+        action: str,
+        comments: Optional[str] = None,
+        recommendations: Optional[str] = None,
+        retries: int = 0,
+    ) -> Dict[str, Any]: ...
+
+    def resend_letter(self, letter_id: int, sender_id: int, title: str, body: str) -> None: ...
+
+    def get_letter(self, letter_id: int) -> Dict[str, Any]: ...
+
+    def get_letter_history(self, letter_id: int) -> List[Dict[str, Any]]: ...
+
+    def get_letter_events(self, letter_id: int) -> List[Dict[str, Any]]: ...
+
+
+class SQLiteStorage:
+    """The SQLite file at ``path``."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        service.init_db(path)
+
+    def init_db(self) -> None:
+        service.init_db(self.path)
+
+    def create_user(self, name, role):
+        return service.create_user(self.path, name, role)
+
+    def import_users(self, source, chunk_size=1000):
+        return service.import_users(self.path, source, chunk_size)
+
+    def send_letter(self, sender_id, title, body, route=None):
+        return service.send_letter(self.path, sender_id, title, body, route)
+
+    def list_pending_for_role(self, role, fields=None, date_from=None, date_to=None):
+        return service.list_pending_for_role(self.path, role, fields, date_from, date_to)
+
+    def list_all_letters(self, user_id=None, fields=None, date_from=None, date_to=None, status=None):
+        return service.list_all_letters(self.path, user_id, fields, date_from, date_to, status)
+
+    def iter_pending_for_role(self, role, fields=None, date_from=None, date_to=None):
+        return service.iter_pending_for_role(self.path, role, fields, date_from, date_to)
+
+    def get_pending_counts(self):
+        return service.get_pending_counts(self.path)
+
+    def iter_letters(self, user_id=None, fields=None, date_from=None, date_to=None, status=None):
+        return service.iter_letters(self.path, user_id, fields, date_from, date_to, status)
+
+    def list_letters_page(
+        self, status=None, sender=None, date_from=None, date_to=None, search=None, limit=25, offset=0
+    ):
+        return service.list_letters_page(
+            self.path, status, sender, date_from, date_to, search, limit, offset
+        )
+
+    def list_pending_page(self, role, limit=25, offset=0):
+        return service.list_pending_page(self.path, role, limit, offset)
+
+    def get_admin_overview(self, recent=10):
+        return service.get_admin_overview(self.path, recent)
+
+    def act_on_letter(
+        self, letter_id, actor_id, action, comments=None, recommendations=None, retries=0
+    ):
+        return service.act_on_letter(
+            self.path, letter_id, actor_id, action, comments, recommendations, retries
+        )
+
+    def resend_letter(self, letter_id, sender_id, title, body):
+        return service.resend_letter(self.path, letter_id, sender_id, title, body)
+
+    def get_letter(self, letter_id):
+        return service.get_letter(self.path, letter_id)
+
+    def get_letter_history(self, letter_id):
+        return service.get_letter_history(self.path, letter_id)
+
+    def get_letter_events(self, letter_id):
+        return service.get_letter_events(self.path, letter_id)
+
+
+class MemoryStorage:
+    """Process-local store with the same behaviour as the SQLite backend.
+
+    Rows are stored as plain dicts keyed by id and returned as ``Record``s. Pending steps are kept in one sorted
+    queue per role so inbox reads never scan letters for other roles.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.RLock()
+        self._users: Dict[int, Dict[str, Any]] = {}
+        self._user_keys: Dict[Tuple[str, str], int] = {}
+        self._letters: Dict[int, Dict[str, Any]] = {}
+        self._steps: Dict[int, List[Dict[str, Any]]] = {}
+        # letter id -> append-only [(type, actor id, payload, ts)]
+        self._events: Dict[int, List[Tuple[str, Optional[int], Dict[str, Any], int]]] = {}
+        # role -> sorted [(letter created_at, step id, step)]
+        self._queues: Dict[str, List[Tuple[int, int, Dict[str, Any]]]] = {}
+        # user id -> letters sent or acted on
+        self._involved: Dict[int, Set[int]] = {}
+        self._next_ids = {"users": 1, "letters": 1, "steps": 1}
+
+    def _new_id(self, table: str) -> int:
+        nid = self._next_ids[table]
+        self._next_ids[table] = nid + 1
+        return nid
+
+    def _enqueue(self, letter: Dict[str, Any], step: Dict[str, Any]) -> None:
+        insort(
+            self._queues.setdefault(step["role"], []),
+            (letter["created_at"], step["id"], step),
+            key=lambda e: e[:2],
+        )
+
+    def _dequeue(self, step: Dict[str, Any]) -> None:
+        queue = self._queues.get(step["role"], [])
+        for i, entry in enumerate(queue):
+            if entry[1] == step["id"]:
+                del queue[i]
+                return
+
+    def init_db(self) -> None:
+        pass
+
+    def create_user(self, name: str, role: str) -> int:
+        if role not in service.VALID_ROLES:
+            raise ValueError(
+                f"Invalid role: {role}. Valid roles: {', '.join(service.VALID_ROLES)}"
+            )
+        with self._lock:
+            if (name, role) in self._user_keys:
+                raise ValueError(f"User '{name}' with role '{role}' already exists")
+            uid = self._new_id("users")
+            self._users[uid] = {"id": uid, "name": name, "role": role}
+            self._user_keys[(name, role)] = uid
+            return uid
+
+    def import_users(self, source, chunk_size: int = 1000) -> Dict[str, Any]:
+        imported, rejected = 0, []
+        for number, name, role in service._user_rows(source):
+            if not name or not role:
+                error = "Missing name or role"
+            elif role not in service.VALID_ROLES:
+                error = f"Invalid role: {role}"
+            else:
+                try:
+                    self.create_user(name, role)
+                    imported += 1
+                    continue
+                except ValueError as e:
+                    error = str(e)
+            rejected.append({"row": number, "name": name, "role": role, "error": error})
+        return {"imported": imported, "rejected": rejected}
+
+    def send_letter(self, sender_id, title, body, route=None) -> int:
+        with self._lock:
+            sender = self._users.get(sender_id)
+            if not sender:
+                raise ValueError(f"Sender with id {sender_id} not found")
+            if sender["role"] not in service.VALID_ROLES:
+                raise ValueError(f"Invalid sender role: {sender['role']}")
+
+            route = route or service.DEFAULT_ROUTE
+            unknown = [role for role in route if role_id(role) is None]
+            if unknown:
+                raise ValueError(f"Invalid role in route: {unknown[0]}")
+            lid = self._new_id("letters")
+            letter = {
+                "id": lid,
+                "title": title,
+                "body": body,
+                "sender_id": sender_id,
+                "status": "pending",
+                "created_at": now_ms(),
+                "current_step": 0,
+                "version": 0,
+            }
+            self._letters[lid] = letter
+            steps = self._steps[lid] = []
+            for idx, role in enumerate(route):
+                step = {
+                    "id": self._new_id("steps"),
+                    "letter_id": lid,
+                    "step_index": idx,
+                    "role": role,
+                    "status": "pending",
+                    "actor_id": None,
+                    "comments": None,
+                    "acted_at": None,
+                    "version": 0,
+                }
+                steps.append(step)
+                self._enqueue(letter, step)
+            self._involved.setdefault(sender_id, set()).add(lid)
+            self._log_event(lid, "sent", sender_id, {"title": title}, letter["created_at"])
+            return lid
+
+    def list_pending_for_role(
+        self, role: str, fields=None, date_from=None, date_to=None
+    ) -> List[Dict[str, Any]]:
+        return list(self.iter_pending_for_role(role, fields, date_from, date_to))
+
+    def iter_pending_for_role(
+        self, role: str, fields=None, date_from=None, date_to=None
+    ) -> Iterator[Dict[str, Any]]:
+        if fields:
+            fields = service.check_fields(fields, service.PENDING_FIELDS)
+        created = _between(date_from, date_to)
+        with self._lock:
+            queue = list(self._queues.get(role, ()))
+        for created_at, _, step in queue:
+            if not created(created_at):
+                continue
+            with self._lock:
+                letter = self._letters[step["letter_id"]]
+                sender = self._users.get(letter["sender_id"])
+                if sender is None or step["status"] != "pending" or letter["status"] != "pending":
+                    continue
+                row = _project({
+                    **step,
+                    "title": letter["title"],
+                    "body": letter["body"],
+                    "sender_id": letter["sender_id"],
+                    "created_at": letter["created_at"],
+                    "letter_status": letter["status"],
+                    "sender_name": sender["name"],
+                }, fields)
+            yield row
+
+    def _pending_counts(self) -> Dict[str, int]:
+        with self._lock:
+            counts = {}
+            for role, queue in self._queues.items():
+                n = sum(
+                    1
+                    for _, _, step in queue
+                    if step["status"] == "pending"
+                    and self._letters[step["letter_id"]]["status"] == "pending"
+                    and self._letters[step["letter_id"]]["sender_id"] in self._users
+                )
+                if n:
+                    counts[role] = n
+        return counts
+
+    def get_pending_counts(self) -> Dict[str, int]:
+        counts = self._pending_counts()
+        return {role: counts.get(role, 0) for role in sorted(service.VALID_ROLES | set(counts))}
+
+    def list_all_letters(
+        self, user_id: Optional[int] = None, fields=None, date_from=None, date_to=None, status=None
+    ) -> List[Dict[str, Any]]:
+        return list(self.iter_letters(user_id, fields, date_from, date_to, status))
+
+    def iter_letters(
+        self, user_id: Optional[int] = None, fields=None, date_from=None, date_to=None, status=None
+    ) -> Iterator[Dict[str, Any]]:
+        if fields:
+            fields = service.check_fields(fields, service.LETTER_FIELDS)
+        created = _between(date_from, date_to)
+        with self._lock:
+            if user_id:
+                ids = self._involved.get(user_id, ())
+                letters = [self._letters[lid] for lid in ids]
+            else:
+                letters = list(self._letters.values())
+        letters = [
+            l for l in letters if created(l["created_at"]) and (not status or l["status"] == status)
+        ]
+        letters.sort(key=itemgetter("created_at", "id"), reverse=True)
+        for letter in letters:
+            with self._lock:
+                sender = self._users.get(letter["sender_id"])
+                if sender is None:
+                    continue
+                row = _project({**letter, "sender_name": sender["name"]}, fields)
+            yield row
+
+    def _summary(self, letter: Dict[str, Any]) -> Record:
+        return Record.from_dict({
+            **{name: letter[name] for name in _SUMMARY_FIELDS},
+            "sender_name": self._users[letter["sender_id"]]["name"],
+        })
+
+    def list_letters_page(
+        self, status=None, sender=None, date_from=None, date_to=None, search=None, limit=25, offset=0
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        created = _between(date_from or None, date_to or None)
+        sender = sender and sender.lower()
+        search = search and search.lower()
+        with self._lock:
+            matches = [
+                letter
+                for letter in self._letters.values()
+                if letter["sender_id"] in self._users
+                and created(letter["created_at"])
+                and (not status or letter["status"] == status)
+                and (not sender or sender in self._users[letter["sender_id"]]["name"].lower())
+                and (not search or search in letter["title"].lower() or search in letter["body"].lower())
+            ]
+            matches.sort(key=itemgetter("created_at", "id"), reverse=True)
+            return [self._summary(l) for l in matches[offset:offset + limit]], len(matches)
+
+    def list_pending_page(self, role: str, limit: int = 25, offset: int = 0):
+        rows = self.list_pending_for_role(
+            role, ["letter_id", "step_index", "title", "sender_id", "created_at", "sender_name"]
+        )
+        return rows[offset:offset + limit], len(rows)
+
+    def get_admin_overview(self, recent: int = 10) -> Dict[str, Any]:
+        with self._lock:
+            counts: Dict[str, int] = {}
+            for letter in self._letters.values():
+                counts[letter["status"]] = counts.get(letter["status"], 0) + 1
+            latest = sorted(
+                (l for l in self._letters.values() if l["sender_id"] in self._users),
+                key=itemgetter("created_at", "id"),
+                reverse=True,
+            )[:recent]
+            return {
+                "counts": counts,
+                "total": len(self._letters),
+                "pending_by_role": self._pending_counts(),
+                "recent": [self._summary(l) for l in latest],
+            }
+
+    def act_on_letter(
+        self, letter_id, actor_id, action, comments=None, recommendations=None, retries=0
+    ):
+        # transitions run under the store lock, so they never conflict
+        with self._lock:
+            letter = self._letters.get(letter_id)
+            if not letter:
+                raise ValueError("Letter not found")
+            user = self._users.get(actor_id)
+            if not user:
+                raise ValueError("Actor not found")
+
+            steps = self._steps[letter_id]
+            current_step = letter["current_step"]
+            step = steps[current_step] if current_step < len(steps) else None
+            now = now_ms()
+            full_comments = comments or ""
+            if recommendations:
+                full_comments += f"\nRecommendations: {recommendations}"
+
+            if action == "comment":
+                if user["role"].lower() == "student":
+                    raise ValueError("Students are not permitted to comment")
+                if not step:
+                    raise ValueError("No approval step found to comment on")
+                existing = step["comments"] or ""
+                new_comment = f"[{to_iso(now)}] {user['name']} ({user['role']}): {full_comments}"
+                step["comments"] = existing + ("\n" if existing else "") + new_comment
+                step["version"] += 1
+                self._log_event(letter_id, "commented", actor_id, service._step_event(step, full_comments), now)
+                return self.get_letter(letter_id)
+
+            if letter["status"] in ["approved", "rejected"]:
+                raise ValueError(f"Letter already {letter['status']}")
+            if not step:
+                raise ValueError("No approval step found")
+            if step["status"] != "pending":
+                raise ValueError("Step already acted on")
+            if user["role"] != step["role"]:
+                raise ValueError(
+                    f"User role '{user['role']}' cannot act on step role '{step['role']}'"
+                )
+            if action not in ("approve", "reject"):
+                raise ValueError("Unknown action. Use 'approve' or 'reject'")
+
+            step.update(
+                status="approved" if action == "approve" else "rejected",
+                actor_id=actor_id,
+                comments=full_comments,
+                acted_at=now,
+                version=step["version"] + 1,
+            )
+            letter["version"] += 1
+            self._log_event(letter_id, step["status"], actor_id, service._step_event(step, full_comments), now)
+            self._dequeue(step)
+            self._involved.setdefault(actor_id, set()).add(letter_id)
+            if action == "approve":
+                if current_step + 1 >= len(steps):
+                    letter["status"] = "approved"
+                else:
+                    letter["current_step"] = current_step + 1
+            else:
+                letter["status"] = "rejected"
+                for other in steps:
+                    if other["status"] == "pending":
+                        self._dequeue(other)
+                service.send_rejection_notice(letter_id, letter["sender_id"], full_comments)
+            return self.get_letter(letter_id)
+
+    def resend_letter(self, letter_id, sender_id, title, body) -> None:
+        with self._lock:
+            letter = self._letters.get(letter_id)
+            if not letter:
+                raise ValueError("Letter not found")
+            if letter["sender_id"] != sender_id:
+                raise ValueError("Not authorized to resend this letter")
+            if letter["status"] != "rejected":
+                raise ValueError("Only rejected letters can be resent")
+            letter.update(
+                title=title, body=body, status="pending", current_step=0,
+                version=letter["version"] + 1,
+            )
+            for step in self._steps[letter_id]:
+                if step["actor_id"] is not None and step["actor_id"] != sender_id:
+                    self._involved.get(step["actor_id"], set()).discard(letter_id)
+                step.update(
+                    status="pending", actor_id=None, comments=None, acted_at=None,
+                    version=step["version"] + 1,
+                )
+                self._enqueue(letter, step)
+            self._log_event(
+                letter_id, "resent", sender_id, {"title": title}, now_ms()
+            )
+
+    def get_letter(self, letter_id: int) -> Dict[str, Any]:
+        with self._lock:
+            letter = self._letters.get(letter_id)
+            sender = letter and self._users.get(letter["sender_id"])
+            if not sender:
+                raise ValueError("Letter not found")
+            steps = [self._with_actor(s) for s in self._steps[letter_id]]
+            current_step_info = None
+            if letter["status"] == "pending":
+                for step in steps:
+                    if step["step_index"] == letter["current_step"]:
+                        current_step_info = {"role": step["role"], "status": step["status"]}
+                        break
+            return {
+                "letter": Record.from_dict({
+                    **letter,
+                    "sender_name": sender["name"],
+                    "sender_role": sender["role"],
+                }),
+                "steps": steps,
+                "current_step": current_step_info,
+                "total_steps": len(steps),
+            }
+
+    def get_letter_history(self, letter_id: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [
+                Record.from_dict({
+                    "step_index": event["payload"]["step"],
+                    "role": event["payload"]["role"],
+                    "status": event["type"],
+                    "comments": event["payload"]["comments"],
+                    "acted_at": event["ts"],
+                    "actor_name": event["actor_name"],
+                    "actor_role": event["actor_role"],
+                })
+                for event in self.get_letter_events(letter_id)
+                if event["type"] in ("approved", "rejected", "commented")
+            ]
+
+    def get_letter_events(self, letter_id: int) -> List[Dict[str, Any]]:
+        with self._lock:
+            events = []
+            for seq, (type, actor_id, payload, ts) in enumerate(self._events.get(letter_id, ()), 1):
+                actor = self._users.get(actor_id)
+                events.append(Record.from_dict({
+                    "seq": seq,
+                    "type": type,
+                    "actor_id": actor_id,
+                    "actor_name": actor["name"] if actor else None,
+                    "actor_role": actor["role"] if actor else None,
+                    "payload": dict(payload),
+                    "ts": ts,
+                }))
+            return events
+
+    def _log_event(self, letter_id, type, actor_id, payload, ts) -> None:
+        self._events.setdefault(letter_id, []).append((type, actor_id, payload, ts))
+
+    def _with_actor(self, step: Dict[str, Any]) -> Record:
+        actor = self._users.get(step["actor_id"]) if step["actor_id"] is not None else None
+        return Record.from_dict({
+            **step,
+            "actor_name": actor["name"] if actor else None,
+            "actor_role": actor["role"] if actor else None,
+        })
@@ -0,0 +1,22 @@
+"""Helpers for tests that exercise the approval system."""
+from contextlib import contextmanager
+from typing import Iterator
+
+from .db import QueryStats, track_queries
+
+
+@contextmanager
+def assert_max_queries(limit: int) -> Iterator[QueryStats]:
+    """Fail if the block runs more than ``limit`` SQL statements.
+
+    Usage::
+
+        with assert_max_queries(20):
+            act_on_letter(path, lid, uid, "approve")
+    """
+    with track_queries() as stats:
+        yield stats
+    if stats.count > limit:
+        raise AssertionError(
+            f"Expected at most {limit} queries, ran {stats.count}:\n{stats.report()}"
+        )
@@ -0,0 +1,65 @@
+"""Timestamps as integer milliseconds since the Unix epoch (UTC).
+
+``created_at``, ``acted_at``, event ``ts`` and the job times are stored and
+passed around as ints: they compare and index as numbers and need no
+parsing. Callers outside the package see ISO-8601 text instead; the API, the
+CLI and exports convert with ``isoformat_fields`` on the way out, and
+``to_ms`` reads ``from``/``to`` filters given as either.
+"""
+from collections.abc import Mapping
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Optional, Union
+import time
+
+# Keys holding epoch-ms values in service rows
+TIMESTAMP_FIELDS = frozenset({"created_at", "acted_at", "ts", "started_at", "finished_at"})
+
+MS_PER_DAY = 86_400_000
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def now_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+
+def to_ms(value: Union[int, str, date, None]) -> Optional[int]:
+    """Epoch ms for an int, an ISO date or datetime (naive means UTC), or a date.
+
+    Only ints are taken as epoch ms; a string is always read as ISO, so
+    ``"20240101"`` is 2024-01-01 and ``"2024"`` is rejected rather than
+    meaning 2 seconds after 1970. Raises ValueError for anything else.
+    """
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        value = value.strip()
+        try:
+            value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            raise ValueError(f"Invalid timestamp: {value!r}. Use an ISO date, e.g. 2024-05-01") from None
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return (value - _EPOCH) // timedelta(milliseconds=1)
+
+
+def to_iso(ms: Optional[int]) -> Optional[str]:
+    """``2024-05-01T09:30:00.000`` (UTC, no offset) for epoch ms; None stays None."""
+    if ms is None:
+        return None
+    moment = _EPOCH + timedelta(milliseconds=ms)
+    return moment.replace(tzinfo=None).isoformat(timespec="milliseconds")
+
+
+def isoformat_fields(value: Any) -> Any:
+    """Copy of ``value`` with every ``TIMESTAMP_FIELDS`` entry, at any depth, as ISO text."""
+    if isinstance(value, Mapping):
+        return {
+            k: to_iso(v) if k in TIMESTAMP_FIELDS and isinstance(v, int) else isoformat_fields(v)
+            for k, v in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [isoformat_fields(v) for v in value]
+    return value
@@ -0,0 +1,140 @@
+"""Single-writer queue with group commit.
+
+SQLite allows one writer at a time. When many threads call ``send_letter`` or
+``act_on_letter`` at once they queue up on the file lock and some give up with
+``database is locked``. ``WriteQueue`` instead funnels writes through one
+thread that owns one connection::
+
+    writes = WriteQueue("approval.db")
+    future = writes.submit(send_letter, sender_id, "Exit Request", body)
+    letter_id = future.result()
+
+The writer collects whatever is queued (up to ``max_batch`` commands, waiting
+at most ``max_delay`` seconds after the first) and runs the group in a single
+transaction with one savepoint per command, so a failing command only undoes
+itself. Futures resolve after the group commits.
+
+Each process gets its own writer; several API workers still share the file
+lock, but with one connection each instead of one per request.
+
+With ``traced=True`` a command's statements count towards the submitter's
+``db.track_queries()`` block, as if it had run them itself.
+"""
+from concurrent.futures import Future
+from typing import Any, Callable, List, Tuple
+import contextvars
+import queue
+import sqlite3
+import threading
+import time
+
+from .db import attach_archive, get_conn, use_connection
+
+_STOP = object()
+_Command = Tuple[Future, Callable[..., Any], tuple, dict, contextvars.Context]
+
+
+class WriteQueue:
+    """Run write commands for ``db_path`` on a dedicated thread."""
+
+    def __init__(
+        self, db_path: str, max_batch: int = 64, max_delay: float = 0.002, traced: bool = False
+    ) -> None:
+        self.db_path = db_path
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.traced = traced
+        self.commands = 0
+        self.batches = 0
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="approval-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, func: Callable[..., Any], *args, **kwargs) -> Future:
+        """Queue ``func(db_path, *args, **kwargs)`` and return its future."""
+        future: Future = Future()
+        # run in the caller's context, so its track_queries() sees the statements
+        self._queue.put((future, func, args, kwargs, contextvars.copy_context()))
+        return future
+
+    def close(self) -> None:
+        """Finish queued commands and stop the writer thread."""
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def __enter__(self) -> "WriteQueue":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _run(self) -> None:
+        conn = get_conn(self.db_path, traced=self.traced)
+        conn.isolation_level = None  # transactions are managed below
+        attach_archive(conn, self.db_path)
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._run_batch(conn, batch)
+        conn.close()
+
+    def _begin(self, conn: sqlite3.Connection) -> None:
+        delay = 0.01
+        for attempt in range(8):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                return
+            except sqlite3.OperationalError as exc:
+                if "locked" not in str(exc) or attempt == 7:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+
+    def _run_batch(self, conn: sqlite3.Connection, batch: List[_Command]) -> None:
+        done = []
+        try:
+            self._begin(conn)
+            with use_connection(conn, self.db_path):
+                for future, func, args, kwargs, context in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    conn.execute("SAVEPOINT command")
+                    try:
+                        result = context.run(func, self.db_path, *args, **kwargs)
+                    except Exception as exc:
+                        conn.execute("ROLLBACK TO command")
+                        conn.execute("RELEASE command")
+                        done.append((future, exc, False))
+                    else:
+                        conn.execute("RELEASE command")
+                        done.append((future, result, True))
+            conn.execute("COMMIT")
+        except Exception as exc:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for future, *_ in batch:
+                if future.done():
+                    continue
+                if future.running() or future.set_running_or_notify_cancel():
+                    future.set_exception(exc)
+            return
+        self.batches += 1
+        self.commands += len(done)
+        for future, value, ok in done:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
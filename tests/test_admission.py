@@ -0,0 +1,95 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.approval_system.admission import Admission, ConcurrencyLimiter, RateLimiter
+
+
+def test_token_bucket_refills_per_client():
+    limiter = RateLimiter(rate=2, burst=3, max_clients=2)
+    assert [limiter.acquire("kiosk", now=0) for _ in range(3)] == [0, 0, 0]
+    assert limiter.acquire("kiosk", now=0) == pytest.approx(0.5)
+    assert limiter.acquire("other", now=0) == 0
+    assert limiter.acquire("kiosk", now=0.5) == 0
+    # least recently seen clients are forgotten (and start with a full bucket)
+    limiter.acquire("third", now=1)
+    assert len(limiter) == 2
+    assert [limiter.acquire("other", now=1) for _ in range(3)] == [0, 0, 0]
+
+
+def test_user_header_only_trusted_from_proxies():
+    admission = Admission(trusted_proxies=["10.0.0.1"])
+    assert admission.client_key("10.0.0.1", "7") == "user:7"
+    assert admission.client_key("10.0.0.1", None) == "10.0.0.1"
+    # anyone else is keyed by address whatever user id they claim
+    assert admission.client_key("203.0.113.5", "7") == "203.0.113.5"
+    assert Admission().client_key("10.0.0.1", "7") == "10.0.0.1"
+    assert Admission().client_key(None, None) == "-"
+
+
+def test_concurrency_limiter_queues_then_sheds():
+    async def scenario():
+        slots = ConcurrencyLimiter(limit=1, max_queue=1, timeout=0.05)
+        assert await slots.acquire()
+        waiter = asyncio.ensure_future(slots.acquire())
+        await asyncio.sleep(0)
+        assert slots.queued == 1
+        assert not await slots.acquire()  # queue full
+        slots.release()
+        assert await waiter
+        assert not await slots.acquire()  # timed out waiting
+        slots.release()
+        return slots
+
+    slots = asyncio.run(scenario())
+    assert (slots.in_flight, slots.queued, slots.peak_queued) == (0, 0, 1)
+
+
+def test_concurrency_limiter_rebinds_when_idle():
+    slots = ConcurrencyLimiter(limit=1, max_queue=1, timeout=1)
+
+    async def contend():
+        assert await slots.acquire()
+        waiter = asyncio.ensure_future(slots.acquire())
+        await asyncio.sleep(0)
+        slots.release()
+        assert await waiter
+        slots.release()
+
+    # a semaphore that has waited is tied to its loop; a new loop gets new slots
+    asyncio.run(contend())
+    asyncio.run(contend())
+
+    async def hold():
+        assert await slots.acquire()
+
+    asyncio.run(hold())
+    with pytest.raises(RuntimeError, match="another event loop"):
+        asyncio.run(hold())
+
+
+def test_api_rate_limits_reads_and_writes_separately(tmp_path, monkeypatch):
+    pytest.importorskip("fastapi")
+    pytest.importorskip("httpx")
+    from fastapi.testclient import TestClient
+    from test_api import load_api
+
+    monkeypatch.setenv("APPROVAL_DB", str(tmp_path / "approval.db"))
+    monkeypatch.setenv("APPROVAL_READ_RATE", "0.001")
+    monkeypatch.setenv("APPROVAL_READ_BURST", "2")
+    monkeypatch.setenv("APPROVAL_TRUSTED_PROXIES", "testclient")
+    with TestClient(load_api().app) as client:
+        assert client.get("/api/letters").status_code == 200
+        assert client.get("/api/letters").status_code == 200
+        res = client.get("/api/letters")
+        assert res.status_code == 429 and int(res.headers["Retry-After"]) > 0
+        # other clients and writes have their own budgets
+        assert client.get("/api/letters", headers={"X-User-Id": "7"}).status_code == 200
+        assert client.post("/api/users", json={"name": "Ada", "role": "Student"}).status_code == 200
+
+        stats = client.get("/api/admission").json()
+        assert stats["rate_limited_read"] == 1 and stats["admitted"] == 4
+        assert stats["in_flight"] == 0
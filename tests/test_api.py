@@ -0,0 +1,214 @@
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+from fastapi.testclient import TestClient
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+
+def load_api():
+    """Import approval-system/api.py afresh so it picks up the environment."""
+    spec = importlib.util.spec_from_file_location(
+        "approval_api", os.path.join(ROOT, "approval-system", "api.py")
+    )
+    api = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(api)
+    return api
+
+
+@pytest.fixture
+def db_path(monkeypatch):
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    monkeypatch.setenv("APPROVAL_DB", path)
+    yield path
+    os.remove(path)
+
+
+@pytest.fixture
+def client(db_path, monkeypatch):
+    monkeypatch.setenv("APPROVAL_DEBUG", "1")
+    return TestClient(load_api().app)
+
+
+def test_query_count_header(client):
+    res = client.post("/api/users", json={"name": "Ada", "role": "Student"})
+    assert res.status_code == 200
+    sender = res.json()["id"]
+    res = client.post("/api/send", json={"sender_id": sender, "title": "Exit Request", "body": "x"})
+    assert res.status_code == 200
+    assert int(res.headers["X-Query-Count"]) >= 6
+
+    res = client.get("/api/users")
+    assert res.headers["X-Query-Count"] == "1"
+
+
+def test_query_headers_off_by_default(db_path):
+    res = TestClient(load_api().app).get("/api/users")
+    assert res.status_code == 200 and "X-Query-Count" not in res.headers
+
+
+def test_write_queue_mode(db_path, monkeypatch):
+    monkeypatch.setenv("APPROVAL_WRITE_QUEUE", "1")
+    monkeypatch.setenv("APPROVAL_DEBUG", "1")
+    api = load_api()
+    queued = TestClient(api.app)
+    try:
+        sender = queued.post("/api/users", json={"name": "Ada", "role": "Student"}).json()["id"]
+        res = queued.post("/api/send", json={"sender_id": sender, "title": "t", "body": "b"})
+        assert res.status_code == 200
+        # statements run on the writer thread count towards the request
+        assert int(res.headers["X-Query-Count"]) >= 6
+        res = queued.post("/api/act", json={
+            "letter_id": res.json()["id"], "actor_name": "Sam", "actor_role": "SRC", "action": "approve",
+        })
+        assert res.json()["current_step"] == {"role": "Faculty", "status": "pending"}
+        assert api.WRITER.commands == 4
+    finally:
+        api.WRITER.close()
+
+
+def test_admin_overview_and_lookup(client):
+    sender = client.post("/api/users", json={"name": "Ada", "role": "Student"}).json()["id"]
+    for i in range(3):
+        client.post("/api/send", json={"sender_id": sender, "title": f"t{i}", "body": "b"})
+    client.post("/api/act", json={
+        "letter_id": 1, "actor_name": "src", "actor_role": "SRC", "action": "reject",
+    })
+
+    res = client.get("/api/admin/overview", params={"recent": 2})
+    overview = res.json()
+    assert overview["counts"] == {"pending": 2, "rejected": 1}
+    assert overview["total"] == 3
+    assert overview["pending_by_role"]["SRC"] == 2
+    assert [l["title"] for l in overview["recent"]] == ["t2", "t1"]
+    assert "body" not in overview["recent"][0]
+    assert int(res.headers["X-Query-Count"]) <= 4
+
+    res = client.get("/api/pending/counts")
+    counts = res.json()
+    assert counts["SRC"] == counts["Vice Chancellor"] == 2
+    assert counts["Student"] == 0
+    assert int(res.headers["X-Query-Count"]) == 1
+
+    res = client.get("/api/users/lookup", params={"name": "ADA"})
+    assert [u["id"] for u in res.json()] == [sender]
+    assert client.get("/api/users/lookup", params={"name": "nobody"}).json() == []
+
+
+def test_list_fields_and_gzip(client):
+    sender = client.post("/api/users", json={"name": "Ada", "role": "Student"}).json()["id"]
+    for i in range(20):
+        client.post("/api/send", json={"sender_id": sender, "title": f"t{i}", "body": "x" * 200})
+
+    res = client.get("/api/letters", params={"fields": "id,title,status"})
+    assert res.json()[0] == {"id": 20, "title": "t19", "status": "pending"}
+    assert client.get("/api/letters", params={"fields": "id,secret"}).status_code == 400
+
+    rows = client.get("/api/pending", params={"role": "SRC", "fields": "letter_id,title"}).json()
+    assert rows[0] == {"letter_id": 1, "title": "t0"}
+
+    res = client.get("/api/letters", headers={"Accept-Encoding": "gzip"})
+    assert res.headers["content-encoding"] == "gzip"
+    assert len(res.json()) == 20 and res.json()[0]["body"] == "x" * 200
+    small = client.get("/api/letters", params={"fields": "id"}, headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+
+
+def test_timestamps_are_iso_with_date_range(client):
+    from datetime import datetime
+
+    sender = client.post("/api/users", json={"name": "Ada", "role": "Student"}).json()["id"]
+    lid = client.post("/api/send", json={"sender_id": sender, "title": "t", "body": "b"}).json()["id"]
+
+    sent = client.get(f"/api/letter/{lid}").json()["letter"]["created_at"]
+    assert datetime.fromisoformat(sent).year >= 2024
+    rows = client.get("/api/letters", params={"from": sent[:10]}).json()
+    assert [(r["id"], r["created_at"]) for r in rows] == [(lid, sent)]
+    assert client.get("/api/letters", params={"to": "2000-01-01"}).json() == []
+    assert client.get("/api/pending", params={"role": "SRC", "from": "2999-01-01"}).json() == []
+    assert client.get("/api/letters", params={"from": "soon"}).status_code == 400
+
+
+def test_idempotency_key_replays_writes(client, db_path):
+    from src.approval_system.db import get_conn
+
+    sender = client.post("/api/users", json={"name": "Ada", "role": "Student"}).json()["id"]
+    letter = {"sender_id": sender, "title": "Exit Request", "body": "x"}
+    first = client.post("/api/send", json=letter, headers={"Idempotency-Key": "k1"})
+    again = client.post("/api/send", json=letter, headers={"Idempotency-Key": "k1"})
+    assert first.json() == again.json() == {"id": 1}
+    assert "Idempotent-Replayed" not in first.headers
+    assert again.headers["Idempotent-Replayed"] == "true"
+    assert again.headers["X-Query-Count"] == "1"
+
+    act = {"letter_id": 1, "actor_name": "src", "actor_role": "SRC", "action": "approve"}
+    first = client.post("/api/act", json=act, headers={"Idempotency-Key": "k2"})
+    again = client.post("/api/act", json=act, headers={"Idempotency-Key": "k2"})
+    assert first.status_code == again.status_code == 200
+    assert again.json() == first.json()
+    assert first.json()["current_step"]["role"] == "Faculty"
+    # without a key the duplicate is a second action and fails
+    assert client.post("/api/act", json=act).status_code == 400
+
+    # errors are replayed too, and a key can't be reused for another request
+    bad = {**act, "letter_id": 99}
+    assert client.post("/api/act", json=bad, headers={"Idempotency-Key": "k3"}).status_code == 400
+    res = client.post("/api/act", json=bad, headers={"Idempotency-Key": "k3"})
+    assert res.status_code == 400 and res.headers["Idempotent-Replayed"] == "true"
+    assert client.post("/api/send", json=letter, headers={"Idempotency-Key": "k1x"}).status_code == 200
+    assert client.post("/api/send", json={**letter, "title": "other"}, headers={"Idempotency-Key": "k1"}).status_code == 422
+
+    conn = get_conn(db_path)
+    assert conn.execute("SELECT COUNT(*) FROM letters").fetchone()[0] == 2
+    conn.execute("UPDATE idempotency_keys SET expires_at = 0 WHERE key = 'k1'")
+    conn.commit()
+    conn.close()
+    assert client.post("/api/send", json=letter, headers={"Idempotency-Key": "k1"}).json() == {"id": 3}
+
+
+def test_bulk_user_import(client):
+    users = [{"name": f"s{i}", "role": "Student"} for i in range(5)]
+    users += [{"name": "s1", "role": "Student"}, {"name": "x", "role": "Janitor"}]
+    res = client.post("/api/users/bulk", json={"users": users}, headers={"Idempotency-Key": "bulk"})
+    assert res.status_code == 200
+    assert res.json()["imported"] == 5
+    assert [r["row"] for r in res.json()["rejected"]] == [6, 7]
+    again = client.post("/api/users/bulk", json={"users": users}, headers={"Idempotency-Key": "bulk"})
+    assert again.json() == res.json() and again.headers["Idempotent-Replayed"] == "true"
+    assert len(client.get("/api/users").json()) == 5
+
+
+def test_background_export_job(db_path, monkeypatch):
+    monkeypatch.setenv("APPROVAL_JOB_WORKERS", "1")
+    api = load_api()
+    client = TestClient(api.app)
+    sender = client.post("/api/users", json={"name": "Ada", "role": "Student"}).json()["id"]
+    client.post("/api/send", json={"sender_id": sender, "title": "Exit Request", "body": "x"})
+
+    assert client.post("/api/jobs", json={"kind": "nope"}).status_code == 400
+    assert client.get("/api/jobs/999").status_code == 404
+    try:
+        res = client.post("/api/jobs", json={"kind": "export_letters", "params": {"format": "csv"}})
+        assert res.status_code == 200
+        url = res.json()["url"]
+        deadline = time.monotonic() + 30
+        while (job := client.get(url).json())["status"] in ("queued", "running"):
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+    finally:
+        api.JOBS.stop()
+    assert job["status"] == "done" and "result_path" not in job
+    res = client.get(job["result_url"])
+    assert res.status_code == 200 and res.headers["content-type"].startswith("text/csv")
+    assert "Exit Request" in res.text
+    shutil.rmtree(os.path.splitext(db_path)[0] + ".jobs")
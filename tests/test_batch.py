@@ -0,0 +1,38 @@
+import io
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.approval_system import get_letter, list_all_letters
+from src.approval_system.batch import run_batch
+
+
+def test_run_batch(tmp_path):
+    path = str(tmp_path / "approval.db")
+    commands = [
+        {"op": "create-user", "name": "s", "role": "Student"},
+        {"op": "create-user", "name": "r", "role": "SRC"},
+        {"op": "create-user", "name": "r", "role": "SRC"},
+        *[{"op": "send", "sender_id": 1, "title": f"t{i}", "body": "b", "id": i} for i in range(5)],
+        {"op": "act", "letter_id": 1, "actor_id": 2, "action": "approve", "comments": "ok"},
+        {"op": "history", "letter_id": 1},
+        {"op": "fly"},
+    ]
+    lines = [json.dumps(c) for c in commands] + ["", "{broken"]
+    out = io.StringIO()
+    assert run_batch(path, lines, out, chunk_size=3) == (9, 3)
+
+    results = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [r["ok"] for r in results] == [True, True, False] + [True] * 7 + [False, False]
+    assert "already exists" in results[2]["error"]
+    assert [r["id"] for r in results[3:8]] == [0, 1, 2, 3, 4]
+    assert results[8]["result"]["current_step"]["role"] == "Faculty"
+    assert results[9]["result"][0]["comments"] == "ok"
+    assert results[9]["result"][0]["acted_at"][10] == "T"
+    assert results[8]["result"]["letter"]["created_at"][10] == "T"
+    assert results[10]["error"].startswith("Unknown op")
+    assert results[11]["line"] == 13  # blank line 12 is skipped
+
+    assert len(list_all_letters(path)) == 5
+    assert get_letter(path, 1)["steps"][0]["status"] == "approved"
@@ -0,0 +1,101 @@
+import io
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+import cli
+from src.approval_system import create_user, init_db, iter_letters, send_letter
+from src.approval_system import service
+
+
+def run_cli(*args):
+    out = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "cli.py"), *args],
+        capture_output=True, text=True, check=True,
+    )
+    return out.stdout
+
+
+def test_iter_letters_fetches_in_batches(tmp_path, monkeypatch):
+    path = str(tmp_path / "approval.db")
+    init_db(path)
+    sender = create_user(path, "s", "Student")
+    for i in range(7):
+        send_letter(path, sender, f"t{i}", "b")
+    monkeypatch.setattr(service, "FETCH_SIZE", 3)
+    rows = iter_letters(path)
+    assert next(rows)["title"] == "t6"
+    assert [r["title"] for r in rows] == [f"t{i}" for i in range(5, -1, -1)]
+
+
+def test_list_formats(tmp_path):
+    path = str(tmp_path / "approval.db")
+    init_db(path)
+    sender = create_user(path, "s", "Student")
+    send_letter(path, sender, "Exit Request", "line one\nline\ttwo")
+    send_letter(path, sender, "Second", "b")
+
+    letters = json.loads(run_cli("--db", path, "list-all", "--format", "json"))
+    assert [l["title"] for l in letters] == ["Second", "Exit Request"]
+    assert letters[0]["created_at"][10] == "T"
+    assert run_cli("--db", path, "list-all", "--from", "2999-01-01", "--format", "ndjson") == ""
+    lines = run_cli("--db", path, "list-pending", "SRC", "--to", "2999-01-01", "--format", "ndjson")
+    assert len(lines.splitlines()) == 2
+
+    lines = run_cli("--db", path, "list-pending", "SRC", "--format", "ndjson").splitlines()
+    assert [json.loads(l)["title"] for l in lines] == ["Exit Request", "Second"]
+
+    counts = run_cli("--db", path, "list-pending", "--counts").splitlines()
+    assert [l.split()[-1] for l in counts if l.startswith("SRC ")] == ["2"]
+    lines = run_cli("--db", path, "list-pending", "Staff", "--counts", "--format", "ndjson").splitlines()
+    assert [json.loads(l) for l in lines] == [{"role": "Staff", "pending": 0}]
+
+    tsv = run_cli("--db", path, "list-all", "--format", "tsv").splitlines()
+    assert len(tsv) == 3
+    header = tsv[0].split("\t")
+    assert tsv[2].split("\t")[header.index("body")] == "line one\\nline\\ttwo"
+
+
+def test_write_rows_empty():
+    out = io.StringIO()
+    assert cli.write_rows(iter(()), "json", out) == 0
+    assert json.loads(out.getvalue()) == []
+
+
+def test_import_users(tmp_path):
+    path = str(tmp_path / "approval.db")
+    csv_path = tmp_path / "users.csv"
+    csv_path.write_text("name,role\nAda,Student\nBob,Janitor\nAda,Student\n", encoding="utf-8")
+    rejected = [json.loads(l) for l in run_cli("--db", path, "import-users", str(csv_path), "--format", "ndjson").splitlines()]
+    assert [(r["row"], r["name"]) for r in rejected] == [(2, "Bob"), (3, "Ada")]
+    assert [u["name"] for u in service.find_users_by_name(path, "ada")] == ["Ada"]
+
+
+def test_commands_migrate_old_databases(tmp_path):
+    from src.approval_system import db
+
+    path = str(tmp_path / "old.db")
+    conn = db.get_conn(path)
+    for migration in db._MIGRATIONS[:4]:
+        for statement in migration:
+            conn.execute(statement)
+    conn.execute("PRAGMA user_version = 4")
+    conn.execute("INSERT INTO users(name, role) VALUES ('Ada', 'Student')")
+    conn.commit()
+    conn.close()
+
+    assert json.loads(run_cli("--db", path, "list-all", "--format", "json")) == []
+    assert db.get_conn(path).execute("PRAGMA user_version").fetchone()[0] == db.SCHEMA_VERSION
+
+
+def test_errors_go_to_stderr(tmp_path):
+    path = str(tmp_path / "approval.db")
+    out = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "cli.py"), "--db", path, "batch", str(tmp_path / "missing.ndjson")],
+        capture_output=True, text=True,
+    )
+    assert out.returncode == 1
+    assert out.stdout == "" and "Error" in out.stderr
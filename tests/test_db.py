@@ -0,0 +1,330 @@
+import logging
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.approval_system import init_db, create_user, send_letter, act_on_letter
+from src.approval_system import db
+from src.approval_system.testing import assert_max_queries
+
+
+@pytest.fixture
+def path():
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    init_db(path)
+    yield path
+    os.remove(path)
+
+
+def test_query_budget(path):
+    approver = create_user(path, "a", "SRC")
+    sender = create_user(path, "s", "Student")
+    with assert_max_queries(12):
+        lid = send_letter(path, sender, "Test", "Please approve")
+    with assert_max_queries(12) as stats:
+        act_on_letter(path, lid, approver, "approve")
+    assert stats.count > 0
+    assert any("UPDATE steps" in sql for sql, _, _ in stats.top())
+
+    with pytest.raises(AssertionError, match="at most 1 queries"):
+        with assert_max_queries(1):
+            send_letter(path, sender, "Test", "Please approve")
+
+
+def test_slow_query_log_includes_plan(path, caplog):
+    threshold = db.SLOW_QUERY_MS
+    db.enable_tracing(slow_query_ms=0)
+    try:
+        with caplog.at_level(logging.WARNING, logger="approval_system.sql"):
+            create_user(path, "a", "SRC")
+    finally:
+        db.disable_tracing()
+        db.SLOW_QUERY_MS = threshold
+    messages = "\n".join(r.getMessage() for r in caplog.records)
+    assert "SELECT id FROM users WHERE name = ? AND role_id = ?" in messages
+    assert "USING COVERING INDEX idx_users_name_role" in messages
+    assert db.global_stats.count > 0
+
+
+def test_init_db_skips_current_schema(path):
+    with db.track_queries() as stats:
+        init_db(path)
+    assert stats.count == 0
+    conn = db.get_conn(path)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == db.SCHEMA_VERSION
+    conn.close()
+
+
+def test_init_db_rechecks_changed_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "CURRENT_FILES_MAX", 2)
+    db._current_files.clear()
+    paths = [str(tmp_path / f"{i}.db") for i in range(3)]
+    for p in paths:
+        init_db(p)
+    assert len(db._current_files) == 2
+
+    # a file written since it was checked gets one cheap version check again
+    init_db(paths[2])
+    conn = db.get_conn(paths[2])
+    conn.execute("INSERT INTO users(name, role_id) VALUES ('x', 1)")
+    conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    with db.track_queries() as stats:
+        init_db(paths[2])
+    assert stats.count > 0
+    with db.track_queries() as stats:
+        init_db(paths[2])
+    assert stats.count == 0
+
+
+def test_init_db_upgrades_unversioned_file(tmp_path):
+    legacy = str(tmp_path / "legacy.db")
+    conn = db.get_conn(legacy)
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, role TEXT NOT NULL)")
+    conn.execute("INSERT INTO users(name, role) VALUES ('old', 'SRC')")
+    conn.commit()
+    conn.close()
+    init_db(legacy)
+    conn = db.get_conn(legacy)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == db.SCHEMA_VERSION
+    assert conn.execute("SELECT name FROM users").fetchone()["name"] == "old"
+    conn.close()
+
+
+def _schema_at(path, version):
+    """Create ``path`` with the schema as of ``version``."""
+    conn = db.get_conn(path)
+    for migration in db._MIGRATIONS[:version]:
+        if callable(migration):
+            migration(conn)
+            continue
+        for statement in migration:
+            conn.execute(statement)
+    conn.execute(f"PRAGMA user_version = {version}")
+    return conn
+
+
+def test_bodies_move_out_of_letters(tmp_path):
+    from src.approval_system import get_letter, list_all_letters
+
+    path = str(tmp_path / "v4.db")
+    long_body = "Please approve my request. " * 100
+    conn = _schema_at(path, 4)
+    conn.execute("INSERT INTO users(name, role) VALUES ('Ada', 'Student')")
+    for lid, body in ((1, "archived"), (2, "short"), (3, long_body)):
+        conn.execute(
+            "INSERT INTO letters(id, title, body, sender_id, created_at) VALUES(?, ?, ?, 1, ?)",
+            (lid, f"t{lid}", body, f"2020-01-0{lid}"),
+        )
+    conn.execute("DELETE FROM letters WHERE id = 1")
+    conn.commit()
+    conn.close()
+    archive = _schema_at(db.archive_path_for(path), 4)
+    archive.execute(
+        "INSERT INTO letters(id, title, body, sender_id, status, created_at) "
+        "VALUES(1, 't1', 'archived', 1, 'approved', '2020-01-01')"
+    )
+    archive.commit()
+    archive.close()
+
+    init_db(path)
+    assert "body" not in db.table_columns(db.get_conn(path), "letters")
+    conn = db.get_conn(path)
+    codecs = {r["id"]: r["codec"] for r in conn.execute("SELECT id, codec FROM letter_bodies")}
+    assert codecs[2] == "raw" and codecs[3] in ("zlib", "zstd")
+    conn.close()
+    assert [l["body"] for l in list_all_letters(path)] == [long_body, "short", "archived"]
+    assert get_letter(path, 1)["letter"]["body"] == "archived"
+
+    # new letters and bodies never reuse ids that live in the archive
+    lid = send_letter(path, 1, "new", "fresh")
+    assert lid == 4
+    conn = db.get_conn(path)
+    assert conn.execute("SELECT body_id FROM letters WHERE id = 4").fetchone()[0] > 3
+    conn.close()
+    assert get_letter(path, lid)["letter"]["body"] == "fresh"
+
+
+def test_event_log_backfilled_from_steps(tmp_path):
+    from src.approval_system import get_letter_events, get_letter_history
+
+    path = str(tmp_path / "v8.db")
+    conn = _schema_at(path, 8)
+    conn.executemany(
+        "INSERT INTO users(id, name, role) VALUES(?, ?, ?)",
+        [(1, "Ada", "Student"), (2, "Bo", "SRC"), (3, "Cy", "HOD")],
+    )
+    conn.execute("INSERT INTO letter_bodies(id, hash, codec, data, refcount) VALUES(1, x'00', 'raw', 'b', 1)")
+    conn.execute(
+        "INSERT INTO letters(id, title, body_id, sender_id, created_at, current_step) "
+        "VALUES(1, 'Trip', 1, 1, '2020-01-01', 1)"
+    )
+    conn.executemany(
+        "INSERT INTO steps(letter_id, step_index, role, status, actor_id, comments, acted_at) "
+        "VALUES(1, ?, ?, ?, ?, ?, ?)",
+        [
+            (0, "SRC", "approved", 2, "fine", "2020-01-02"),
+            (1, "HOD", "pending", None, "[..] Cy (HOD): hmm", None),
+            (2, "Dean", "pending", None, None, None),
+        ],
+    )
+    conn.commit()
+    conn.close()
+
+    init_db(path)
+    assert [(e["seq"], e["type"], e["actor_name"], e["ts"]) for e in get_letter_events(path, 1)] == [
+        (1, "sent", "Ada", 1577836800000),
+        (2, "approved", "Bo", 1577923200000),
+        (3, "commented", None, 1577836800000),
+    ]
+    assert [(h["step_index"], h["role"], h["comments"]) for h in get_letter_history(path, 1)] == [
+        (0, "SRC", "fine"),
+        (1, "HOD", "[..] Cy (HOD): hmm"),
+    ]
+    # new events continue the backfilled sequence
+    act_on_letter(path, 1, 3, "approve")
+    assert get_letter_events(path, 1)[-1]["seq"] == 4
+
+
+def test_role_names_become_ids(tmp_path):
+    from src.approval_system import get_letter, get_pending_counts, list_pending_for_role
+    from src.approval_system.roles import ROLES, role_name
+
+    path = str(tmp_path / "v12.db")
+    conn = _schema_at(path, 12)
+    conn.executemany(
+        "INSERT INTO users(id, name, role) VALUES(?, ?, ?)",
+        [(1, "Ada", "Student"), (2, "Bo", "Dean"), (3, "Cy", "Registrar")],
+    )
+    conn.execute("INSERT INTO letter_bodies(id, hash, codec, data, refcount) VALUES(1, x'00', 'raw', 'b', 1)")
+    conn.execute("INSERT INTO letters(id, title, body_id, sender_id, created_at) VALUES(1, 'Trip', 1, 1, '2020-01-01')")
+    conn.executemany(
+        "INSERT INTO steps(letter_id, step_index, role) VALUES(1, ?, ?)", [(0, "Dean"), (1, "Registrar")]
+    )
+    conn.commit()
+    conn.close()
+
+    init_db(path)
+    conn = db.get_conn(path)
+    assert "role" not in db.table_columns(conn, "users") + db.table_columns(conn, "steps")
+    ids = {r["name"]: r["id"] for r in conn.execute("SELECT name, id FROM roles")}
+    assert ids["Dean"] == ROLES.index("Dean") + 1 and ids["Registrar"] == len(ROLES) + 1
+    assert [r[0] for r in conn.execute("SELECT role_id FROM steps ORDER BY step_index")] == [
+        ids["Dean"], ids["Registrar"],
+    ]
+    conn.close()
+    # a role only this DB knows still reads back by name
+    assert role_name(ids["Registrar"]) == "Registrar"
+    assert [s["role"] for s in get_letter(path, 1)["steps"]] == ["Dean", "Registrar"]
+    assert [l["title"] for l in list_pending_for_role(path, "Dean")] == ["Trip"]
+    assert get_pending_counts(path)["Registrar"] == 1
+    act_on_letter(path, 1, 2, "approve")
+    assert get_letter(path, 1)["current_step"]["role"] == "Registrar"
+
+
+def test_timestamps_become_epoch_ms(tmp_path):
+    from src.approval_system import list_all_letters
+
+    path = str(tmp_path / "v13.db")
+    conn = _schema_at(path, 13)
+    conn.execute("INSERT INTO users(id, name, role_id) VALUES(1, 'Ada', 9)")
+    conn.execute("INSERT INTO letter_bodies(id, hash, codec, data, refcount) VALUES(1, x'00', 'raw', 'b', 1)")
+    conn.executemany(
+        "INSERT INTO letters(id, title, body_id, sender_id, created_at) VALUES(?, ?, 1, 1, ?)",
+        [(1, "Old", "2020-01-01T00:00:00.250"), (2, "New", "2020-03-01T12:00:00")],
+    )
+    conn.execute("INSERT INTO steps(letter_id, step_index, role_id, acted_at) VALUES(1, 0, 1, '2020-01-02')")
+    conn.execute("INSERT INTO jobs(kind, params, created_at) VALUES('letter_rollup', '{}', '2020-01-01')")
+    conn.commit()
+    conn.close()
+
+    init_db(path)
+    conn = db.get_conn(path)
+    assert [r[0] for r in conn.execute("SELECT created_at FROM letters ORDER BY id")] == [
+        1577836800250, 1583064000000,
+    ]
+    assert conn.execute("SELECT acted_at FROM steps").fetchone()[0] == 1577923200000
+    assert conn.execute("SELECT created_at, started_at FROM jobs").fetchone()[:] == (1577836800000, None)
+    plan = " ".join(
+        r[3] for r in conn.execute("EXPLAIN QUERY PLAN SELECT id FROM steps WHERE acted_at >= 0")
+    )
+    assert "idx_steps_acted" in plan
+    conn.close()
+    assert [l["title"] for l in list_all_letters(path, date_from="2020-02-01")] == ["New"]
+
+
+def test_unreadable_timestamps_stop_the_migration(tmp_path):
+    path = str(tmp_path / "v13.db")
+    conn = _schema_at(path, 13)
+    conn.execute("INSERT INTO users(id, name, role_id) VALUES(1, 'Ada', 9)")
+    conn.execute("INSERT INTO letter_bodies(id, hash, codec, data, refcount) VALUES(1, x'00', 'raw', 'b', 1)")
+    conn.executemany(
+        "INSERT INTO letters(id, title, body_id, sender_id, created_at) VALUES(?, ?, 1, 1, ?)",
+        [(1, "Good", "2020-01-01"), (2, "Bad", "last tuesday")],
+    )
+    conn.commit()
+    conn.close()
+
+    with pytest.raises(ValueError, match=r"letters\.created_at: 'last tuesday'"):
+        init_db(path)
+    conn = db.get_conn(path)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == 13
+    assert [r[0] for r in conn.execute("SELECT created_at FROM letters ORDER BY id")] == [
+        "2020-01-01", "last tuesday",
+    ]
+    conn.execute("UPDATE letters SET created_at = '2020-01-02' WHERE id = 2")
+    conn.commit()
+    conn.close()
+    init_db(path)
+
+
+def test_package_import_is_lazy():
+    import subprocess
+
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    code = (
+        "import sys\n"
+        "from src.approval_system import get_letter\n"
+        "print(sorted(m for m in sys.modules if m.startswith('src.approval_system')))\n"
+    )
+    out = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True)
+    loaded = out.stdout.strip()
+    assert "src.approval_system.service" in loaded
+    assert "storage" not in loaded and "writer" not in loaded
+
+
+def test_data_version_token(path):
+    version = db.DataVersion(path, max_age=0)
+    first = version.token()
+    assert version.token() == first
+    create_user(path, "a", "SRC")
+    second = version.token()
+    assert second != first
+    version.bump()
+    assert version.token() != second
+
+    lazy = db.DataVersion(path, max_age=3600)
+    token = lazy.token()
+    create_user(path, "b", "SRC")
+    assert lazy.token() == token  # within the staleness window
+
+
+def test_idempotency_expiry_becomes_ms(tmp_path):
+    path = str(tmp_path / "v14.db")
+    conn = _schema_at(path, 14)
+    conn.execute(
+        "INSERT INTO idempotency_keys(key, request_hash, status, response, expires_at) "
+        "VALUES('k', x'00', 200, x'7b7d', 1700000000)"
+    )
+    conn.commit()
+    conn.close()
+
+    init_db(path)
+    conn = db.get_conn(path)
+    assert conn.execute("SELECT expires_at FROM idempotency_keys").fetchone()[0] == 1700000000000
+    conn.close()
@@ -0,0 +1,172 @@
+import csv
+import json
+import os
+import sqlite3
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.approval_system import (
+    JobQueue,
+    act_on_letter,
+    create_user,
+    get_job,
+    init_db,
+    send_letter,
+    submit_job,
+)
+from src.approval_system import jobs
+from src.approval_system.db import get_conn
+from src.approval_system.jobs import (
+    claim_job,
+    purge_jobs,
+    requeue_stale_jobs,
+    results_dir_for,
+    run_job,
+)
+from src.approval_system.timestamps import MS_PER_DAY
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / "approval.db")
+    init_db(path)
+    sender = create_user(path, "sender", "Student")
+    approver = create_user(path, "src", "SRC")
+    for i in range(5):
+        send_letter(path, sender, f"L{i}", "body", route=["SRC"])
+    act_on_letter(path, 1, approver, "approve")
+    return path
+
+
+def wait_for(path, job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = get_job(path, job_id)
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"job {job_id} still {job['status']}")
+
+
+def test_export_and_rollup_in_process(db, monkeypatch):
+    monkeypatch.setattr(jobs, "PROGRESS_EVERY", 2)
+    export = submit_job(db, "export_letters", {"format": "csv", "status": "pending", "fields": ["id", "title"]})
+    rollup = submit_job(db, "letter_rollup")
+    assert get_job(db, export)["status"] == "queued"
+
+    assert claim_job(db) == export
+    run_job(db, export)
+    job = get_job(db, export)
+    assert job["status"] == "done" and job["progress"] == 1.0
+    assert job["result_path"] == os.path.join(results_dir_for(db), f"job-{export}.csv")
+    with open(job["result_path"], newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert sorted(r["title"] for r in rows) == ["L1", "L2", "L3", "L4"]
+    assert list(rows[0]) == ["id", "title"]
+
+    assert claim_job(db) == rollup and claim_job(db) is None
+    run_job(db, rollup)
+    with open(get_job(db, rollup)["result_path"]) as f:
+        report = json.load(f)
+    assert {r["status"]: r["count"] for r in report["by_day"]} == {"approved": 1, "pending": 4}
+    assert report["pending_by_role"]["SRC"] == 4
+
+
+def test_bad_jobs_are_rejected_or_fail(db, monkeypatch):
+    with pytest.raises(ValueError):
+        submit_job(db, "drop_tables")
+    with pytest.raises(ValueError):
+        submit_job(db, "export_letters", {"format": "xlsx"})
+
+    def broken(source, params, out, progress):
+        out.write("partial")
+        raise RuntimeError("disk full")
+
+    monkeypatch.setitem(jobs.JOB_KINDS, "letter_rollup", (broken, None, lambda p: "json"))
+    job_id = submit_job(db, "letter_rollup")
+    claim_job(db)
+    run_job(db, job_id)
+    job = get_job(db, job_id)
+    assert job["status"] == "failed" and job["error"] == "disk full"
+    assert os.listdir(results_dir_for(db)) == []
+
+
+def test_queue_runs_jobs_in_worker_processes(db):
+    with JobQueue(db, workers=2, poll=0.05) as queue:
+        ids = [submit_job(db, "export_letters", {"format": "ndjson"}) for _ in range(3)]
+        queue.wake()
+        finished = [wait_for(db, job_id) for job_id in ids]
+    assert [j["status"] for j in finished] == ["done"] * 3
+    with open(finished[0]["result_path"]) as f:
+        assert len([json.loads(line) for line in f]) == 5
+
+
+def test_purge_finished_jobs(db):
+    old, recent, queued = [submit_job(db, "letter_rollup") for _ in range(3)]
+    for job_id in (old, recent):
+        claim_job(db)
+        run_job(db, job_id)
+    old_result = get_job(db, old)["result_path"]
+    conn = get_conn(db)
+    conn.execute("UPDATE jobs SET finished_at = finished_at - ? WHERE id = ?", (8 * MS_PER_DAY, old))
+    conn.commit()
+    conn.close()
+
+    assert purge_jobs(db, older_than_days=7) == 1
+    assert get_job(db, old) is None and not os.path.exists(old_result)
+    assert os.path.exists(get_job(db, recent)["result_path"])
+    assert get_job(db, queued)["status"] == "queued"
+
+
+def test_stale_running_jobs_are_requeued_then_failed(db):
+    job_id = submit_job(db, "letter_rollup")
+    live = submit_job(db, "letter_rollup")
+
+    def expire():
+        conn = get_conn(db)
+        conn.execute("UPDATE jobs SET heartbeat_at = heartbeat_at - 60000 WHERE id = ?", (job_id,))
+        conn.commit()
+        conn.close()
+
+    for attempt in (1, 2):
+        assert claim_job(db) == job_id
+        expire()
+        assert requeue_stale_jobs(db, lease=30, max_attempts=2) == 1
+        assert get_job(db, job_id)["status"] == ("queued" if attempt == 1 else "failed")
+    assert get_job(db, job_id)["error"] == "lease expired"
+
+    assert claim_job(db) == live
+    assert requeue_stale_jobs(db, lease=30) == 0
+    run_job(db, live)
+    assert get_job(db, live)["status"] == "done"
+
+
+def test_requeued_job_outcome_is_dropped(db):
+    job_id = submit_job(db, "letter_rollup")
+    claim_job(db)
+    conn = get_conn(db)
+    conn.execute("UPDATE jobs SET status = 'queued' WHERE id = ?", (job_id,))
+    conn.commit()
+    conn.close()
+    run_job(db, job_id)
+    assert get_job(db, job_id)["status"] == "queued"
+
+
+def test_dispatcher_survives_db_errors(db, monkeypatch, caplog):
+    claim = jobs.claim_job
+    calls = []
+
+    def locked_once(path):
+        calls.append(path)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        return claim(path)
+
+    monkeypatch.setattr(jobs, "claim_job", locked_once)
+    job_id = submit_job(db, "letter_rollup")
+    with JobQueue(db, workers=1, poll=0.05):
+        assert wait_for(db, job_id)["status"] == "done"
+    assert "Claiming a job failed" in caplog.text
@@ -0,0 +1,46 @@
+import json
+import os
+import pickle
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.approval_system import create_user, init_db, list_all_letters, send_letter
+from src.approval_system.records import Record
+
+
+def test_record_behaves_like_a_read_only_dict():
+    row = Record.from_dict({"id": 1, "title": "Exit Request", "body": None})
+    assert row["title"] == "Exit Request" and row[0] == 1
+    assert row.get("missing", "x") == "x" and "body" in row and 0 not in row
+    assert list(row) == ["id", "title", "body"] and len(row) == 3
+    assert row == {"id": 1, "title": "Exit Request", "body": None}
+    assert dict(row) == row.to_dict()
+    assert json.loads(row.to_json()) == row.to_dict()
+    assert pickle.loads(pickle.dumps(row)) == row
+    assert not hasattr(row, "__dict__")
+
+
+def test_duplicate_column_names(tmp_path):
+    from src.approval_system.db import get_conn
+
+    conn = get_conn(str(tmp_path / "approval.db"))
+    row = conn.execute("SELECT 1 AS id, 2 AS title, 3 AS id").fetchone()
+    conn.close()
+    assert row["id"] == 1 and row[2] == 3
+    assert len(row) == 2 and list(row) == ["id", "title"]
+    assert row.to_dict() == {"id": 1, "title": 2} == dict(row)
+    assert repr(row) == "Record(id=1, title=2)"
+
+
+def test_listing_rows_are_smaller_than_dicts(tmp_path):
+    path = str(tmp_path / "approval.db")
+    init_db(path)
+    sender = create_user(path, "s", "Student")
+    for i in range(300):
+        send_letter(path, sender, f"t{i}", "b")
+
+    rows = list_all_letters(path)
+    assert all(isinstance(r, Record) for r in rows)
+    # the values tuple comes from sqlite3 either way; a record adds one
+    # small object where dict(row) added a full hash table
+    assert sys.getsizeof(rows[0]) * 4 < sys.getsizeof(dict(rows[0]))
@@ -0,0 +1,89 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.approval_system import (
+    act_on_letter,
+    archive_letters,
+    create_user,
+    get_admin_overview,
+    init_db,
+    list_all_letters,
+    send_letter,
+)
+from src.approval_system.replica import ReplicaManager
+
+
+def test_snapshot_routing_and_staleness(tmp_path):
+    path = str(tmp_path / "approval.db")
+    init_db(path)
+    sender = create_user(path, "sender", "Student")
+    send_letter(path, sender, "first", "body")
+
+    replica = ReplicaManager(path, interval=60, pages=1)
+    assert replica.staleness() is None and replica.reader_path() == path
+    replica.refresh()
+    assert replica.reader_path() == replica.replica_path == str(tmp_path / "approval.replica.db")
+    assert replica.staleness() < 5
+
+    send_letter(path, sender, "second", "body")
+    assert [l["title"] for l in list_all_letters(replica.reader_path())] == ["first"]
+    assert get_admin_overview(replica.reader_path())["total"] == 1
+    replica.refresh()
+    assert [l["title"] for l in list_all_letters(replica.reader_path())] == ["second", "first"]
+
+    # a snapshot older than max_staleness is no longer served
+    old = time.time() - 1000
+    os.utime(replica.replica_path, (old, old))
+    assert replica.staleness() > 900
+    assert replica.reader_path() == path
+    assert replica.stats()["serving"] == "primary"
+
+
+def test_archive_is_snapshotted_too(tmp_path):
+    path = str(tmp_path / "approval.db")
+    init_db(path)
+    sender = create_user(path, "sender", "Student")
+    approver = create_user(path, "src", "SRC")
+    old = send_letter(path, sender, "old", "body", route=["SRC"])
+    act_on_letter(path, old, approver, "approve")
+    assert archive_letters(path, older_than_days=-1) == 1
+    send_letter(path, sender, "new", "body")
+
+    replica = ReplicaManager(path)
+    replica.refresh()
+    assert os.path.exists(str(tmp_path / "approval.replica.archive.db"))
+    assert [l["title"] for l in list_all_letters(replica.reader_path())] == ["new", "old"]
+
+
+def test_refresh_runs_alongside_writers(tmp_path):
+    path = str(tmp_path / "approval.db")
+    init_db(path)
+    sender = create_user(path, "sender", "Student")
+    for i in range(200):
+        send_letter(path, sender, f"L{i}", "x" * 2000)
+
+    stop = threading.Event()
+    sent = []
+
+    def writer():
+        while not stop.is_set():
+            sent.append(send_letter(path, sender, "during", "body"))
+
+    replica = ReplicaManager(path, interval=0.01, pages=4, sleep=0).start()
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        deadline = time.monotonic() + 10
+        while replica.refreshes < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        stop.set()
+        thread.join()
+        replica.stop()
+    assert replica.refreshes >= 3 and replica.failures == 0
+    assert sent
+    # every snapshot is a consistent copy that the service can read
+    assert len(list_all_letters(replica.replica_path)) >= 200
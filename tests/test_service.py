@@ -59,3 +59,269 @@ def test_full_flow():
             os.remove(path)
         except Exception:
             pass
+
+
+def test_archive_reads_through():
+    from src.approval_system import archive_letters, get_letter_history, list_all_letters, resend_letter
+    from src.approval_system import service
+    from src.approval_system.db import archive_path_for, get_conn
+
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        init_db(path)
+        approver = create_user(path, "src", "SRC")
+        sender = create_user(path, "sender", "Student")
+        old = send_letter(path, sender, "Old", "rejected long ago")
+        act_on_letter(path, old, approver, "reject", comments="no")
+        fresh = send_letter(path, sender, "Fresh", "still pending")
+        conn = get_conn(path)
+        conn.execute("UPDATE steps SET acted_at = 978307200000 WHERE letter_id = ?", (old,))
+        conn.commit()
+        conn.close()
+
+        before = (get_letter(path, old), get_letter_history(path, old), list_all_letters(path))
+        assert archive_letters(path, older_than_days=30, batch_size=1) == 1
+        after = (get_letter(path, old), get_letter_history(path, old), list_all_letters(path))
+        assert after == before
+
+        conn = get_conn(path)
+        hot = [r["id"] for r in conn.execute("SELECT id FROM letters")]
+        conn.close()
+        assert hot == [fresh]
+        assert service.count_letters(path) == 2
+        assert service.count_letters(path, "rejected") == 1
+        assert service.count_letters(path, date_from="2999-01-01") == 0
+
+        # resending an archived rejection brings it back into the hot DB
+        resend_letter(path, old, sender, "Old-upd", "second try")
+        assert get_letter(path, old)["letter"]["status"] == "pending"
+        assert get_letter(path, old)["letter"]["body"] == "second try"
+        assert archive_letters(path, older_than_days=30) == 0
+    finally:
+        for p in (path, archive_path_for(path)):
+            if os.path.exists(p):
+                os.remove(p)
+
+
+def test_paged_listings_filter_in_sql(tmp_path):
+    from src.approval_system import list_letters_page, list_pending_page
+
+    path = str(tmp_path / "pages.db")
+    init_db(path)
+    approver = create_user(path, "src", "SRC")
+    ada = create_user(path, "Ada Lovelace", "Student")
+    bob = create_user(path, "Bob", "Student")
+    ids = [send_letter(path, ada if i % 2 else bob, f"Request {i}", f"body {i}") for i in range(7)]
+    act_on_letter(path, ids[0], approver, "reject", comments="no")
+
+    rows, total = list_letters_page(path, limit=3, offset=0)
+    assert total == 7
+    assert [r["id"] for r in rows] == ids[::-1][:3]
+    assert "body" not in rows[0]
+    rows, _ = list_letters_page(path, limit=3, offset=6)
+    assert [r["id"] for r in rows] == [ids[0]]
+
+    assert list_letters_page(path, status="rejected")[1] == 1
+    assert list_letters_page(path, sender="lovelace")[1] == 3
+    assert list_letters_page(path, search="body 4")[0][0]["id"] == ids[4]
+    assert list_letters_page(path, date_from="2000-01-01", date_to="2000-01-02")[1] == 0
+    assert list_letters_page(path, date_from="2000-01-01")[1] == 7
+
+    rows, total = list_pending_page(path, "SRC", limit=4, offset=4)
+    assert total == 6
+    assert [r["letter_id"] for r in rows] == ids[5:]
+
+
+def test_search_unpacks_only_remaining_bodies(tmp_path, monkeypatch):
+    from src.approval_system import bodies, list_letters_page
+
+    path = str(tmp_path / "search.db")
+    init_db(path)
+    approver = create_user(path, "src", "SRC")
+    sender = create_user(path, "s", "Student")
+    long_body = "Please approve my request. " * 40
+    ids = [send_letter(path, sender, f"Trip {i}", long_body + f"needle {i}") for i in range(4)]
+    send_letter(path, sender, "Short", "needle in a raw body")
+    act_on_letter(path, ids[0], approver, "reject")
+
+    unpacked = []
+    unpack = bodies.unpack
+
+    def counting(codec, data):
+        unpacked.append(codec)
+        return unpack(codec, data)
+
+    monkeypatch.setattr(bodies, "unpack", counting)
+    assert list_letters_page(path, search="trip")[1] == 4
+    assert unpacked == []
+    # only the rejected letter's compressed body is read (count and page)
+    rows, total = list_letters_page(path, status="rejected", search="needle 0")
+    assert total == 1 and rows[0]["id"] == ids[0]
+    assert len(unpacked) == 2 and "raw" not in unpacked
+    assert list_letters_page(path, search="raw body")[1] == 1
+
+def test_identical_bodies_are_stored_once(tmp_path):
+    from src.approval_system import archive_letters, body_stats, get_letter, resend_letter
+    from src.approval_system.db import archive_path_for, get_conn
+
+    path = str(tmp_path / "dedup.db")
+    init_db(path)
+    approver = create_user(path, "src", "SRC")
+    sender = create_user(path, "sender", "Student")
+    template = "I request permission to leave campus for the weekend. " * 20
+    ids = [send_letter(path, sender, "Exit Request", template, route=["SRC"]) for _ in range(4)]
+    other = send_letter(path, sender, "Other", "different", route=["SRC"])
+
+    def bodies(db):
+        conn = get_conn(db)
+        rows = [(r["refcount"], r["codec"]) for r in conn.execute("SELECT refcount, codec FROM letter_bodies ORDER BY id")]
+        conn.close()
+        return rows
+
+    assert bodies(path)[0][0] == 4 and len(bodies(path)) == 2
+    stats = body_stats(path)
+    assert (stats["references"], stats["bodies"]) == (5, 2)
+    assert stats["dedup_ratio"] == 2.5
+    assert stats["stored_bytes"] < stats["logical_bytes"]
+
+    # resending swaps the reference; an unreferenced body is dropped
+    act_on_letter(path, other, approver, "reject", comments="no")
+    resend_letter(path, other, sender, "Other", template)
+    assert bodies(path)[0][0] == 5 and len(bodies(path)) == 1
+
+    # archived letters keep sharing one body per DB
+    for lid in ids[:2]:
+        act_on_letter(path, lid, approver, "approve")
+    conn = get_conn(path)
+    conn.execute("UPDATE steps SET acted_at = 978307200000 WHERE letter_id IN (?, ?)", ids[:2])
+    conn.commit()
+    conn.close()
+    assert archive_letters(path, older_than_days=30, batch_size=1) == 2
+    assert bodies(path)[0][0] == 3
+    assert [r[0] for r in bodies(archive_path_for(path))] == [2]
+    assert get_letter(path, ids[0])["letter"]["body"] == template
+    assert body_stats(path)["references"] == 5
+
+
+def test_concurrent_approvals_apply_once(tmp_path):
+    import threading
+    from collections import Counter
+    from src.approval_system import ConflictError
+
+    path = str(tmp_path / "race.db")
+    init_db(path)
+    route = ["SRC", "Faculty", "HOD"]
+    actors = [(create_user(path, f"{role}{i}", role), role) for role in route for i in range(3)]
+    sender = create_user(path, "sender", "Faculty Association")
+    letters = [send_letter(path, sender, f"L{i}", "body", route) for i in range(10)]
+
+    applied = Counter()
+    errors = []
+    counter_lock = threading.Lock()
+
+    def worker(actor_id, role):
+        # keep sweeping until every letter is through, racing the other actors
+        # of the same role for each step
+        for _ in range(200):
+            open_letters = [lid for lid in letters if get_letter(path, lid)["letter"]["status"] == "pending"]
+            if not open_letters:
+                return
+            for lid in open_letters:
+                try:
+                    act_on_letter(path, lid, actor_id, "approve", retries=3)
+                except ConflictError:
+                    pass
+                except ValueError as e:
+                    if "role" not in str(e) and "already" not in str(e):
+                        errors.append(e)
+                    continue
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                else:
+                    with counter_lock:
+                        applied[(lid, role)] += 1
+
+    threads = [threading.Thread(target=worker, args=a) for a in actors]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not errors
+    # every step was approved by exactly one successful call: none lost, none doubled
+    assert applied == Counter({(lid, role): 1 for lid in letters for role in route})
+    for lid in letters:
+        out = get_letter(path, lid)
+        assert out["letter"]["status"] == "approved"
+        assert all(s["status"] == "approved" and s["actor_id"] for s in out["steps"])
+        assert [s["version"] for s in out["steps"]] == [1] * len(route)
+        assert out["letter"]["version"] == len(route)
+
+
+def test_letter_conflict_undoes_step_on_borrowed_connection(tmp_path, monkeypatch):
+    from src.approval_system import ConflictError, get_letter_events, service
+    from src.approval_system.db import get_conn, use_connection
+
+    path = str(tmp_path / "shared.db")
+    init_db(path)
+    approver = create_user(path, "src", "SRC")
+    sender = create_user(path, "sender", "Student")
+    lid = send_letter(path, sender, "Trip", "b", route=["SRC", "HOD"])
+
+    get_step = service._get_step
+    bumps = []
+
+    def racing_get_step(conn, letter_id, step_index):
+        # another writer changes the letter after we read it, once per call
+        step = get_step(conn, letter_id, step_index)
+        if len(bumps) < 2:
+            conn.execute("UPDATE letters SET version = version + 1 WHERE id = ?", (letter_id,))
+            bumps.append(letter_id)
+        return step
+
+    monkeypatch.setattr(service, "_get_step", racing_get_step)
+    conn = get_conn(path)
+    conn.isolation_level = None
+    conn.execute("BEGIN IMMEDIATE")
+    with use_connection(conn, path):
+        try:
+            act_on_letter(path, lid, approver, "approve", retries=0)
+            assert False, "expected a conflict"
+        except ConflictError:
+            pass
+        # the claimed step was undone, so a retry applies cleanly
+        out = act_on_letter(path, lid, approver, "approve", retries=1)
+    conn.execute("COMMIT")
+    conn.close()
+
+    assert out["steps"][0]["status"] == "approved" and out["steps"][0]["version"] == 1
+    assert out["letter"]["current_step"] == 1
+    assert [e["type"] for e in get_letter_events(path, lid)] == ["sent", "approved"]
+
+
+def test_concurrent_identical_bodies(tmp_path):
+    import threading
+
+    path = str(tmp_path / "bodies.db")
+    init_db(path)
+    senders = [create_user(path, f"s{i}", "Student") for i in range(6)]
+    errors = []
+
+    def sender(uid):
+        for i in range(30):
+            try:
+                send_letter(path, uid, "t", f"body {i}")
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=sender, args=(uid,)) for uid in senders]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    from src.approval_system import body_stats
+    stats = body_stats(path)
+    assert stats["bodies"] == 30 and stats["references"] == 180
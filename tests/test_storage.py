@@ -0,0 +1,291 @@
+"""Conformance suite run against every storage backend."""
+import os
+import sys
+from collections.abc import Mapping
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.approval_system import (
+    MemoryStorage,
+    SQLiteStorage,
+    ShardedStorage,
+    act_on_letter,
+    create_user,
+    get_letter,
+    get_letter_events,
+    get_admin_overview,
+    get_letter_history,
+    get_pending_counts,
+    import_users,
+    init_db,
+    iter_letters,
+    iter_pending_for_role,
+    list_all_letters,
+    list_letters_page,
+    list_pending_for_role,
+    list_pending_page,
+    resend_letter,
+    send_letter,
+)
+from src.approval_system.service import DEFAULT_ROUTE
+
+
+@pytest.fixture(params=["sqlite", "memory", "sharded"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteStorage(str(tmp_path / "approval.db"))
+    if request.param == "sharded":
+        return ShardedStorage([str(tmp_path / f"shard{i}.db") for i in range(3)])
+    return MemoryStorage()
+
+
+@pytest.fixture
+def people(store):
+    init_db(store)
+    users = {role: create_user(store, f"u-{role}", role) for role in DEFAULT_ROUTE}
+    users["sender"] = create_user(store, "sender", "Student")
+    return users
+
+
+def test_create_user_validation(store, people):
+    with pytest.raises(ValueError, match="Invalid role"):
+        create_user(store, "x", "Janitor")
+    with pytest.raises(ValueError, match="already exists"):
+        create_user(store, "sender", "Student")
+    with pytest.raises(ValueError, match="not found"):
+        send_letter(store, 999, "t", "b")
+    with pytest.raises(ValueError, match="Invalid role in route"):
+        send_letter(store, people["sender"], "t", "b", route=["SRC", "Janitor"])
+
+
+def test_import_users(store, people):
+    lines = [
+        "name,role",
+        "a1,Student",
+        "a2,Janitor",
+        "sender,Student",
+        "a3,Staff",
+        ",Student",
+        "a1,Student",
+        '"Doe, Jane",SRC',
+    ]
+    result = import_users(store, lines, chunk_size=2)
+    assert result["imported"] == 3
+    assert [(r["row"], r["error"].split(":")[0]) for r in result["rejected"]] == [
+        (2, "Invalid role"),
+        (3, "User 'sender' with role 'Student' already exists"),
+        (5, "Missing name or role"),
+        (6, "User 'a1' with role 'Student' already exists"),
+    ]
+    # imported users are real users on every backend (and shard)
+    for name, role in [("a1", "Student"), ("a3", "Staff"), ("Doe, Jane", "SRC")]:
+        with pytest.raises(ValueError, match="already exists"):
+            create_user(store, name, role)
+    new = import_users(store, [{"name": "b1", "role": "Student"}])
+    assert new == {"imported": 1, "rejected": []}
+    assert import_users(store, []) == {"imported": 0, "rejected": []}
+
+
+def test_full_approval(store, people):
+    lid = send_letter(store, people["sender"], "Exit Request", "Going home")
+    for role in DEFAULT_ROUTE:
+        assert [p["letter_id"] for p in list_pending_for_role(store, role)] == [lid]
+        out = act_on_letter(store, lid, people[role], "approve", comments=f"ok {role}")
+    assert out["letter"]["status"] == "approved"
+    assert out["current_step"] is None
+    assert out["total_steps"] == len(DEFAULT_ROUTE)
+    assert [s["actor_name"] for s in out["steps"]] == [f"u-{r}" for r in DEFAULT_ROUTE]
+    assert all(list_pending_for_role(store, r) == [] for r in DEFAULT_ROUTE)
+    with pytest.raises(ValueError, match="already approved"):
+        act_on_letter(store, lid, people["SRC"], "approve")
+
+
+def test_reject_and_resend(store, people, capsys):
+    lid = send_letter(store, people["sender"], "Exit Request", "Going home")
+    act_on_letter(store, lid, people["SRC"], "approve")
+    out = act_on_letter(store, lid, people["Faculty"], "reject", "no", "try later")
+    assert out["letter"]["status"] == "rejected"
+    assert out["steps"][1]["comments"] == "no\nRecommendations: try later"
+    assert "notifying user" in capsys.readouterr().out
+    assert list_pending_for_role(store, "HOD") == []
+    assert [l["id"] for l in list_all_letters(store, people["Faculty"])] == [lid]
+
+    with pytest.raises(ValueError, match="Not authorized"):
+        resend_letter(store, lid, people["SRC"], "t", "b")
+    resend_letter(store, lid, people["sender"], "Exit Request v2", "Please")
+    letter = get_letter(store, lid)
+    assert letter["letter"]["title"] == "Exit Request v2"
+    assert letter["current_step"] == {"role": "SRC", "status": "pending"}
+    assert all(s["actor_id"] is None for s in letter["steps"])
+    assert list_all_letters(store, people["Faculty"]) == []
+    assert len(list_pending_for_role(store, "HOD")) == 1
+    with pytest.raises(ValueError, match="Only rejected"):
+        resend_letter(store, lid, people["sender"], "t", "b")
+
+
+def test_act_errors(store, people):
+    lid = send_letter(store, people["sender"], "Exit Request", "Going home")
+    with pytest.raises(ValueError, match="cannot act on step role"):
+        act_on_letter(store, lid, people["HOD"], "approve")
+    with pytest.raises(ValueError, match="Unknown action"):
+        act_on_letter(store, lid, people["SRC"], "escalate")
+    with pytest.raises(ValueError, match="Actor not found"):
+        act_on_letter(store, lid, 999, "approve")
+    with pytest.raises(ValueError, match="Letter not found"):
+        act_on_letter(store, 999, people["SRC"], "approve")
+    with pytest.raises(ValueError, match="Students are not permitted"):
+        act_on_letter(store, lid, people["sender"], "comment", "hi")
+
+
+def test_comment_keeps_step_pending(store, people):
+    lid = send_letter(store, people["sender"], "Exit Request", "Going home")
+    act_on_letter(store, lid, people["Dean"], "comment", "first")
+    out = act_on_letter(store, lid, people["HOD"], "comment", "second")
+    comments = out["steps"][0]["comments"].splitlines()
+    assert comments[0].endswith("u-Dean (Dean): first")
+    assert comments[1].endswith("u-HOD (HOD): second")
+    assert out["steps"][0]["status"] == "pending"
+
+
+def test_listings(store, people):
+    first = send_letter(store, people["sender"], "A", "a")
+    second = send_letter(store, people["sender"], "B", "b", route=["HOD"])
+    assert [l["id"] for l in list_all_letters(store)] == [second, first]
+    assert [p["letter_id"] for p in list_pending_for_role(store, "HOD")] == [first, second]
+    row = list_pending_for_role(store, "HOD")[1]
+    assert row["sender_name"] == "sender" and row["letter_status"] == "pending"
+    assert row["body"] == "b" and row["step_index"] == 0
+    assert list(iter_letters(store)) == list_all_letters(store)
+    assert list(iter_pending_for_role(store, "HOD")) == list_pending_for_role(store, "HOD")
+
+    slim = list_all_letters(store, fields=["id", "title", "id"])
+    assert [dict(r) for r in slim] == [{"id": second, "title": "B"}, {"id": first, "title": "A"}]
+    slim = list_pending_for_role(store, "HOD", fields=["letter_id", "sender_name"])
+    assert dict(slim[0]) == {"letter_id": first, "sender_name": "sender"}
+    with pytest.raises(ValueError, match="Unknown field"):
+        list_all_letters(store, fields=["body; DROP TABLE letters"])
+
+    counts = get_pending_counts(store)
+    assert set(counts) >= set(DEFAULT_ROUTE)
+    assert {r: counts[r] for r in ("SRC", "HOD", "Dean")} == {"SRC": 1, "HOD": 2, "Dean": 1}
+    assert counts == {r: len(list_pending_for_role(store, r)) for r in counts}
+
+    act_on_letter(store, second, people["HOD"], "approve")
+    history = get_letter_history(store, second)
+    assert [(h["role"], h["status"], h["actor_name"]) for h in history] == [
+        ("HOD", "approved", "u-HOD")
+    ]
+    assert get_letter_history(store, 999) == []
+    with pytest.raises(ValueError, match="Letter not found"):
+        get_letter(store, 999)
+
+
+def test_date_range(store, people):
+    first = send_letter(store, people["sender"], "A", "a", route=["HOD"])
+    second = send_letter(store, people["sender"], "B", "b", route=["HOD"])
+    letters = list_all_letters(store)
+    assert all(isinstance(l["created_at"], int) for l in letters)
+    newest = letters[0]["created_at"]
+
+    assert [l["id"] for l in list_all_letters(store, date_from="2000-01-01")] == [second, first]
+    assert list_all_letters(store, date_to="2000-01-01T00:00:00Z") == []
+    # [from, to): a letter created exactly at ``to`` is left out
+    assert second in [l["id"] for l in list_all_letters(store, date_from=newest)]
+    assert second not in [l["id"] for l in list_all_letters(store, date_to=newest)]
+    assert list(iter_letters(store, None, None, newest)) == list_all_letters(store, date_from=newest)
+    assert [p["letter_id"] for p in list_pending_for_role(store, "HOD", date_from="2000-01-01")] == [
+        first, second,
+    ]
+    assert list(iter_pending_for_role(store, "HOD", None, None, "2000-01-01")) == []
+    with pytest.raises(ValueError, match="Invalid timestamp"):
+        list_all_letters(store, date_from="last tuesday")
+    # digit strings are dates, never epoch ms
+    assert len(list_all_letters(store, date_from="20000101")) == 2
+    with pytest.raises(ValueError, match="Invalid timestamp"):
+        list_all_letters(store, date_from="2024")
+
+
+def test_pages_and_overview(store, people):
+    ids = [
+        send_letter(store, people["sender"], title, body, route=["HOD"])
+        for title, body in (("Trip", "to Paris"), ("Leave", "two days"), ("Paris trip", "again"))
+    ]
+    act_on_letter(store, ids[1], people["HOD"], "reject", "no")
+
+    page, total = list_letters_page(store, limit=2)
+    assert total == 3 and [l["id"] for l in page] == ids[::-1][:2]
+    assert set(page[0]) == {"id", "title", "sender_id", "status", "created_at", "current_step", "sender_name"}
+    page, total = list_letters_page(store, limit=2, offset=2)
+    assert total == 3 and [l["id"] for l in page] == [ids[0]]
+    assert [l["id"] for l in list_letters_page(store, search="PARIS")[0]] == [ids[2], ids[0]]
+    assert [l["id"] for l in list_letters_page(store, status="rejected", sender="SEND")[0]] == [ids[1]]
+    assert list_letters_page(store, date_to="2000-01-01") == ([], 0)
+
+    page, total = list_pending_page(store, "HOD", limit=1, offset=1)
+    assert total == 2 and [(p["letter_id"], p["sender_name"]) for p in page] == [(ids[2], "sender")]
+    assert list_pending_page(store, "Dean") == ([], 0)
+
+    overview = get_admin_overview(store, recent=2)
+    assert overview["counts"] == {"pending": 2, "rejected": 1} and overview["total"] == 3
+    assert overview["pending_by_role"] == {"HOD": 2}
+    assert [l["id"] for l in overview["recent"]] == [ids[2], ids[1]]
+
+
+def test_history_keeps_every_round(store, people):
+    lid = send_letter(store, people["sender"], "Trip", "v1", route=["HOD", "Dean"])
+    act_on_letter(store, lid, people["Dean"], "comment", "why?")
+    act_on_letter(store, lid, people["HOD"], "reject", "no")
+    resend_letter(store, lid, people["sender"], "Trip", "v2")
+    act_on_letter(store, lid, people["HOD"], "approve", "ok now")
+    history = get_letter_history(store, lid)
+    assert [(h["status"], h["step_index"], h["actor_name"], h["comments"]) for h in history] == [
+        ("commented", 0, "u-Dean", "why?"),
+        ("rejected", 0, "u-HOD", "no"),
+        ("approved", 0, "u-HOD", "ok now"),
+    ]
+    events = get_letter_events(store, lid)
+    assert [(e["seq"], e["type"]) for e in events] == [
+        (1, "sent"), (2, "commented"), (3, "rejected"), (4, "resent"), (5, "approved"),
+    ]
+    assert events[0]["payload"] == {"title": "Trip"}
+    assert events[0]["actor_name"] == "sender"
+    assert get_letter_events(store, 999) == []
+
+
+def test_backends_agree(tmp_path):
+    """Run one scenario on both backends and compare every result."""
+
+    def scenario(store):
+        init_db(store)
+        ids = {role: create_user(store, role.lower(), role) for role in DEFAULT_ROUTE}
+        s = create_user(store, "s", "Student")
+        a = send_letter(store, s, "A", "a")
+        b = send_letter(store, s, "B", "b")
+        act_on_letter(store, a, ids["SRC"], "approve", "fine")
+        act_on_letter(store, b, ids["SRC"], "reject", "no")
+        resend_letter(store, b, s, "B2", "b2")
+        act_on_letter(store, b, ids["SRC"], "approve")
+        act_on_letter(store, b, ids["Faculty"], "approve")
+        return [
+            get_letter(store, a),
+            get_letter(store, b),
+            get_letter_history(store, a),
+            get_letter_history(store, b),
+            get_letter_events(store, b),
+            list_all_letters(store),
+            list_all_letters(store, ids["SRC"]),
+            *[list_pending_for_role(store, r) for r in DEFAULT_ROUTE],
+        ]
+
+    def scrub(value):
+        if isinstance(value, Mapping):
+            return {k: scrub(v) for k, v in value.items() if k not in ("created_at", "acted_at", "ts")}
+        if isinstance(value, list):
+            return [scrub(v) for v in value]
+        return value
+
+    sqlite = scenario(SQLiteStorage(str(tmp_path / "a.db")))
+    memory = scenario(MemoryStorage())
+    assert scrub(memory) == scrub(sqlite)
+    assert type(memory[0]["letter"]) is type(sqlite[0]["letter"])
@@ -0,0 +1,45 @@
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.approval_system import act_on_letter, create_user, init_db, list_all_letters, send_letter
+from src.approval_system.writer import WriteQueue
+
+
+def test_concurrent_writes_are_group_committed(tmp_path):
+    path = str(tmp_path / "approval.db")
+    init_db(path)
+    sender = create_user(path, "sender", "Student")
+    approver = create_user(path, "src", "SRC")
+
+    futures = []
+    lock = threading.Lock()
+
+    def client():
+        for _ in range(25):
+            f = writes.submit(send_letter, sender, "Exit Request", "body")
+            with lock:
+                futures.append(f)
+
+    with WriteQueue(path, max_delay=0.01) as writes:
+        threads = [threading.Thread(target=client) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        ids = [f.result(timeout=10) for f in futures]
+
+        # a failing command is rolled back on its own; its neighbours commit
+        bad = writes.submit(act_on_letter, ids[0], 999, "approve")
+        good = writes.submit(act_on_letter, ids[0], approver, "approve")
+        with pytest.raises(ValueError, match="Actor not found"):
+            bad.result(timeout=10)
+        assert good.result(timeout=10)["letter"]["current_step"] == 1
+
+    assert len(set(ids)) == 200
+    assert len(list_all_letters(path)) == 200
+    assert writes.commands == 202
+    assert writes.batches < writes.commands